@@ -0,0 +1,169 @@
+''' Aligns the samples of every microbit onto one uniform timebase.
+The microbits are polled one after another, so their samples are interleaved
+and unevenly spaced, and comparing balls needs them at the same times.
+Aligner is a StagedResampler, see resample.py, which interpolates the
+samples of every microbit onto a shared grid at SAMPLE_RATE, column k at
+k / SAMPLE_RATE seconds, with one np.interp over all of them. Only the
+columns between the last column of each microbit and its newest sample are
+worked out on each flush, never the whole window.
+The columns are held in one devices x WINDOW array used as a ring, so the
+last WINDOW columns of every microbit are kept in fixed memory. Columns a
+microbit has no samples around, before its first sample or across a gap
+longer than MAX_GAP_NS, are NaN.
+The microbits fill their columns at different times, so window returns the
+columns up to the last one filled by every microbit which has had samples
+within MAX_LAG_NS of the newest, as a devices x time matrix in time order.
+correlate estimates the lag between pairs of microbits from the peak of
+their cross-correlation over the last CORRELATION_COLUMNS columns, worked
+out for every pair at once with one rfft of the rows. '''
+
+import numpy as np
+
+from resample import MAX_GAP_NS, StagedResampler, interpolate
+
+# rate of the shared grid in Hz
+SAMPLE_RATE = 50
+# columns kept for each microbit, about 10 seconds
+WINDOW = 512
+# columns between flushes
+FLUSH_COLUMNS = 8
+# a microbit with no samples for this long no longer holds back the aligned columns
+MAX_LAG_NS = 500000000
+# columns correlated and the largest lag searched, about 5 and 1 seconds
+CORRELATION_COLUMNS = 256
+MAX_SHIFT = 50
+
+
+class Aligner(StagedResampler):
+    def __init__(self, num_microbits=3, sample_rate=SAMPLE_RATE, window=WINDOW,
+            flush_columns=FLUSH_COLUMNS, max_gap_ns=MAX_GAP_NS, max_lag_ns=MAX_LAG_NS):
+        self.period_ns = 1000000000 // sample_rate
+        self.window_size = window
+        self.max_lag_ns = max_lag_ns
+        # the column after the last filled by any microbit
+        self.end = 0
+        # changes whenever columns are filled
+        self.sequence = 0
+        super().__init__(num_microbits, flush_columns * self.period_ns, max_gap_ns)
+
+
+    def add(self, devices, times, mags, starts, lengths, restart):
+        ''' Fill the columns of each microbit in <devices> up to its newest
+        sample, see StagedResampler.add. '''
+        rows, columns, values = self.fill(devices, times, mags, starts, lengths, restart)
+        end = int(self.filled[devices].max())
+        if end > self.end:
+            # clear the columns the ring moves on to
+            self.matrix[:, np.arange(max(self.end, end - self.window_size), end)
+                % self.window_size] = np.nan
+            self.end = end
+        # columns which have left the window are not filled
+        kept = columns >= self.end - self.window_size
+        self.matrix[rows[kept], columns[kept] % self.window_size] = values[kept]
+        self.sequence += 1
+
+
+    def correlate(self, pairs=None, num_columns=CORRELATION_COLUMNS, max_shift=MAX_SHIFT):
+        ''' Return {(a, b): (lag in seconds, correlation)} for each pair of
+        microbit ids in <pairs>, or every pair with samples, from the peak of
+        their normalised cross-correlation over the last <num_columns>
+        aligned columns, searching lags up to <max_shift> columns. A positive
+        lag means that microbit a follows microbit b. '''
+        _, matrix = self.window(num_columns)
+        if matrix.shape[1] <= max_shift:
+            return {}
+        held = ~np.isnan(matrix).all(axis=1)
+        if pairs is None:
+            first, second = np.triu_indices(len(matrix), 1)
+        else:
+            first, second = (np.array([pair[n] for pair in pairs], dtype=np.int64)
+                for n in (0, 1))
+        keep = (first < len(matrix)) & (second < len(matrix))
+        first, second = first[keep], second[keep]
+        keep = held[first] & held[second]
+        first, second = first[keep], second[keep]
+        if not len(first):
+            return {}
+        # the columns a microbit has no samples for count as its mean
+        missing = np.isnan(matrix)
+        values = np.where(missing, 0, matrix)
+        counts = np.maximum((~missing).sum(axis=1, keepdims=True), 1)
+        values -= values.sum(axis=1, keepdims=True) / counts
+        values[missing] = 0
+        size = 1 << (matrix.shape[1] + max_shift - 1).bit_length()
+        spectra = np.fft.rfft(values, size, axis=1)
+        products = np.fft.irfft(spectra[first] * spectra[second].conj(), size, axis=1)
+        # shifts from -max_shift to max_shift
+        products = np.concatenate((products[:, -max_shift:], products[:, :max_shift + 1]), axis=1)
+        energy = (values * values).sum(axis=1)
+        norms = np.sqrt(energy[first] * energy[second])
+        norms[norms == 0] = np.inf
+        correlations = products / norms[:, None]
+        peaks = correlations.argmax(axis=1)
+        rows = np.arange(len(peaks))
+        peak_correlations = correlations[rows, peaks]
+        # a parabola through the peak and its neighbours places it between columns
+        inside = (peaks > 0) & (peaks < 2 * max_shift)
+        offsets = np.zeros(len(peaks))
+        around = correlations[rows[inside, None], peaks[inside, None] + [-1, 0, 1]]
+        curve = around[:, 0] - 2 * around[:, 1] + around[:, 2]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            offsets[inside] = np.where(curve < 0, 0.5 * (around[:, 0] - around[:, 2]) / curve, 0)
+        lags = (peaks + offsets - max_shift) * self.period_ns / 1e9
+        return {(int(a), int(b)): (float(lag), float(correlation)) for a, b, lag, correlation
+            in zip(first, second, lags, peak_correlations)}
+
+
+    def create_state(self, num_microbits):
+        ''' Start every microbit with no columns. '''
+        super().create_state(num_microbits)
+        self.matrix = np.full((num_microbits, self.window_size), np.nan)
+        # the column after the last filled by each microbit
+        self.filled = np.zeros(num_microbits, dtype=np.int64)
+
+
+    def fill(self, devices, times, mags, starts, lengths, restart):
+        ''' Return (ids, columns, values) of the new columns of each microbit
+        in <devices>, from the column after the last it filled up to its
+        newest sample, see StagedResampler.add, and move filled on. '''
+        period_ns = self.period_ns
+        newest = times[starts + lengths - 1]
+        # the first column at or after the first sample of a microbit which restarts
+        first = np.where(restart, -(-times[starts] // period_ns), self.filled[devices])
+        filled = np.maximum(newest // period_ns + 1, first)
+        self.filled[devices] = filled
+        num_columns = filled - first
+        total = int(num_columns.sum())
+        stretches = np.repeat(np.arange(len(devices)), num_columns)
+        columns = np.repeat(first, num_columns) + np.arange(total) - np.repeat(
+            np.cumsum(num_columns) - num_columns, num_columns)
+        values = interpolate(columns * period_ns, stretches, times, mags, starts, lengths
+            ) if total else np.zeros(0)
+        return devices[stretches], columns, values
+
+
+    def reset(self):
+        ''' Forget every sample, e.g. after a seek. '''
+        super().reset()
+        self.end = 0
+        self.sequence += 1
+
+
+    def state(self):
+        ''' Return the arrays of the state of every microbit, for grow. '''
+        return super().state() + [self.matrix, self.filled]
+
+
+    def window(self, num_columns=None):
+        ''' Return (times in ns, matrix), a copy of up to the last <num_columns>
+        aligned columns, as a devices x time matrix oldest first, NaN where a
+        microbit has no samples around a column. '''
+        with self.lock:
+            active = self.last_time >= 0
+            if not active.any():
+                return np.zeros(0, dtype=np.int64), self.matrix[:, :0].copy()
+            active &= self.last_time >= self.last_time.max() - self.max_lag_ns
+            end = int(self.filled[active].min())
+            start = max(end - (num_columns or self.window_size), self.end - self.window_size)
+            columns = np.arange(start, max(end, start))
+            return columns * self.period_ns, self.matrix[:, columns % self.window_size]
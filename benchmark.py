@@ -0,0 +1,340 @@
+''' Benchmarks for the microbit juggling data pipeline.
+micro: unpack_scan, calc_mag, update_df_dict, create_dispatcher_data and
+    snapshot, timed call by call, and ScanFramer.feed on version 1 reads and
+    protocol version 2 decode_frames, per sample.
+macro: ReadMicrobits polling FakeMicrobits through a pty.
+render: MicrobitJuggle.update drawing 3 to 64 curves offscreen, with a new
+    sample for every microbit each frame so every curve is redrawn, and
+    RENDER_WINDOW_CURVES curves of RENDER_WINDOW samples each. The history
+    benchmarks draw the curves from the History, following the newest
+    samples and then zoomed out to the whole of HISTORY_SAMPLES.
+scaling: ReadMicrobits.process_data per sample for 3 to 64 microbits, taking
+    protocol version 2 frames from every microbit in turn, which should not
+    grow with the number of microbits.
+receivers: MultiReceiver reading 12 microbits through 1 to 4 simulated
+    receivers on their own radio groups, whose total rate should grow with
+    the number of receivers.
+startup: importing the acquisition modules in a fresh interpreter, and the
+    time from starting headless.py --fake to its first stored sample.
+Each result is written as a JSON line with samples_per_sec, p50_us, p99_us
+and peak_rss_kb so that runs can be compared.
+
+python benchmark.py -s micro,macro,render,scaling,receivers,startup -o bench_output.txt '''
+
+import json
+import logging
+from optparse import OptionParser
+import os
+import resource
+import subprocess
+import sys
+import threading
+from time import monotonic_ns, perf_counter_ns, sleep
+
+import numpy as np
+
+MACRO_DURATION = 5.0
+MICRO_REPEATS = 20000
+RENDER_CURVES = [3, 8, 16, 32, 64]
+RENDER_FRAMES = 300
+RENDER_WINDOW = 10000
+# time between the samples of each microbit in the render benchmarks
+RENDER_PERIOD_NS = 10000000
+RENDER_WINDOW_CURVES = [16, 64]
+# samples of each microbit in the history benchmarks, an hour at 100 a second
+HISTORY_SAMPLES = 360000
+RECEIVERS = [1, 2, 4]
+RECEIVER_MICROBITS = 12
+SCALING_MICROBITS = [3, 16, 32, 64]
+SCAN = 'ST,1,1234,-240,336,240,EN'
+STARTUP_MODULES = ['read_microbits', 'microbit_stream', 'headless']
+STARTUP_REPEATS = 5
+SUITES = ['micro', 'macro', 'render', 'scaling', 'receivers', 'startup']
+
+
+def peak_rss_kb():
+    ''' Return the peak resident set size of this process in kB. '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def summarise(name, durations_ns, samples=None, elapsed_s=None, **extra):
+    ''' Return a result dict from a list of per sample durations in ns. '''
+    durations = np.asarray(durations_ns, dtype=np.float64)
+    if samples is None:
+        samples = len(durations)
+    if elapsed_s is None:
+        elapsed_s = durations.sum() / 1e9
+    result = {
+        'name': name,
+        'samples': int(samples),
+        'samples_per_sec': samples / elapsed_s if elapsed_s else 0.0,
+        'p50_us': float(np.percentile(durations, 50)) / 1e3 if len(durations) else None,
+        'p99_us': float(np.percentile(durations, 99)) / 1e3 if len(durations) else None,
+        'peak_rss_kb': peak_rss_kb(),
+    }
+    result.update(extra)
+    return result
+
+
+def time_calls(function, args_list):
+    ''' Call function once for each args tuple, return the durations in ns. '''
+    durations = np.empty(len(args_list), dtype=np.int64)
+    for i, args in enumerate(args_list):
+        start = perf_counter_ns()
+        function(*args)
+        durations[i] = perf_counter_ns() - start
+    return durations
+
+
+def filled_reader(num_microbits, num_samples, history_samples=0):
+    ''' Return a ReadMicrobits, not polling, with num_samples in each ring buffer
+    and history_samples in its history, RENDER_PERIOD_NS apart. The ring
+    buffers are made larger than MAX_ROWS to hold them if needed, as
+    main.py does for --samples. '''
+    from read_microbits import MAX_ROWS, ReadMicrobits
+    reader = ReadMicrobits(num_microbits, run_main=False,
+        ring_rows=max(num_samples, MAX_ROWS))
+    rng = np.random.default_rng(0)
+    for ident, ring in enumerate(reader.df_dict.values()):
+        for count in range(num_samples):
+            x_acc, y_acc, z_acc = (int(a) for a in rng.integers(-2000, 2000, 3))
+            ring.append((count * RENDER_PERIOD_NS, ident, count, x_acc, y_acc, z_acc,
+                reader.calc_mag(x_acc, y_acc, z_acc)))
+    for ident in range(num_microbits):
+        reader.history.extend(np.arange(history_samples) * RENDER_PERIOD_NS,
+            np.full(history_samples, ident), rng.integers(0, 3000, history_samples))
+    return reader
+
+
+def micro_benchmarks(repeats=MICRO_REPEATS):
+    ''' Time the per scan parse and store functions of ReadMicrobits. '''
+    reader = filled_reader(3, 0)
+    now_ns = monotonic_ns()
+    scans = ['ST,1,{},-240,336,240,EN'.format(i) for i in range(repeats)]
+    rows = [reader.create_scan_row(scan, now_ns) for scan in scans]
+    ring = reader.df_dict['mb_1']
+    for row in rows[:ring.capacity]:
+        reader.update_df_dict(row, ring)
+    results = [
+        framer_benchmark(repeats),
+        summarise('micro.unpack_scan',
+            time_calls(reader.unpack_scan, [(SCAN,)] * repeats)),
+        summarise('micro.calc_mag',
+            time_calls(reader.calc_mag, [(-240, 336, 240)] * repeats)),
+        summarise('micro.update_df_dict',
+            time_calls(reader.update_df_dict, [(row, ring) for row in rows])),
+        summarise('micro.create_dispatcher_data',
+            time_calls(reader.create_dispatcher_data, [()] * (repeats // 10))),
+        summarise('micro.snapshot',
+            time_calls(reader.snapshot, [()] * (repeats // 10))),
+        decode_benchmark(repeats),
+    ]
+    return results
+
+
+def framer_benchmark(repeats=MICRO_REPEATS, scans_per_read=16):
+    ''' Time ScanFramer.feed on version 1 reads of <scans_per_read> scans,
+    the last split with the next read, as process_data parses them. '''
+    from scan_framer import ScanFramer
+    framer = ScanFramer()
+    stream = ''.join('ST,{},{},-240,336,240,EN'.format(i % 3, i)
+        for i in range(repeats)).encode()
+    read_size = len(stream) // (repeats // scans_per_read)
+    reads = [(stream[start:start + read_size],)
+        for start in range(0, len(stream), read_size)]
+    durations = time_calls(framer.feed, reads)
+    return summarise('micro.scan_framer_feed', durations / scans_per_read,
+        samples=repeats, elapsed_s=durations.sum() / 1e9)
+
+
+def decode_benchmark(repeats=MICRO_REPEATS, frames_per_read=64):
+    ''' Time decode_frames on reads holding <frames_per_read> full batches. '''
+    from protocol import MAX_BATCH, decode_frames, encode_frame
+    read_bytes = b''.join(encode_frame(i % 3, i, i * MAX_BATCH,
+        [(-240, 336, 240)] * MAX_BATCH) for i in range(frames_per_read))
+    reads = repeats // (frames_per_read * MAX_BATCH)
+    durations = time_calls(decode_frames, [(read_bytes,)] * reads)
+    samples = reads * frames_per_read * MAX_BATCH
+    return summarise('micro.decode_frames', durations / (frames_per_read * MAX_BATCH),
+        samples=samples, elapsed_s=durations.sum() / 1e9)
+
+
+def scaling_benchmark(num_microbits, repeats=MICRO_REPEATS):
+    ''' Time process_data per sample with frames from <num_microbits> in turn. '''
+    from protocol import MAX_BATCH, encode_frame
+    reader = filled_reader(num_microbits, 0)
+    rounds = max(repeats // (num_microbits * MAX_BATCH), 1)
+    # one read per round, holding a frame from each microbit like a TDMA frame
+    reads = [(b''.join(encode_frame(ident, i, i * MAX_BATCH,
+        [(-240, 336, 240)] * MAX_BATCH) for ident in range(num_microbits)),
+        monotonic_ns()) for i in range(rounds)]
+    durations = time_calls(reader.process_data, reads)
+    samples_per_read = num_microbits * MAX_BATCH
+    stored = sum(tracker.received for tracker in reader.trackers.values())
+    return summarise('scaling.process_data.{}mb'.format(num_microbits),
+        durations / samples_per_read, samples=rounds * samples_per_read,
+        elapsed_s=durations.sum() / 1e9, stored=stored)
+
+
+def macro_benchmark(num_microbits=3, duration=MACRO_DURATION, protocol=1, **fake_options):
+    ''' Run ReadMicrobits against FakeMicrobits, started with <fake_options>,
+    for <duration> seconds, as the library API runs it. '''
+    from read_microbits import ReadMicrobits
+    reader = ReadMicrobits(num_microbits, run_main=False, dispatch=False, fake=True,
+        protocol=protocol, fake_options=fake_options)
+    thread = threading.Thread(target=reader.run, daemon=True)
+    thread.start()
+    sleep(duration)
+    # closed when run returns, its counters are kept
+    fake_microbits = reader.fake_microbits
+    reader.stop()
+    thread.join()
+    transmitted = sum(transmitter.count
+        for transmitter in fake_microbits.transmitters.values())
+    stored = sum(len(ring) for ring in reader.df_dict.values())
+    # samples covered by the counts received, for version 2 a poll returns several
+    covered = sum(ring.last_count + 1 for ring in reader.df_dict.values()
+        if ring.last_count is not None)
+    poll_reply = reader.metrics.histogram('poll_reply')
+    return summarise('macro.read_microbits.v{}.{}mb'.format(protocol, num_microbits),
+        [], samples=covered, elapsed_s=duration, p50_us=poll_reply.percentile(50) / 1e3,
+        p99_us=poll_reply.percentile(99) / 1e3, polls=fake_microbits.polls,
+        lost=fake_microbits.lost, transmitted=transmitted, stored=stored,
+        malformed=reader.framer.malformed)
+
+
+def receiver_benchmark(num_receivers, num_microbits=RECEIVER_MICROBITS,
+        duration=MACRO_DURATION, protocol=1):
+    ''' Run MultiReceiver with <num_receivers> simulated receivers for <duration> seconds. '''
+    from multi_receiver import MultiReceiver
+    reader = MultiReceiver(num_microbits, run_main=False, receivers=num_receivers,
+        groups=[11 + index for index in range(num_receivers)], fake=True,
+        protocol=protocol)
+    thread = threading.Thread(target=reader.run, daemon=True)
+    thread.start()
+    sleep(duration)
+    reader.stop()
+    thread.join()
+    # the worst poll to reply latency of any receiver
+    poll_replies = [worker.metrics.histogram('poll_reply') for worker in reader.workers]
+    received = sum(tracker.received for tracker in reader.trackers.values())
+    return summarise('receivers.multi_receiver.v{}.{}rx'.format(protocol, num_receivers),
+        [], samples=received, elapsed_s=duration, merged=reader.merged.merged,
+        late=reader.merged.late,
+        rtt_p50_us=max(hist.percentile(50) for hist in poll_replies) / 1e3,
+        rtt_p99_us=max(hist.percentile(99) for hist in poll_replies) / 1e3)
+
+
+def render_benchmark(num_curves, frames=RENDER_FRAMES, num_samples=None,
+        history_samples=0, zoom_out=False):
+    ''' Time MicrobitJuggle.update drawing <num_curves> curves offscreen, from
+    the ring buffers, or with <history_samples> from the History, <zoom_out>
+    showing all of it. '''
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    import main
+    import pyqtgraph as pg
+    if num_samples is None:
+        num_samples = main.NUM_SAMPLES
+    reader = filled_reader(num_curves, num_samples, history_samples)
+    if not history_samples:
+        # draw from the ring buffers, as for an acquisition process
+        reader.history = None
+    juggle = main.MicrobitJuggle(num_curves, reader=reader, num_samples=num_samples)
+    rings = list(reader.df_dict.values())
+    ids = np.arange(num_curves)
+    mags = np.full(num_curves, 1000)
+    durations = np.empty(frames, dtype=np.int64)
+    for frame in range(frames):
+        count = max(num_samples, history_samples) + frame
+        for ident, ring in enumerate(rings):
+            ring.append((count * RENDER_PERIOD_NS, ident, count, 0, 0, 1000, 1000))
+        if history_samples:
+            reader.history.extend(np.full(num_curves, count * RENDER_PERIOD_NS), ids, mags)
+        if zoom_out and not frame:
+            juggle.plots[0].setXRange(0, count * RENDER_PERIOD_NS / 1e9, padding=0)
+        start = perf_counter_ns()
+        juggle.update()
+        durations[frame] = perf_counter_ns() - start
+    juggle.win.close()
+    name = 'render.update.{}curves'.format(num_curves)
+    if num_samples != main.NUM_SAMPLES:
+        name += '.{}samples'.format(num_samples)
+    if history_samples:
+        name += '.history' + ('.all' if zoom_out else '')
+    return summarise(name, durations, frames_per_sec=frames / (durations.sum() / 1e9))
+
+
+def startup_benchmarks(repeats=STARTUP_REPEATS):
+    ''' Time cold imports and headless.py to its first sample, each in a new process. '''
+    here = os.path.dirname(os.path.abspath(__file__))
+    results = []
+    for module in STARTUP_MODULES:
+        code = ('from time import perf_counter_ns; start = perf_counter_ns(); '
+            'import {}; print(perf_counter_ns() - start)'.format(module))
+        durations = [int(subprocess.run([sys.executable, '-c', code], cwd=here,
+            capture_output=True, text=True, check=True).stdout.split()[-1])
+            for _ in range(repeats)]
+        results.append(summarise('startup.import.{}'.format(module), durations))
+    durations = []
+    for _ in range(repeats):
+        start = perf_counter_ns()
+        process = subprocess.Popen([sys.executable, 'headless.py', '--fake',
+            '--duration', '1'], cwd=here, stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE, text=True)
+        for line in process.stderr:
+            if line.startswith('cold start'):
+                durations.append(perf_counter_ns() - start)
+                break
+        process.stderr.close()
+        process.wait()
+    results.append(summarise('startup.headless.first_sample', durations))
+    return results
+
+
+def run(suites, out_file=None, duration=MACRO_DURATION):
+    ''' Run the benchmark <suites> and write the results. '''
+    results = []
+    if 'micro' in suites:
+        results.extend(micro_benchmarks())
+    if 'macro' in suites:
+        results.append(macro_benchmark(3, duration))
+        results.append(macro_benchmark(3, duration, loss=0.05, fragment=0.2))
+        results.append(macro_benchmark(3, duration, protocol=2))
+    if 'render' in suites:
+        try:
+            import pyqtgraph
+        except ImportError:
+            print('pyqtgraph not installed, skipping render benchmarks')
+        else:
+            results.extend(render_benchmark(n) for n in RENDER_CURVES)
+            results.extend(render_benchmark(n, num_samples=RENDER_WINDOW)
+                for n in RENDER_WINDOW_CURVES)
+            for zoom_out in (False, True):
+                results.extend(render_benchmark(n, history_samples=HISTORY_SAMPLES,
+                    zoom_out=zoom_out) for n in RENDER_WINDOW_CURVES)
+    if 'scaling' in suites:
+        results.extend(scaling_benchmark(n) for n in SCALING_MICROBITS)
+    if 'receivers' in suites:
+        results.extend(receiver_benchmark(n, duration=duration) for n in RECEIVERS)
+    if 'startup' in suites:
+        results.extend(startup_benchmarks())
+    lines = [json.dumps(result) for result in results]
+    if out_file:
+        with open(out_file, 'a') as out:
+            out.write('\n'.join(lines) + '\n')
+    for line in lines:
+        print(line)
+    return results
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option('-s', '--suites', default=','.join(SUITES),
+        help='comma separated benchmark suites: {}'.format(','.join(SUITES)))
+    parser.add_option('-o', '--out', default=None,
+        help='append JSON lines of results to this file')
+    parser.add_option('-d', '--duration', type='float', default=MACRO_DURATION,
+        help='seconds to run each macro benchmark')
+    (options, args) = parser.parse_args()
+    logging.disable(logging.INFO)
+    run(options.suites.split(','), options.out, options.duration)
@@ -0,0 +1,103 @@
+''' Estimates when each sample was taken on the host monotonic clock.
+With protocol version 2 a transmitter samples every SAMPLE_PERIOD_NS by its
+own clock and numbers the samples with its count, so the count is the device
+clock. A sample reaches the host some radio and serial latency after it was
+taken, the least latency being the case where the sample was sent at once.
+ClockEstimator fits host time = offset + period * count through the
+earliest arriving sample of each WINDOW_NS, the lower envelope of the
+arrival times, by least squares over the last NUM_WINDOWS windows. offset is
+the host-device clock offset plus the least latency, the same for every
+device on one receiver, and period / SAMPLE_PERIOD_NS - 1 is the drift of the
+device clock. All times are int64 ns from time.monotonic_ns. '''
+
+from collections import deque
+
+import numpy as np
+
+COUNT_MODULUS = 1 << 16
+# sample period of the radio_tx_2 firmware
+SAMPLE_PERIOD_NS = 5000000
+# the lower envelope is taken over windows of this many ns
+WINDOW_NS = 1000000000
+NUM_WINDOWS = 16
+
+
+class ClockEstimator():
+    def __init__(self, period_ns=SAMPLE_PERIOD_NS, modulus=COUNT_MODULUS,
+            window_ns=WINDOW_NS, num_windows=NUM_WINDOWS):
+        self.nominal_period = period_ns
+        self.period = float(period_ns)
+        self.modulus = modulus
+        self.window_ns = window_ns
+        # (count, host time) of the earliest arriving sample of each window
+        self.minima = deque(maxlen=num_windows)
+        self.window_start = None
+        self.window_min = None
+        # unwrapped count of the last sample and its count modulo modulus
+        self.count = None
+        self.raw_count = None
+        # host time of count 0
+        self.offset = None
+
+
+    def drift_ppm(self):
+        ''' Return how fast the device clock runs against the host, in ppm. '''
+        return (self.nominal_period / self.period - 1) * 1e6
+
+
+    def fit(self):
+        ''' Refit offset and period through the window minima. '''
+        points = list(self.minima)
+        if len(points) < 3:
+            return
+        counts = np.array([point[0] for point in points], dtype=np.float64)
+        times = np.array([point[1] for point in points], dtype=np.float64)
+        count_0, time_0 = counts[-1], times[-1]
+        period, _ = np.polyfit(counts - count_0, times - time_0, 1)
+        if period <= 0:
+            return
+        self.period = period
+        # keep the line on or below every minimum, the least latency
+        lowest = np.min(times - time_0 - period * (counts - count_0))
+        self.offset = time_0 + lowest - period * count_0
+
+
+    def sample_time(self, count):
+        ''' Return the estimated host time that unwrapped <count> was sampled. '''
+        return int(self.offset + self.period * count)
+
+
+    def unwrap(self, raw_count):
+        ''' Return <raw_count> continued past the wraps of the count. '''
+        if self.count is None:
+            return raw_count
+        step = (raw_count - self.raw_count) % self.modulus
+        if step > self.modulus // 2:
+            step -= self.modulus
+        return self.count + step
+
+
+    def update(self, raw_count, host_ns):
+        ''' Add a sample <raw_count> which arrived at <host_ns>.
+        Returns the estimated host time the sample was taken, never later
+        than it arrived. '''
+        count = self.unwrap(raw_count)
+        if self.count is None or count > self.count:
+            self.count = count
+            self.raw_count = raw_count
+        if self.offset is None:
+            self.offset = host_ns - self.period * count
+            self.window_start = host_ns
+            self.window_min = (count, host_ns)
+        latency = host_ns - self.sample_time(count)
+        if latency < 0:
+            # arrived sooner than any sample yet, move the line down to it
+            self.offset += latency
+        if host_ns - self.period * count < self.window_min[1] - self.period * self.window_min[0]:
+            self.window_min = (count, host_ns)
+        if host_ns - self.window_start >= self.window_ns:
+            self.minima.append(self.window_min)
+            self.fit()
+            self.window_start = host_ns
+            self.window_min = (count, host_ns)
+        return min(self.sample_time(count), host_ns)
@@ -0,0 +1,192 @@
+''' Keeps the serial port of the receiver microbit open when it is unplugged.
+ConnectionManager is a SerialPort which treats a read or write error as the
+receiver being unplugged. It closes the port and reopens it from a
+background thread, waiting BACKOFF_MIN after the first failed attempt and
+doubling the wait up to BACKOFF_MAX, so a receiver plugged back in is found
+within BACKOFF_MAX of appearing. Meanwhile the polling loop waits in
+wait_connected and the display keeps drawing the scans it already has.
+The pyserial port object is reopened in place, so the references the loops
+hold stay valid.
+The path that was opened, its /dev/serial/by-id link and the pid, vid and
+serial number of the device behind it are cached when the port is opened.
+A reconnect tries the cached paths first, without scanning the ports, and
+only scans for the serial number, then any microbit, if they have gone.
+Metrics, if given:
+reconnect    histogram of the ns from the error to the port being open again
+downtime     histogram of the ns from the last bytes read to the port being open again
+disconnects and reconnects counters '''
+
+import logging
+import os
+import serial.tools.list_ports as list_ports
+from serial_port import BAUD, PID_MICROBIT, TIMEOUT, VID_MICROBIT, SerialPort
+import threading
+from time import monotonic_ns
+
+# bounds on the wait between attempts to reopen the port in seconds
+BACKOFF_MIN = 0.02
+BACKOFF_MAX = 0.5
+# udev links which keep their names when a device is plugged in again
+BY_ID_DIR = '/dev/serial/by-id'
+
+
+class ConnectionManager(SerialPort):
+    def __init__(self, pid=PID_MICROBIT, vid=VID_MICROBIT, baud=BAUD, timeout=TIMEOUT,
+            port=None, metrics=None, backoff_min=BACKOFF_MIN, backoff_max=BACKOFF_MAX):
+        self.pid = pid
+        self.vid = vid
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        # the device the port was last opened on
+        self.path = None
+        self.stable_path = None
+        self.serial_number = None
+        # set while the port is open
+        self.connected = threading.Event()
+        self.closing = threading.Event()
+        self.thread = None
+        self.lost_ns = None
+        self.last_read_ns = monotonic_ns()
+        self.disconnects = 0
+        self.reconnects = 0
+        super().__init__(pid, vid, baud, timeout, port, metrics)
+        if self.serial_port:
+            self.remember(self.serial_port.port)
+            self.connected.set()
+
+
+    def candidate_paths(self):
+        ''' Return the paths to try to reopen, the cached ones if they exist. '''
+        paths = [path for path in (self.path, self.stable_path)
+            if path and os.path.exists(path)]
+        if paths:
+            return paths
+        # plugged back in under another name, look for the same microbit first
+        ports = [p for p in list_ports.comports() if p.pid == self.pid and p.vid == self.vid]
+        ports.sort(key=lambda p: p.serial_number != self.serial_number)
+        return [str(p.device) for p in ports]
+
+
+    def close(self):
+        ''' Stop reconnecting and close the port. '''
+        self.closing.set()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.connected.clear()
+        if self.serial_port:
+            self.serial_port.close()
+
+
+    def find_stable_path(self, device):
+        ''' Return the /dev/serial/by-id link to <device>, or None. '''
+        try:
+            names = os.listdir(BY_ID_DIR)
+        except OSError:
+            return None
+        for name in names:
+            link = os.path.join(BY_ID_DIR, name)
+            if os.path.realpath(link) == device:
+                return link
+
+
+    def get_serial_data(self, serial_port):
+        ''' As SerialPort.get_serial_data, treating an error as a disconnect. '''
+        if not self.connected.is_set():
+            return
+        try:
+            read_bytes = super().get_serial_data(serial_port)
+        except OSError as e:
+            self.lost(e)
+            return
+        if read_bytes:
+            self.last_read_ns = monotonic_ns()
+        return read_bytes
+
+
+    def is_connected(self):
+        ''' Return True while the port is open. '''
+        return self.connected.is_set()
+
+
+    def lost(self, error):
+        ''' Close the port after <error> and reopen it in the background.
+        Called from the thread reading the port, which then waits in
+        wait_connected, so only the reconnect thread uses the port. '''
+        if not self.connected.is_set() or self.closing.is_set():
+            return
+        self.connected.clear()
+        self.lost_ns = monotonic_ns()
+        self.disconnects += 1
+        if self.metrics:
+            self.metrics.count('disconnects')
+        logging.info('*** serial port {} lost: {}, reconnecting'.format(self.path, error))
+        try:
+            self.serial_port.close()
+        except OSError:
+            pass
+        self.thread = threading.Thread(target=self.reconnect, daemon=True)
+        self.thread.start()
+
+
+    def reconnect(self):
+        ''' Try to reopen the port, backing off, until it opens or close is called. '''
+        backoff = self.backoff_min
+        while not self.closing.is_set():
+            if self.reopen():
+                now = monotonic_ns()
+                self.reconnects += 1
+                if self.metrics:
+                    self.metrics.record('reconnect', now - self.lost_ns)
+                    self.metrics.record('downtime', now - self.last_read_ns)
+                    self.metrics.count('reconnects')
+                logging.info('*** serial port {} reconnected after {:0.0f} ms'.format(
+                    self.path, (now - self.lost_ns) / 1e6))
+                self.connected.set()
+                return
+            self.closing.wait(backoff)
+            backoff = min(2 * backoff, self.backoff_max)
+
+
+    def remember(self, path):
+        ''' Cache <path> and the pid, vid, serial number and by-id link of its device. '''
+        self.path = path
+        device = os.path.realpath(path)
+        for p in list_ports.comports():
+            if os.path.realpath(p.device) == device:
+                self.pid, self.vid, self.serial_number = p.pid, p.vid, p.serial_number
+        self.stable_path = self.find_stable_path(device)
+
+
+    def reopen(self):
+        ''' Open the port on the first candidate path that works.
+        Returns True if the port is open. '''
+        serial_port = self.serial_port
+        for path in self.candidate_paths():
+            serial_port.port = path
+            try:
+                serial_port.open()
+                serial_port.reset_input_buffer()
+            except OSError:
+                continue
+            if path not in (self.path, self.stable_path):
+                self.remember(path)
+            return True
+        return False
+
+
+    def wait_connected(self, timeout):
+        ''' Wait up to <timeout> seconds for the port to be open.
+        Returns True if it is. '''
+        return self.connected.wait(timeout)
+
+
+    def wait_serial_data(self, serial_port, timeout):
+        ''' As SerialPort.wait_serial_data, treating an error as a disconnect
+        and waiting out the timeout while disconnected. '''
+        if not self.connected.is_set():
+            self.connected.wait(timeout)
+            return
+        try:
+            return super().wait_serial_data(serial_port, timeout)
+        except OSError as e:
+            self.lost(e)
@@ -0,0 +1,397 @@
+''' Simulates the receiver microbit and the transmitter microbits on a pty.
+Opens a Linux pseudo terminal which SerialPort can open like the USB serial
+port of the receiver microbit.
+Polls of the form mb_N\\n are answered like radio_rx_2/main.cpp relaying
+radio_tx_2/main.cpp: ST,id,count,x_acc,y_acc,z_acc,EN with no line ending.
+Each transmitter increments its count for every reply it sends.
+Polls of the form mb_N:2\\n are answered with a protocol version 2 frame
+holding the samples taken at sample_rate since the last poll, up to MAX_BATCH.
+ss_N:slot,num_slots,slot_ms\n sets up streaming for transmitter N, sync\n
+starts the time slots for all of them and stop\n ends streaming. While
+streaming, each transmitter sends a version 2 frame in its slot of every
+num_slots * slot_ms frame, unpolled.
+With receivers > 1 there is a pty for each receiver microbit, in ports, all
+sharing the transmitters like receivers in the same room. Radio groups are
+simulated: group:G\n sets the group of the receiver it is written to,
+rg_N:G\n is relayed to transmitter N, which moves to group G. A receiver
+only reaches the transmitters in its group, and a reply reaches every
+receiver in the transmitter's group. sync\n and stop\n act on the
+transmitters in the group of the receiver they are written to.
+ports are symlinks to the ptys, like the /dev/serial/by-id links to USB
+serial ports, so unplug and replug can simulate pulling out the USB cable
+of a receiver and plugging it back in: replug opens a new pty, resets the
+receiver to DEFAULT_GROUP and points the same link at it.
+Reply latency, jitter, packet loss and fragmentation of the replies into
+several serial writes can be set.
+Accelerometer values follow a synthetic juggling waveform: about 1g with a
+spike at the throw while the ball is in the hand, near 0g in free fall.
+
+Run as a script to leave a simulator running for another process:
+python fake_microbits.py -n 3 -r 1 '''
+
+import heapq
+import logging
+import math
+from optparse import OptionParser
+import os
+from protocol import DEFAULT_GROUP, MAX_BATCH, POLL_V2_SUFFIX, encode_frame
+import pty
+import random
+import select
+import shutil
+import sys
+import tempfile
+import threading
+import tty
+from time import monotonic, sleep
+
+# accelerometer units are milli-g
+ONE_G = 1024
+# the microbit accelerometer saturates at +-2g by default
+MAX_ACC = 2047
+LATENCY = 0.004
+JITTER = 0.001
+LOSS = 0.0
+FRAGMENT = 0.0
+# juggling cycle for each ball in seconds and the fraction spent in the hand
+CYCLE_TIME = 1.2
+DWELL = 0.3
+NOISE = 20
+# rate at which transmitters sample for protocol version 2
+SAMPLE_RATE = 200
+
+logging.basicConfig(level=logging.DEBUG, format='%(message)s')
+
+
+def juggle_acc(t, phase=0.0, cycle_time=CYCLE_TIME, dwell=DWELL, noise=NOISE, rng=random):
+    ''' Return synthetic x, y, z acceleration in milli-g at time <t> seconds. '''
+    position = ((t / cycle_time) + phase) % 1.0
+    if position < dwell:
+        # in the hand, carried with a throw spike at the end of the dwell
+        carry = position / dwell
+        mag = ONE_G + 1.5 * ONE_G * math.exp(-((carry - 0.85) ** 2) / 0.01)
+    else:
+        # free fall, the accelerometer reads close to 0
+        mag = 0.05 * ONE_G
+    # the ball spins in flight so the direction of the reading rotates
+    angle = 2 * math.pi * (position + phase)
+    x_acc = mag * 0.6 * math.cos(angle) + rng.gauss(0, noise)
+    y_acc = mag * 0.6 * math.sin(angle) + rng.gauss(0, noise)
+    z_acc = mag * 0.53 + rng.gauss(0, noise)
+    return tuple(int(max(-MAX_ACC, min(MAX_ACC, a))) for a in (x_acc, y_acc, z_acc))
+
+
+class FakeTransmitter():
+    ''' One transmitter microbit, as radio_tx_2/main.cpp. '''
+    def __init__(self, ident, phase=0.0, rng=random, sample_rate=SAMPLE_RATE):
+        self.ident = ident
+        self.count = 0
+        self.phase = phase
+        self.rng = rng
+        self.sample_rate = sample_rate
+        self.start_time = monotonic()
+        self.last_sample_time = self.start_time
+        self.seq = 0
+        self.group = DEFAULT_GROUP
+
+
+    def transmit_batch(self):
+        ''' Return a version 2 frame of the samples taken since the last poll.
+        Like the firmware, only the last MAX_BATCH samples are kept. '''
+        new_samples = int((monotonic() - self.last_sample_time) * self.sample_rate)
+        new_samples = max(new_samples, 1)
+        # the sample clock keeps to sample_rate, so the count tracks the time
+        self.last_sample_time += new_samples / self.sample_rate
+        self.count += new_samples
+        batch = min(new_samples, MAX_BATCH)
+        first_count = self.count - batch
+        samples = [juggle_acc(self.last_sample_time - self.start_time
+            - (batch - 1 - i) / self.sample_rate, self.phase, rng=self.rng)
+            for i in range(batch)]
+        frame = encode_frame(self.ident, self.seq, first_count, samples)
+        self.seq += 1
+        return frame
+
+
+    def transmit_sensors(self):
+        ''' Return the scan the transmitter sends over the radio. '''
+        x_acc, y_acc, z_acc = juggle_acc(monotonic() - self.start_time,
+            self.phase, rng=self.rng)
+        scan = 'ST,{},{},{},{},{},EN'.format(self.ident, self.count,
+            x_acc, y_acc, z_acc)
+        self.count += 1
+        return scan.encode()
+
+
+class FakeMicrobits():
+    def __init__(self, num_microbits=3, latency=LATENCY, jitter=JITTER,
+            loss=LOSS, fragment=FRAGMENT, seed=None, receivers=1):
+        self.rng = random.Random(seed)
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.fragment = fragment
+        self.transmitters = {'mb_{}'.format(i): FakeTransmitter(i,
+            phase=i / max(num_microbits, 1), rng=self.rng)
+            for i in range(num_microbits)}
+        # a pty, a link to it and a radio group for each receiver microbit
+        self.link_dir = tempfile.mkdtemp(prefix='fake_microbits_')
+        self.masters = [None] * receivers
+        self.slaves = [None] * receivers
+        self.ports = [os.path.join(self.link_dir, 'microbit_{}'.format(receiver))
+            for receiver in range(receivers)]
+        self.groups = [DEFAULT_GROUP] * receivers
+        for receiver in range(receivers):
+            self.open_pty(receiver)
+        self.port = self.ports[0]
+        # {master: partial line} read from the host
+        self.lines = {}
+        # (unplug or replug, receiver) for the run thread to carry out
+        self.plug_requests = []
+        # heap of (due time, sequence, master, bytes) waiting to be written
+        self.pending = []
+        self.sequence = 0
+        self.polls = 0
+        self.lost = 0
+        # {transmitter: (slot, num_slots, slot_ms)} set up for streaming
+        self.slots = {}
+        # {transmitter: [next send time, frame period]} while streaming
+        self.streams = {}
+        self.running = False
+        self.thread = None
+
+
+    def close(self):
+        ''' Stop the simulator and close the ptys. '''
+        self.stop()
+        for receiver in range(len(self.masters)):
+            self.close_pty(receiver)
+        shutil.rmtree(self.link_dir, ignore_errors=True)
+
+
+    def close_pty(self, receiver):
+        ''' Close the pty of <receiver> and drop the bytes waiting to be written to it. '''
+        master = self.masters[receiver]
+        if master is None:
+            return
+        for fd in (master, self.slaves[receiver]):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self.masters[receiver] = None
+        self.slaves[receiver] = None
+        self.lines.pop(master, None)
+        self.pending = [item for item in self.pending if item[2] != master]
+        heapq.heapify(self.pending)
+
+
+    def handle_line(self, line, receiver=0):
+        ''' React to a line written by the host to <receiver>, like onSerial in radio_rx_2. '''
+        poll = line.decode(errors='replace')
+        if self.handle_stream_command(poll, receiver):
+            return
+        if self.handle_group_command(poll, receiver):
+            return
+        version_2 = poll.endswith(POLL_V2_SUFFIX)
+        if version_2:
+            poll = poll[:-len(POLL_V2_SUFFIX)]
+        transmitter = self.transmitters.get(poll)
+        if not transmitter or transmitter.group != self.groups[receiver]:
+            return
+        self.polls += 1
+        if version_2:
+            scan = transmitter.transmit_batch()
+        else:
+            scan = transmitter.transmit_sensors()
+        self.send(scan, transmitter.group)
+
+
+    def handle_group_command(self, command, receiver=0):
+        ''' Move <receiver> or a transmitter in its group to another radio group.
+        Returns False if <command> is not a group command. '''
+        try:
+            if command.startswith('group:'):
+                self.groups[receiver] = int(command[len('group:'):])
+            elif command.startswith('rg_'):
+                ident, group = command[len('rg_'):].split(':')
+                transmitter = self.transmitters.get('mb_{}'.format(ident))
+                if transmitter and transmitter.group == self.groups[receiver]:
+                    transmitter.group = int(group)
+            else:
+                return False
+        except ValueError:
+            pass
+        return True
+
+
+    def handle_stream_command(self, command, receiver=0):
+        ''' Set up, start or stop streaming for the transmitters in the group
+        of <receiver>. Returns False if <command> is not a streaming command. '''
+        group = self.groups[receiver]
+        if command.startswith('ss_'):
+            try:
+                ident, settings = command[len('ss_'):].split(':')
+                slot, num_slots, slot_ms = (int(a) for a in settings.split(','))
+            except ValueError:
+                return True
+            transmitter = self.transmitters.get('mb_{}'.format(ident))
+            if transmitter and transmitter.group == group:
+                self.slots[transmitter] = (slot, num_slots, slot_ms)
+        elif command == 'sync':
+            now = monotonic()
+            for transmitter, (slot, num_slots, slot_ms) in self.slots.items():
+                if transmitter.group == group:
+                    self.streams[transmitter] = [now + slot * slot_ms / 1000,
+                        num_slots * slot_ms / 1000]
+        elif command == 'stop':
+            self.streams = {transmitter: stream for transmitter, stream
+                in self.streams.items() if transmitter.group != group}
+        else:
+            return False
+        return True
+
+
+    def open_pty(self, receiver):
+        ''' Open a pty for <receiver> and point its link in ports at it. '''
+        master, slave = pty.openpty()
+        # raw mode, no echo or line ending translation
+        tty.setraw(slave)
+        tty.setraw(master)
+        self.masters[receiver] = master
+        self.slaves[receiver] = slave
+        link = self.ports[receiver]
+        os.symlink(os.ttyname(slave), link + '.new')
+        os.replace(link + '.new', link)
+
+
+    def plug(self):
+        ''' Carry out the unplug and replug requests, in the run thread so
+        that a pty is not closed while it is being read. '''
+        while self.plug_requests:
+            action, receiver = self.plug_requests.pop(0)
+            self.close_pty(receiver)
+            if action == 'replug':
+                self.groups[receiver] = DEFAULT_GROUP
+                self.open_pty(receiver)
+
+
+    def replug(self, receiver=0):
+        ''' Plug <receiver> back in on a new pty, reached through the same link. '''
+        self.plug_requests.append(('replug', receiver))
+
+
+    def unplug(self, receiver=0):
+        ''' Pull out the USB cable of <receiver>, closing its pty. '''
+        self.plug_requests.append(('unplug', receiver))
+
+
+    def send(self, scan, group=DEFAULT_GROUP):
+        ''' Send <scan> over the radio in <group> and relay it to the serial
+        port of each receiver in that group. '''
+        for master, receiver_group in zip(self.masters, self.groups):
+            if master is None or receiver_group != group:
+                continue
+            if self.rng.random() < self.loss:
+                # the radio packet was lost after the transmitter sent it
+                self.lost += 1
+                continue
+            delay = max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter))
+            self.schedule(monotonic() + delay, scan, master)
+
+
+    def send_streams(self, now):
+        ''' Send a frame from each streaming transmitter whose slot is due.
+        Returns the time the next slot is due, or None. '''
+        next_due = None
+        for transmitter, stream in self.streams.items():
+            if stream[0] <= now:
+                self.send(transmitter.transmit_batch(), transmitter.group)
+                stream[0] += stream[1]
+            if next_due is None or stream[0] < next_due:
+                next_due = stream[0]
+        return next_due
+
+
+    def run(self):
+        ''' Read commands from the host and write replies when they are due. '''
+        while self.running:
+            self.plug()
+            now = monotonic()
+            while self.pending and self.pending[0][0] <= now:
+                _, _, master, data = heapq.heappop(self.pending)
+                os.write(master, data)
+            next_due = self.send_streams(now)
+            timeout = 0.05
+            if self.pending:
+                timeout = max(0.0, self.pending[0][0] - now)
+            if next_due is not None:
+                timeout = max(0.0, min(timeout, next_due - now))
+            masters = [master for master in self.masters if master is not None]
+            ready, _, _ = select.select(masters, [], [], timeout)
+            for master in ready:
+                try:
+                    read_bytes = os.read(master, 1024)
+                except OSError:
+                    # the host closed the port
+                    continue
+                line = self.lines.setdefault(master, bytearray())
+                for byte in read_bytes:
+                    if byte == ord('\n'):
+                        self.handle_line(bytes(line), self.masters.index(master))
+                        line.clear()
+                    else:
+                        line.append(byte)
+
+
+    def schedule(self, due_time, scan, master=None):
+        ''' Queue <scan> to be written to <master> at <due_time>, split into fragments. '''
+        if master is None:
+            master = self.masters[0]
+        fragments = [scan]
+        if self.rng.random() < self.fragment:
+            split = self.rng.randint(1, len(scan) - 1)
+            fragments = [scan[:split], scan[split:]]
+        for i, data in enumerate(fragments):
+            self.sequence += 1
+            heapq.heappush(self.pending, (due_time + i * 0.001, self.sequence,
+                master, data))
+
+
+    def start(self):
+        ''' Start answering polls in a background thread. Returns the port
+        of the first receiver, the others are in ports. '''
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        logging.info('fake microbits on port: {}'.format(', '.join(self.ports)))
+        return self.port
+
+
+    def stop(self):
+        ''' Stop answering polls. '''
+        self.running = False
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option('-n', '--num_microbits', type='int', default=3)
+    parser.add_option('-l', '--latency', type='float', default=LATENCY)
+    parser.add_option('-j', '--jitter', type='float', default=JITTER)
+    parser.add_option('-p', '--loss', type='float', default=LOSS)
+    parser.add_option('-s', '--fragment', type='float', default=FRAGMENT)
+    parser.add_option('-r', '--receivers', type='int', default=1)
+    (options, args) = parser.parse_args()
+    fake_microbits = FakeMicrobits(options.num_microbits, options.latency,
+        options.jitter, options.loss, options.fragment, receivers=options.receivers)
+    fake_microbits.start()
+    print(' '.join(fake_microbits.ports))
+    try:
+        while True:
+            sleep(1)
+    except KeyboardInterrupt:
+        fake_microbits.close()
+        sys.exit(0)
@@ -0,0 +1,105 @@
+''' Headless acquisition for the microbit_juggling project.
+Polls or streams the microbits like main.py, optionally records them with
+--out, and prints a line of live metrics every --status seconds, without
+importing pyqtgraph, Qt or pandas. Takes the same options as
+read_microbits.py plus:
+--duration S  stop after S seconds, 0 runs until interrupted
+--status S    seconds between status lines
+
+The cold start time is reported once the first sample is stored: how long
+the imports took and how long until the first sample, both timed from when
+this module started to load. Interpreter startup comes before that, time
+the whole with: time python headless.py --fake --duration 0.1
+
+python headless.py --fake --protocol 2 --out recordings '''
+
+from time import perf_counter
+START = perf_counter()
+
+import logging
+from read_microbits import ReadMicrobits
+import sys
+import threading
+from time import monotonic
+
+IMPORTED = perf_counter()
+NUM_MICROBITS = 3
+STATUS_INTERVAL = 1.0
+
+
+class HeadlessReader(ReadMicrobits):
+    def __init__(self, num_microbits=NUM_MICROBITS, run_main=True, **settings):
+        self.first_sample_time = None
+        self.next_status = monotonic() + STATUS_INTERVAL
+        super().__init__(num_microbits, run_main=run_main, dispatch=False, **settings)
+
+
+    def create_option_parser(self):
+        ''' Add the headless options to those of ReadMicrobits. '''
+        parser = super().create_option_parser()
+        parser.add_option('--duration', type='float', default=0.0,
+                    help='Seconds to run for, 0 runs until interrupted')
+        parser.add_option('--status', type='float', default=STATUS_INTERVAL,
+                    help='Seconds between status lines')
+        return parser
+
+
+    def heartbeat(self):
+        ''' Print the status line when it is due. '''
+        now = monotonic()
+        if now < self.next_status:
+            return
+        interval = self.options.status if self.options else STATUS_INTERVAL
+        self.next_status = now + interval
+        print(self.status_line())
+
+
+    def report_cold_start(self):
+        ''' Log how long the imports and the first sample took. '''
+        self.first_sample_time = perf_counter()
+        logging.info('cold start: imports {:0.1f} ms first sample {:0.1f} ms'.format(
+            (IMPORTED - START) * 1e3, (self.first_sample_time - START) * 1e3))
+
+
+    def run(self):
+        ''' Run, stopping after --duration seconds if it was given. '''
+        if self.options and self.options.duration:
+            timer = threading.Timer(self.options.duration, self.stop)
+            timer.daemon = True
+            timer.start()
+        return super().run()
+
+
+    def status_line(self):
+        ''' Return the delivered rate and losses of each microbit and the
+        poll to reply latency on one line. '''
+        fields = []
+        for mb, counters in self.device_counters().items():
+            fields.append('{} {:0.0f}/s lost {} t/o {}'.format(mb,
+                self.trackers[mb].rate, counters['gap_lost'], counters['timed_out']))
+        for ident, (throws, airtime_ns, rate) in self.detector.device_stats().items():
+            fields.append('mb_{} throws {} {:0.0f}/min air {:0.0f} ms'.format(ident,
+                throws, rate, airtime_ns / 1e6))
+        poll_reply = self.metrics.histograms.get('poll_reply')
+        if poll_reply and poll_reply.count:
+            fields.append('rtt p50 {:0.1f} p99 {:0.1f} ms'.format(
+                poll_reply.percentile(50) / 1e6, poll_reply.percentile(99) / 1e6))
+        if self.recorder:
+            fields.append('recorded {} dropped {}'.format(self.recorder.recorded,
+                self.recorder.dropped))
+        return ' | '.join(fields)
+
+
+    def store_scan(self, scan, now_ns):
+        ''' Store <scan>, reporting the cold start time for the first one. '''
+        ident = super().store_scan(scan, now_ns)
+        if ident and self.first_sample_time is None:
+            self.report_cold_start()
+        return ident
+
+
+if __name__ == '__main__':
+    try:
+        HeadlessReader()
+    except KeyboardInterrupt:
+        sys.exit(0)
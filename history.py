@@ -0,0 +1,289 @@
+''' Keeps a long history of mag_acc for each microbit in bounded memory.
+The RingBuffers only hold the last MAX_ROWS scans. HistoryPyramid holds the
+last FULL_ROWS samples of a microbit at full rate in level 0, then levels
+of bins which each summarise FACTOR bins of the level below by their time,
+min, max and mean, so level n bins cover FACTOR ** n samples. Each level is
+a LevelRing of fixed size, so the memory used is fixed when the first
+sample of a microbit arrives, about
+FULL_ROWS * 12 + (NUM_LEVELS - 1) * LEVEL_ROWS * LEVEL_DTYPE.itemsize bytes,
+while the coarsest level reaches back FACTOR ** (NUM_LEVELS - 1) * LEVEL_ROWS
+samples, hours of juggling.
+Samples are added a batch at a time. Level 1 is worked out with numpy once
+BATCH_BINS of its bins are complete, from the newest samples in level 0, and
+each level above as the bins below it complete, so nothing is copied between
+batches and the cost per sample is flat. The samples not yet summarised by a
+level are summarised when a window of it is asked for, so the newest bin of
+every level is up to date.
+History holds a HistoryPyramid for each microbit by integer id, and window
+returns the finest level whose bins between two times fit in the number of
+points asked for, so a plot can draw an hour as quickly as a second. '''
+
+import threading
+
+import numpy as np
+
+FULL_ROWS = 8192
+LEVEL_ROWS = 2048
+# bins of one level summarised by each bin of the next
+FACTOR = 8
+NUM_LEVELS = 5
+# level 1 bins worked out at once
+BATCH_BINS = 8
+# time of the first sample in the bin, min, max and mean mag_acc
+LEVEL_DTYPE = np.dtype([('time', 'i8'), ('min', 'i4'), ('max', 'i4'), ('mean', 'f4')])
+
+
+class LevelRing():
+    ''' Fixed size ring of bins in time order, held as a contiguous array for
+    each LEVEL_DTYPE field so the times can be searched without a copy.
+    With <num_fields> of 2 only the time and min are held, for single
+    samples, whose max and mean are the same. '''
+    def __init__(self, capacity, num_fields=len(LEVEL_DTYPE)):
+        self.capacity = capacity
+        self.stored = [np.zeros(capacity, dtype=LEVEL_DTYPE[field])
+            for field in range(num_fields)]
+        # the four fields, the max and mean of samples are their min
+        self.columns = self.stored + [self.stored[1]] * (len(LEVEL_DTYPE) - num_fields)
+        # next bin to write, always in the range [0, capacity)
+        self.index = 0
+        self.length = 0
+
+
+    def __len__(self):
+        return self.length
+
+
+    def bins(self, ranges):
+        ''' Return a LEVEL_DTYPE array of the bins in the index <ranges>. '''
+        bins = np.empty(sum(end - start for start, end in ranges), dtype=LEVEL_DTYPE)
+        for name, column in zip(LEVEL_DTYPE.names, self.columns):
+            bins[name] = np.concatenate([column[start:end] for start, end in ranges]
+                ) if ranges else column[:0]
+        return bins
+
+
+    def clear(self):
+        self.index = 0
+        self.length = 0
+
+
+    def covers(self, time_ns):
+        ''' Return True if no bin at or after <time_ns> has been dropped. '''
+        return self.length < self.capacity or self.stored[0][self.index] <= time_ns
+
+
+    def extend(self, *columns):
+        ''' Add the bins given column by column in LEVEL_DTYPE order, dropping
+        the oldest. Only the fields held are used. '''
+        num_bins = len(columns[0])
+        if num_bins > self.capacity:
+            columns = [column[-self.capacity:] for column in columns]
+            num_bins = self.capacity
+        start = self.index
+        # written in at most two slices, up to the end of the ring and from the start
+        first = min(num_bins, self.capacity - start)
+        for target, column in zip(self.stored, columns):
+            target[start:start + first] = column[:first]
+            target[:num_bins - first] = column[first:]
+        self.index = (start + num_bins) % self.capacity
+        self.length = min(self.length + num_bins, self.capacity)
+
+
+    def last_time(self):
+        ''' Return the time of the newest bin. The ring must not be empty. '''
+        return self.stored[0][self.index - 1]
+
+
+    def nbytes(self):
+        return sum(column.nbytes for column in self.stored)
+
+
+    def tail(self, num_bins, skip=0):
+        ''' Return the four columns of <num_bins> bins, oldest first, leaving
+        out the newest <skip>. '''
+        end = self.index - skip
+        start = end - num_bins
+        if start >= 0:
+            return [column[start:end] for column in self.columns]
+        if end <= 0:
+            return [column[start:end or None] for column in self.columns]
+        return [np.concatenate((column[start:], column[:end])) for column in self.columns]
+
+
+    def window(self, start_ns, end_ns):
+        ''' Return the (start, end) index ranges of the bins from <start_ns>
+        to <end_ns>, oldest first. '''
+        if self.length < self.capacity:
+            segments = [(0, self.length)]
+        else:
+            segments = [(self.index, self.capacity), (0, self.index)]
+        times = self.stored[0]
+        ranges = []
+        for low, high in segments:
+            segment = times[low:high]
+            end = low + int(np.searchsorted(segment, end_ns, side='right'))
+            low += int(np.searchsorted(segment, start_ns))
+            if end > low:
+                ranges.append((low, end))
+        return ranges
+
+
+class HistoryPyramid():
+    ''' The levels of history of one microbit, see the module docstring. '''
+    def __init__(self, full_rows=FULL_ROWS, level_rows=LEVEL_ROWS, factor=FACTOR,
+            num_levels=NUM_LEVELS):
+        self.factor = factor
+        self.levels = [LevelRing(full_rows, 2)] + [LevelRing(level_rows)
+            for _ in range(num_levels - 1)]
+        # most samples added at once, so that the bins completed at each level
+        # are still held in the level below
+        self.chunk = max(min(full_rows, level_rows) // 2, factor)
+        # changes whenever samples are added or cleared
+        self.sequence = 0
+        self.clear()
+
+
+    def add(self, times, mags):
+        ''' Add up to chunk samples and complete the bins they fill. '''
+        levels, totals, factor = self.levels, self.totals, self.factor
+        levels[0].extend(times, mags)
+        totals[0] += len(times)
+        if totals[0] // factor - totals[1] < BATCH_BINS:
+            return
+        for number in range(1, len(levels)):
+            num_bins = totals[number - 1] // factor - totals[number]
+            if not num_bins:
+                return
+            # the bins below have the same number of samples, so the mean of their means is exact
+            times, mins, maxs, means = (column.reshape(num_bins, factor)
+                for column in levels[number - 1].tail(num_bins * factor,
+                    totals[number - 1] % factor))
+            levels[number].extend(times[:, 0], mins.min(axis=1), maxs.max(axis=1),
+                means.mean(axis=1))
+            totals[number] += num_bins
+
+
+    def clear(self):
+        ''' Forget every sample. '''
+        for level in self.levels:
+            level.clear()
+        # the number of bins ever added to each level
+        self.totals = [0] * len(self.levels)
+        self.sequence += 1
+
+
+    def extend(self, times, mags):
+        ''' Add samples with int64 <times> in ns and <mags>, oldest first. '''
+        if not len(times):
+            return
+        self.sequence += 1
+        for start in range(0, len(times), self.chunk):
+            self.add(times[start:start + self.chunk], mags[start:start + self.chunk])
+
+
+    def newest_bin(self, number):
+        ''' Return a LEVEL_DTYPE array of the bin summarising the samples held
+        in level 0 which are not yet in level <number>, which may be empty. '''
+        level = self.levels[0]
+        num_samples = min(self.totals[0] - self.totals[number] * self.factor ** number,
+            len(level))
+        bins = np.empty(1 if num_samples else 0, dtype=LEVEL_DTYPE)
+        if num_samples:
+            times, mags, _, _ = level.tail(num_samples)
+            bins[0] = (times[0], mags.min(), mags.max(), mags.mean())
+        return bins
+
+
+    def window(self, start_ns, end_ns, max_bins):
+        ''' Return (level, bins) for the finest level holding every bin from
+        <start_ns> to <end_ns>, up to <max_bins> of them, or the coarsest level. '''
+        for number, level in enumerate(self.levels):
+            ranges = level.window(start_ns, end_ns)
+            if (sum(end - start for start, end in ranges) <= max_bins
+                    and level.covers(start_ns) or number == len(self.levels) - 1):
+                bins = level.bins(ranges)
+                if number:
+                    newest = self.newest_bin(number)
+                    if len(newest) and newest['time'][0] <= end_ns:
+                        bins = np.concatenate((bins, newest))
+                return number, bins
+
+
+class History():
+    def __init__(self, full_rows=FULL_ROWS, level_rows=LEVEL_ROWS, factor=FACTOR,
+            num_levels=NUM_LEVELS):
+        ''' The sizes of the levels of each HistoryPyramid, see the module docstring. '''
+        self.settings = (full_rows, level_rows, factor, num_levels)
+        # the HistoryPyramid of each microbit id, made when its first sample arrives
+        self.pyramids = {}
+        # time of the first sample, the origin of the plots
+        self.origin_ns = None
+        self.lock = threading.Lock()
+
+
+    def extend(self, times, ids, mags):
+        ''' Add a batch of samples given as arrays of their times in ns,
+        microbit ids and mag_acc, in the order they were taken for each microbit. '''
+        if not len(ids):
+            return
+        times = np.asarray(times, dtype=np.int64)
+        ids = np.asarray(ids)
+        mags = np.asarray(mags)
+        # the samples of each microbit together, in order
+        if ids[0] == ids[-1] and (ids == ids[0]).all():
+            bounds = []
+        else:
+            order = np.argsort(ids, kind='stable')
+            ids, times, mags = ids[order], times[order], mags[order]
+            bounds = (np.flatnonzero(ids[1:] != ids[:-1]) + 1).tolist()
+        with self.lock:
+            if self.origin_ns is None:
+                self.origin_ns = int(times.min())
+            for start, end in zip([0] + bounds, bounds + [len(ids)]):
+                ident = int(ids[start])
+                pyramid = self.pyramids.get(ident)
+                if pyramid is None:
+                    pyramid = self.pyramids[ident] = HistoryPyramid(*self.settings)
+                pyramid.extend(times[start:end], mags[start:end])
+
+
+    def latest(self):
+        ''' Return the time of the newest sample held, or None. '''
+        with self.lock:
+            newest = [level.last_time() for level in
+                (pyramid.levels[0] for pyramid in self.pyramids.values()) if len(level)]
+        return int(max(newest)) if newest else None
+
+
+    def nbytes(self):
+        ''' Return the bytes held by the levels of every microbit. '''
+        with self.lock:
+            return sum(level.nbytes() for pyramid in self.pyramids.values()
+                for level in pyramid.levels)
+
+
+    def reset(self):
+        ''' Forget every sample, e.g. after a seek. '''
+        with self.lock:
+            for pyramid in self.pyramids.values():
+                pyramid.clear()
+            self.origin_ns = None
+
+
+    def sequences(self):
+        ''' Return {id: sequence}, where the sequence of a microbit changes
+        whenever samples are added for it. '''
+        with self.lock:
+            return {ident: pyramid.sequence for ident, pyramid in self.pyramids.items()}
+
+
+    def window(self, ident, start_ns, end_ns, max_bins):
+        ''' Return (level, bins), a copy of the LEVEL_DTYPE bins of microbit
+        <ident> from <start_ns> to <end_ns> at the finest level with up to
+        <max_bins> of them, see HistoryPyramid.window. (0, None) if there
+        are no samples for <ident>. '''
+        with self.lock:
+            pyramid = self.pyramids.get(ident)
+            if pyramid is None:
+                return 0, None
+            return pyramid.window(start_ns, end_ns, max_bins)
@@ -0,0 +1,199 @@
+''' Detects juggling throws and catches in the accelerometer samples as they arrive.
+A ball in flight is in free fall, so its accelerometer reads close to 0g,
+while in the hand it reads about 1g or more. Each microbit has a two state
+machine, in the hand or in flight, with hysteresis: it leaves the hand when
+mag_acc falls below FREE_FALL and lands when mag_acc rises above LANDED, so
+noise around a single threshold does not make spurious events.
+A flight is only a throw once it has lasted MIN_AIRTIME_NS, a dip shorter
+than that is ignored. Then a throw event is emitted, timed at the start of
+the flight, and a catch event when the ball lands, carrying the airtime.
+Throw events carry the throws per minute of that microbit over the last
+RATE_WINDOW_NS.
+
+process takes a batch of samples from any of the microbits, such as the
+rows stored from one serial read. The thresholds are applied to the whole
+batch with numpy and only the samples where a state machine changes state
+are visited in Python, so the cost per sample stays flat and the state kept
+for each microbit is fixed in size.
+
+Events are (time_ns, id, kind, airtime_ns, throws_per_minute) tuples, kind
+THROW or CATCH, kept in a deque of the last MAX_EVENTS. Consumers poll
+events_since with the sequence number they last saw.
+Several ReceiverWorker threads share one EventDetector, see
+multi_receiver.py, so process, reset and the readers of the state hold
+lock, and the methods they call expect it to be held. '''
+
+from collections import deque
+import threading
+
+import numpy as np
+
+THROW = 'throw'
+CATCH = 'catch'
+# hysteresis thresholds on mag_acc in milli-g
+FREE_FALL = 400
+LANDED = 700
+# shortest flight counted as a throw
+MIN_AIRTIME_NS = 100000000
+# throws per minute are counted over this window
+RATE_WINDOW_NS = 60000000000
+# most throw times kept for each microbit for the rate
+MAX_RATE_THROWS = 256
+MAX_EVENTS = 1024
+# states
+IN_HAND = 0
+IN_FLIGHT = 1
+
+
+class EventDetector():
+    def __init__(self, num_microbits=3, free_fall=FREE_FALL, landed=LANDED,
+            min_airtime_ns=MIN_AIRTIME_NS, max_events=MAX_EVENTS):
+        self.free_fall = free_fall
+        self.landed = landed
+        self.min_airtime_ns = min_airtime_ns
+        self.events = deque(maxlen=max_events)
+        # number of events ever emitted, the sequence number of the next one
+        self.sequence = 0
+        self.lock = threading.Lock()
+        self.create_state(num_microbits)
+
+
+    def create_state(self, num_microbits):
+        ''' Start every microbit in the hand with no throws. '''
+        self.state = np.full(num_microbits, IN_HAND, dtype=np.int8)
+        # start time of the flight of each microbit in flight
+        self.flight_start = np.zeros(num_microbits, dtype=np.int64)
+        # whether that flight has been emitted as a throw yet
+        self.thrown = np.zeros(num_microbits, dtype=bool)
+        self.throws = np.zeros(num_microbits, dtype=np.int64)
+        self.last_airtime = np.zeros(num_microbits, dtype=np.int64)
+        self.throw_times = [deque(maxlen=MAX_RATE_THROWS) for _ in range(num_microbits)]
+
+
+    def detect(self, times, ids, mags):
+        ''' Run the state machines over a batch of samples, see process. '''
+        top = int(ids.max()) + 1
+        if top > len(self.state):
+            self.grow(top)
+        low = mags < self.free_fall
+        high = mags > self.landed
+        decisive = np.flatnonzero(low | high)
+        if len(decisive):
+            # the decisive samples of each microbit together, in time order
+            decisive = decisive[np.argsort(ids[decisive], kind='stable')]
+            devices = ids[decisive]
+            levels = np.where(low[decisive], IN_FLIGHT, IN_HAND).astype(np.int8)
+            before = np.empty_like(levels)
+            before[1:] = levels[:-1]
+            first = np.ones(len(levels), dtype=bool)
+            first[1:] = devices[1:] != devices[:-1]
+            before[first] = self.state[devices[first]]
+            for index in np.flatnonzero(levels != before):
+                sample = decisive[index]
+                ident = int(devices[index])
+                if levels[index] == IN_FLIGHT:
+                    self.take_off(ident, int(times[sample]))
+                else:
+                    self.land(ident, int(times[sample]))
+        # flights which have lasted long enough are throws, without waiting to land
+        waiting = np.flatnonzero((self.state == IN_FLIGHT) & ~self.thrown)
+        if len(waiting):
+            latest = np.full(len(self.state), -1, dtype=np.int64)
+            np.maximum.at(latest, ids, np.asarray(times, dtype=np.int64))
+            latest = latest[waiting]
+            due = (latest >= 0) & (latest - self.flight_start[waiting] >= self.min_airtime_ns)
+            for ident in waiting[due]:
+                self.throw(int(ident))
+
+
+    def device_stats(self):
+        ''' Return {id: (throws, last airtime in ns, throws per minute)} for
+        each microbit that has thrown. '''
+        with self.lock:
+            return {int(ident): (int(self.throws[ident]), int(self.last_airtime[ident]),
+                self.throw_rate(ident)) for ident in np.flatnonzero(self.throws)}
+
+
+    def emit(self, time_ns, ident, kind, airtime_ns=0, rate=0.0):
+        ''' Add an event to events. '''
+        self.events.append((time_ns, ident, kind, airtime_ns, rate))
+        self.sequence += 1
+
+
+    def events_since(self, sequence):
+        ''' Return (sequence, events) with the events emitted since <sequence>,
+        at most the last MAX_EVENTS of them. Pass the sequence returned to
+        the next call. '''
+        with self.lock:
+            new = min(self.sequence - sequence, len(self.events))
+            events = list(self.events)[len(self.events) - new:] if new > 0 else []
+            return self.sequence, events
+
+
+    def grow(self, num_microbits):
+        ''' Make room for the state of <num_microbits>, keeping the state held. '''
+        old = len(self.state)
+        state, flight_start, thrown = self.state, self.flight_start, self.thrown
+        throws, last_airtime, throw_times = self.throws, self.last_airtime, self.throw_times
+        self.create_state(num_microbits)
+        self.state[:old] = state
+        self.flight_start[:old] = flight_start
+        self.thrown[:old] = thrown
+        self.throws[:old] = throws
+        self.last_airtime[:old] = last_airtime
+        self.throw_times[:old] = throw_times
+
+
+    def land(self, ident, time_ns):
+        ''' Microbit <ident> has landed at <time_ns>. '''
+        self.state[ident] = IN_HAND
+        airtime = time_ns - int(self.flight_start[ident])
+        if airtime < self.min_airtime_ns:
+            return
+        if not self.thrown[ident]:
+            self.throw(ident)
+        self.last_airtime[ident] = airtime
+        self.emit(time_ns, ident, CATCH, airtime)
+
+
+    def process(self, times, ids, mags):
+        ''' Run the state machines over a batch of samples given as arrays of
+        their times in ns, microbit ids and mag_acc, in the order they were
+        taken for each microbit. '''
+        if not len(ids):
+            return
+        with self.lock:
+            self.detect(times, np.asarray(ids), mags)
+
+
+    def reset(self):
+        ''' Forget the state of every microbit, e.g. after a seek. '''
+        with self.lock:
+            self.create_state(len(self.state))
+
+
+    def take_off(self, ident, time_ns):
+        ''' Microbit <ident> has started to fall at <time_ns>. '''
+        self.state[ident] = IN_FLIGHT
+        self.flight_start[ident] = time_ns
+        self.thrown[ident] = False
+
+
+    def throw(self, ident):
+        ''' Emit the throw of the current flight of <ident>. '''
+        self.thrown[ident] = True
+        time_ns = int(self.flight_start[ident])
+        self.throws[ident] += 1
+        throw_times = self.throw_times[ident]
+        throw_times.append(time_ns)
+        while throw_times[0] < time_ns - RATE_WINDOW_NS:
+            throw_times.popleft()
+        self.emit(time_ns, ident, THROW, 0, self.throw_rate(ident))
+
+
+    def throw_rate(self, ident):
+        ''' Return the throws per minute of <ident> over its recent throws. '''
+        throw_times = self.throw_times[ident]
+        if len(throw_times) < 2 or throw_times[-1] == throw_times[0]:
+            return 0.0
+        return (len(throw_times) - 1) * 60e9 / (throw_times[-1] - throw_times[0])
@@ -1,32 +1,91 @@
 ''' Main module for the microbit_juggling project.
 Sets up the pyqtgraph.
-Data collection from the microbits is done in a separate thread.
-Communication between the graph and the data collection thread via pydispatch.
-Data samples are held in numpy arrays.
-To do: dynamically change the number of microbits and graphs
+Data collection from the microbits is done in a separate thread, or with
+--process in a separate process writing to a shared memory buffer.
+--replay FILE [--speed X] plays a recorded session instead.
+The graph copies the latest samples from the ring buffers of the reader, or
+draws them from its History, see history.py, and only redraws the curves
+which have changed. --samples N sets how many of the latest samples are drawn.
+--metrics adds the per stage latency histograms and loss counters to the text.
+--num_microbits N sets how many microbits there are, with ids 0 to N - 1.
 
 Matthew Oppenheim May 2018. '''
 
 import logging
+from metrics import FrameMeter, Metrics
 import numpy as np
-from pydispatch import dispatcher
-from pyqtgraph.Qt import QtGui, QtCore
+from pyqtgraph.Qt import QtCore, QtGui, QtWidgets
 import pyqtgraph as pg
-from pyqtgraph.ptime import time
-from read_microbits import ReadMicrobits
+from read_microbits import MAX_ROWS, ReadMicrobits
+from spectrum import MAX_FREQ
 import sys
 import threading
 
-# how many samples to average to obtain the sample frequency
-FREQ_AVG = 5
+# most of each frame interval to spend drawing, the rest is left to the reader
+FRAME_BUDGET = 0.5
+# slowest the display refreshes at when frames take long to draw
+MIN_REFRESH_RATE = 10
+# seconds of history shown while following the newest samples
+HISTORY_SPAN = 10
+# colour of the curves, as drawn by pyqtgraph by default
+CURVE_PEN = (200, 200, 200)
+# dominant frequencies written on each line of the readout
+READOUT_COLUMNS = 8
+# most plots stacked in one column before another column is started
+MAX_PLOT_ROWS = 8
 NUM_MICROBITS = 3
 # how many samples to display
 NUM_SAMPLES = 5
-# frequency to refresh the display
-SCREEN_REFRESH_RATE = 30
+# fastest the display refreshes at
+SCREEN_REFRESH_RATE = 60
+# top of the spectrum plot, amplitude in milli-g
+SPECTRUM_RANGE = 600
+# how often the refresh rate, status and metrics text are updated in ns
+STATUS_INTERVAL_NS = 1000000000
 
 logging.basicConfig(level=logging.DEBUG, format='%(message)s')
 
+def pop_option(name, default=None):
+    ''' Remove option <name> and its value from sys.argv, return the value.
+    ReadMicrobits parses the remaining arguments. '''
+    if name not in sys.argv:
+        return default
+    i = sys.argv.index(name)
+    value = sys.argv[i+1]
+    del sys.argv[i:i+2]
+    return value
+
+
+def plot_grid(num_microbits):
+    ''' Return (rows, columns) of the plots of <num_microbits>, in columns
+    of up to MAX_PLOT_ROWS. '''
+    num_cols = -(-num_microbits // MAX_PLOT_ROWS)
+    return -(-num_microbits // num_cols), num_cols
+
+
+def peak_downsample(samples, start, max_points):
+    ''' Return (x, y) to draw <samples>, the first at x = <start>, with at
+    most about <max_points> points. Longer runs of samples are split into
+    bins, each drawn as its min and its max, so no peak is lost. y is always
+    a new array, as setData keeps what it is given, never a view of <samples>. '''
+    num_samples = len(samples)
+    if num_samples <= max_points:
+        return np.arange(start, start + num_samples, dtype=np.float64), np.array(samples)
+    size = -(-2 * num_samples // max_points)
+    num_bins = num_samples // size
+    # the samples left over at the end are drawn as they are
+    whole = num_bins * size
+    bins = samples[:whole].reshape(num_bins, size)
+    y = np.empty(2 * num_bins + num_samples - whole, dtype=samples.dtype)
+    y[0:2 * num_bins:2] = bins.min(axis=1)
+    y[1:2 * num_bins:2] = bins.max(axis=1)
+    y[2 * num_bins:] = samples[whole:]
+    x = np.empty(len(y), dtype=np.float64)
+    x[:2 * num_bins] = start + np.repeat(np.arange(num_bins) * size + size / 2, 2)
+    x[2 * num_bins:] = start + np.arange(whole, num_samples)
+    return x, y
+
+
 def system_exit(message):
     ''' quit script '''
     print('system exit: {}'.format(message))
@@ -34,96 +93,352 @@ def system_exit(message):
 
 
 class MicrobitJuggle():
-    def __init__(self, num_microbits=3):
+    def __init__(self, num_microbits=3, use_process=False, replay=None, speed=1.0,
+            show_metrics=False, reader=None, num_samples=NUM_SAMPLES):
+        ''' <reader> displays an existing reader instead of starting one.
+        <num_samples> is the number of the latest samples drawn for each
+        microbit, the ring buffers of the reader started hold at least that many. '''
         logging.info('started main.py')
-        if num_microbits > 3:
-            system_exit('max num_microbits is 3')
-        mb_thread = threading.Thread(target=ReadMicrobits)
-        mb_thread.start()
-        self.app = QtGui.QApplication([])
-        win = pg.GraphicsWindow()
-        win.setWindowTitle('Microbit accelerometer data')
-        p0 = win.addPlot()
-        win.nextRow()
-        p1 = win.addPlot()
-        win.nextRow()
-        p2 = win.addPlot()
-        for plot in [p0, p1, p2]:
-            plot.setYRange(0,3000)
+        self.acquisition = None
+        ring_rows = max(num_samples, MAX_ROWS)
+        if reader:
+            self.reader = reader
+        elif replay:
+            from replay import ReplayMicrobits
+            self.reader = ReplayMicrobits(replay, num_microbits, speed, run_main=False,
+                ring_rows=ring_rows)
+            mb_thread = threading.Thread(target=self.reader.main, daemon=True)
+            mb_thread.start()
+        elif use_process:
+            from shared_buffer import AcquisitionProcess
+            self.acquisition = AcquisitionProcess(num_microbits, ring_rows)
+            self.acquisition.start()
+            self.reader = self.acquisition
+        else:
+            self.reader = ReadMicrobits(num_microbits=num_microbits, run_main=False,
+                dispatch=False, ring_rows=ring_rows)
+            mb_thread = threading.Thread(target=self.reader.main, daemon=True)
+            mb_thread.start()
+        self.app = pg.mkQApp()
+        self.win = pg.GraphicsWindow()
+        self.win.setWindowTitle('Microbit accelerometer data')
+        self.mb_names = ['mb_{}'.format(i) for i in range(num_microbits)]
+        self.num_samples = num_samples
+        # an acquisition process does not share its history
+        self.history = getattr(self.reader, 'history', None)
+        self.following = True
+        self.plots = self.create_plots(self.win, num_microbits, num_samples)
+        self.spectrum = getattr(self.reader, 'spectrum', None)
+        if self.spectrum:
+            self.create_spectrum_plot(self.win, num_microbits)
         self.text = pg.TextItem('text', anchor=(0,3))
-        p2.addItem(self.text)
-        self.curve0 = p0.plot()
-        self.curve1 = p1.plot()
-        self.curve2 = p2.plot()
-        self.index = 0
-        self.last_time = time()
-        self.freq = None
-        self.freq_list = np.zeros(FREQ_AVG)
-        self.mb_dict = self.create_mb_dict(num_microbits)
-        dispatcher.connect(self.dispatcher_receive_data,
-            sender='read_microbits', signal='plot_data')
-
-
-    def dispatcher_receive_data(self, message):
-        ''' Handle <message> sent through dispatch. '''
-        self.mb_dict = message
-        # logging.info('received: {}'.format(self.mb_dict))
-
-
-    def graph_update_rate(self):
-            ''' Calculate graph refresh frequency. '''
-            now_time = time()
-            dt = now_time - self.last_time
-            self.last_time = now_time
-            if self.freq is None:
-                self.freq = 1.0/dt
+        self.plots[-1].addItem(self.text)
+        # the ring buffer sequence of each microbit when its curve was drawn
+        self.drawn = {}
+        self.curves = {mb: self.create_curve(plot)
+            for mb, plot in zip(self.mb_names, self.plots)}
+        self.shown_text = None
+        self.status_text = ''
+        self.next_status = 0
+        self.meter = FrameMeter()
+        self.metrics = Metrics()
+        self.show_metrics = show_metrics
+        self.metrics_text = ''
+        self.timer = QtCore.QTimer()
+        self.timer.setTimerType(QtCore.Qt.PreciseTimer)
+        self.timer.timeout.connect(self.update)
+        # the events are found by the reader, an acquisition process keeps them
+        self.detector = getattr(self.reader, 'detector', None)
+        self.event_sequence = 0
+        self.events_text = ''
+        # the samples of every microbit on one timebase, kept by the reader
+        self.aligner = getattr(self.reader, 'aligner', None)
+        self.lags_text = ''
+
+
+    def adapt_refresh(self):
+        ''' Set the timer interval so that drawing takes up to FRAME_BUDGET of
+        each frame, refreshing between MIN_REFRESH_RATE and SCREEN_REFRESH_RATE. '''
+        interval_ms = self.meter.draw_time() / 1e6 / FRAME_BUDGET
+        interval_ms = int(min(max(interval_ms, 1000 / SCREEN_REFRESH_RATE),
+            1000 / MIN_REFRESH_RATE))
+        if interval_ms != self.timer.interval():
+            self.timer.setInterval(interval_ms)
+
+
+    def create_curve(self, plot):
+        ''' Add a curve to <plot>. A bare PlotCurveItem is used, rather than a
+        PlotDataItem, which works out far more than is needed on every setData. '''
+        curve = pg.PlotCurveItem(pen=pg.mkPen(CURVE_PEN), skipFiniteCheck=True)
+        plot.addItem(curve)
+        # the downsampling depends on the size and range of the view
+        view = plot.getViewBox()
+        view.sigResized.connect(self.redraw)
+        view.sigXRangeChanged.connect(self.redraw)
+        view.sigRangeChangedManually.connect(self.stop_following)
+        return curve
+
+
+    def create_plots(self, win, num_microbits, num_samples=NUM_SAMPLES):
+        ''' Add a plot to <win> for each microbit, in columns of up to MAX_PLOT_ROWS,
+        showing <num_samples>. Returns the plots in microbit id order. '''
+        num_rows, num_cols = plot_grid(num_microbits)
+        plots = []
+        for i in range(num_microbits):
+            # with more than the original three, label each plot with its microbit
+            title = self.mb_names[i] if num_microbits > NUM_MICROBITS else None
+            plot = win.addPlot(row=i % num_rows, col=i // num_rows, title=title)
+            plot.setYRange(0,3000)
+            # a fixed range saves working out the bounds of the data every frame
+            if self.history:
+                plot.setXRange(-HISTORY_SPAN, 0, padding=0)
+                # the mouse zooms and pans every plot in time only
+                plot.setMouseEnabled(y=False)
+                if plots:
+                    plot.setXLink(plots[0])
+                # the time axis is redrawn as it moves, only label the bottom plots
+                if i % num_rows != num_rows - 1 and i != num_microbits - 1:
+                    plot.hideAxis('bottom')
             else:
-                s = np.clip(dt*3., 0, 1)
-                self.freq = self.freq * (1-s) + (1.0/dt) * s
-            self.freq_list[-1] = self.freq
-            return(FREQ_AVG*np.average(self.freq_list))
+                plot.setXRange(0, num_samples)
+            # the axes do not change, repaint them from a pixmap with the curves
+            for axis in ('left', 'bottom'):
+                plot.getAxis(axis).setCacheMode(QtWidgets.QGraphicsItem.DeviceCoordinateCache)
+            plots.append(plot)
+        return plots
+
+
+    def create_spectrum_plot(self, win, num_microbits):
+        ''' Add a plot under the others, across every column, with a
+        spectrum curve in its own colour for each microbit and the dominant
+        frequency readout. '''
+        num_rows, num_cols = plot_grid(num_microbits)
+        plot = win.addPlot(row=num_rows, col=0, colspan=num_cols)
+        plot.setXRange(0, MAX_FREQ)
+        plot.setYRange(0, SPECTRUM_RANGE)
+        plot.setLabel('bottom', 'Hz')
+        self.spectrum_curves = []
+        for i in range(num_microbits):
+            curve = pg.PlotCurveItem(pen=pg.mkPen(pg.intColor(i, hues=num_microbits)),
+                skipFiniteCheck=True)
+            plot.addItem(curve)
+            self.spectrum_curves.append(curve)
+        self.readout = pg.TextItem('', anchor=(0, 0))
+        self.readout.setPos(0, SPECTRUM_RANGE)
+        plot.addItem(self.readout)
+        self.readout_text = None
+        # the spectrum sequence of each microbit when its curve was drawn
+        self.spectrum_drawn = {}
+
 
+    def draw_curve(self, mb, samples):
+        ''' Set the curve of <mb> to the part of <samples> in view, peak
+        downsampled to two points for each pixel across the plot. '''
+        curve = self.curves[mb]
+        view = curve.getViewBox()
+        (left, right), _ = view.viewRange()
+        start = min(max(int(left), 0), len(samples))
+        end = min(max(int(right) + 2, start), len(samples))
+        x, y = peak_downsample(samples[start:end], start, 2 * max(int(view.width()), 1))
+        curve.setData(x=x, y=y)
 
-    def create_mb_dict(self, num_microbits):
-        ''' Create a dictionary to store the microbit data. '''
-        mb_names = ['mb_{}'.format(id_x) for id_x in range(num_microbits)]
-        mb_dict = {name: self.initialise_data() for name in mb_names}
-        return mb_dict
 
+    def draw_history(self, mb, ident, left, right):
+        ''' Set the curve of <mb>, microbit id <ident>, to its history from
+        <left> to <right> seconds, at most two bins for each pixel. Bins
+        summarising several samples are drawn as their min and max. '''
+        origin_ns = self.history.origin_ns
+        if origin_ns is None:
+            return
+        curve = self.curves[mb]
+        width = 2 * max(int(curve.getViewBox().width()), 1)
+        level, bins = self.history.window(ident, origin_ns + int(left * 1e9),
+            origin_ns + int(right * 1e9), width)
+        if bins is None:
+            return
+        x = (bins['time'] - origin_ns) / 1e9
+        if level == 0:
+            curve.setData(x=x, y=bins['min'])
+            return
+        y = np.empty(2 * len(bins), dtype=bins['min'].dtype)
+        y[0::2] = bins['min']
+        y[1::2] = bins['max']
+        curve.setData(x=np.repeat(x, 2), y=y)
 
-    def initialise_data(self):
-        ''' Create a numpy array of 0s. '''
-        # MAKE dtype INT
-        return np.zeros(NUM_SAMPLES,dtype=int)
 
+    def redraw(self, *args):
+        ''' Redraw every curve on the next frame. '''
+        self.drawn.clear()
 
-    def roll_data(self, data):
-        ''' Rolls <data> by one sample. '''
-        # using slices is 2.5 times faster than using np.roll
-        data[:-1] = data[1:]
-        return data
+
+    def start(self):
+        ''' Start refreshing the display at SCREEN_REFRESH_RATE. '''
+        self.timer.start(int(1000 / SCREEN_REFRESH_RATE))
+
+
+    def stop_following(self, *args):
+        ''' Stop moving the time axis on to the newest samples, as it has
+        been zoomed or panned with the mouse. '''
+        self.following = False
 
 
     def update(self):
-        ''' Update the plot curves with new data. SYNTHETIC DATA '''
-        dispatcher.send(message=NUM_SAMPLES, sender='main', signal='request_data')
-        self.text.setText('screen refresh rate: {:0.1f}'.format(
-            self.graph_update_rate(), color=(255,255,0)))
-        self.curve0.setData(self.mb_dict['mb_0'])
-        self.curve1.setData(self.mb_dict['mb_1'])
-        self.curve2.setData(self.mb_dict['mb_2'])
-        for data in self.mb_dict.values():
-            data = self.roll_data(data)
+        ''' Redraw the curves of the microbits with new samples and the text. '''
+        start = self.meter.frame_started()
+        if self.history:
+            self.update_history()
+        else:
+            self.update_latest()
+        if start >= self.next_status:
+            self.next_status = start + STATUS_INTERVAL_NS
+            self.update_status()
+        if self.spectrum:
+            self.update_spectrum()
+        if self.detector:
+            self.update_events_text()
+        text = self.status_text + self.lags_text + self.events_text + self.metrics_text
+        if text != self.shown_text:
+            self.text.setText(text, color=(255,255,0))
+            self.shown_text = text
         self.app.processEvents()
+        self.meter.frame_done(start)
+        self.metrics.record_since('render', start)
+
+
+    def update_history(self):
+        ''' Move the time axis on to the newest samples while following and
+        redraw the curves of the microbits with new samples. The plots show
+        seconds from the first sample and follow the newest HISTORY_SPAN
+        seconds until they are zoomed or panned, and follow again once panned
+        back to the newest samples. '''
+        latest_ns = self.history.latest()
+        origin_ns = self.history.origin_ns
+        if latest_ns is None or origin_ns is None:
+            return
+        newest = (latest_ns - origin_ns) / 1e9
+        view = self.plots[0].getViewBox()
+        (left, right), _ = view.viewRange()
+        if not self.following and right >= newest:
+            self.following = True
+        # move on a pixel at a time, every curve is redrawn for the new range
+        if self.following and newest - right > (right - left) / max(view.width(), 1):
+            left, right = newest - (right - left), newest
+            view.setXRange(left, right, padding=0)
+        sequences = self.history.sequences()
+        for ident, mb in enumerate(self.mb_names):
+            sequence = sequences.get(ident)
+            if sequence is not None and sequence != self.drawn.get(mb):
+                self.draw_history(mb, ident, left, right)
+                self.drawn[mb] = sequence
+
+
+    def update_latest(self):
+        ''' Redraw the curves of the microbits with new samples in their ring buffers. '''
+        sequences = self.reader.sequences()
+        changed = [mb for mb in self.curves if sequences[mb] != self.drawn.get(mb)]
+        if changed:
+            # pyqtgraph keeps the arrays given to setData and draws them later,
+            # while the reader goes on writing into the ring buffers, so copy them
+            mb_dict = self.reader.snapshot(self.num_samples, mbs=changed, copy=True)
+            for mb in changed:
+                self.draw_curve(mb, mb_dict[mb])
+                self.drawn[mb] = sequences[mb]
+
+
+    def update_spectrum(self):
+        ''' Redraw the spectra which have been worked out again since the
+        last frame and the dominant frequency readout. '''
+        sequences = self.spectrum.sequences()
+        changed = [ident for ident, sequence in sequences.items()
+            if ident < len(self.spectrum_curves) and sequence != self.spectrum_drawn.get(ident)]
+        if not changed:
+            return
+        for ident in changed:
+            spectrum = self.spectrum.spectrum(ident)
+            if spectrum:
+                frequencies, magnitudes = spectrum
+                self.spectrum_curves[ident].setData(x=frequencies, y=magnitudes)
+            self.spectrum_drawn[ident] = sequences[ident]
+        entries = ['{}: {:0.2f} Hz'.format(self.mb_names[ident], frequency) for ident, frequency
+            in sorted(self.spectrum.dominant_frequencies().items()) if ident < len(self.mb_names)]
+        text = '\n'.join('  '.join(entries[i:i + READOUT_COLUMNS])
+            for i in range(0, len(entries), READOUT_COLUMNS))
+        if text != self.readout_text:
+            self.readout.setText(text, color=(255,255,0))
+            self.readout_text = text
+
+
+    def update_events_text(self):
+        ''' Rewrite the juggling statistics when there are new events. '''
+        self.event_sequence, events = self.detector.events_since(self.event_sequence)
+        if not events:
+            return
+        lines = ['mb_{} throws: {} {:0.0f}/min airtime: {:0.0f} ms'.format(ident,
+            throws, rate, airtime_ns / 1e6) for ident, (throws, airtime_ns, rate)
+            in sorted(self.detector.device_stats().items())]
+        self.events_text = '\n' + '\n'.join(lines)
+
+
+    def update_status(self):
+        ''' Rewrite the frame rate, reader status and metrics text and adapt
+        the refresh rate to the time taken to draw the last frames. '''
+        status = ''
+        if self.acquisition:
+            status = ' {}'.format(self.acquisition.check())
+        self.status_text = 'screen refresh rate: {:0.1f} draw: {:0.1f} ms{}'.format(
+            self.meter.frame_rate(), self.meter.draw_time() / 1e6, status)
+        if self.aligner:
+            self.lags_text = self.update_lags_text()
+        if self.show_metrics:
+            self.metrics_text = self.update_metrics_text()
+        self.adapt_refresh()
+
+
+    def update_lags_text(self):
+        ''' Return the lag of each microbit behind mb_0, positive when it
+        follows mb_0, and their correlation. '''
+        lags = self.aligner.correlate([(ident, 0) for ident in range(1, len(self.mb_names))])
+        if not lags:
+            return ''
+        entries = ['{} {:+0.2f} s ({:0.2f})'.format(self.mb_names[ident], lag, correlation)
+            for (ident, _), (lag, correlation) in sorted(lags.items())]
+        return '\nlag behind mb_0: ' + '\n'.join('  '.join(entries[i:i + READOUT_COLUMNS])
+            for i in range(0, len(entries), READOUT_COLUMNS))
+
+
+    def update_metrics_text(self):
+        ''' Return the metrics overlay text for the reader and the display. '''
+        lines = self.metrics.text_lines()
+        # the reader metrics are not shared from an acquisition process
+        reader_metrics = getattr(self.reader, 'metrics', None)
+        if reader_metrics:
+            lines = reader_metrics.text_lines() + lines
+        if hasattr(self.reader, 'device_counters'):
+            for mb, counters in sorted(self.reader.device_counters().items()):
+                lines.append('{} lost: {} timed out: {} duplicated: {}'.format(mb,
+                    counters['gap_lost'], counters['timed_out'], counters['duplicated']))
+        return '\n' + '\n'.join(lines)
 
 
 if __name__ == '__main__':
     logging.info('starting MicrobitJuggle ')
-    microbit_juggling = MicrobitJuggle(num_microbits=3)
-    timer = QtCore.QTimer()
-    timer.timeout.connect(microbit_juggling.update)
-    # timer units are milliseconds. timer.start(0) to go as fast as practical.
-    timer.start(1000/SCREEN_REFRESH_RATE)
+    # --process is for main.py, ReadMicrobits parses the remaining arguments
+    use_process = '--process' in sys.argv
+    if use_process:
+        sys.argv.remove('--process')
+    show_metrics = '--metrics' in sys.argv
+    if show_metrics:
+        sys.argv.remove('--metrics')
+    num_microbits = int(pop_option('--num_microbits',
+        pop_option('-n', NUM_MICROBITS)))
+    replay = pop_option('--replay')
+    speed = float(pop_option('--speed', 1.0))
+    num_samples = int(pop_option('--samples', NUM_SAMPLES))
+    microbit_juggling = MicrobitJuggle(num_microbits=num_microbits, use_process=use_process,
+        replay=replay, speed=speed, show_metrics=show_metrics, num_samples=num_samples)
+    microbit_juggling.start()
     if (sys.flags.interactive != 1) or not hasattr(QtCore, 'PYQT_'):
         QtGui.QApplication.instance().exec_()
+        if microbit_juggling.acquisition:
+            microbit_juggling.acquisition.stop()
 
@@ -0,0 +1,182 @@
+''' Low overhead instrumentation for the data pipeline.
+LatencyHistogram counts durations in log-linear buckets, like an HDR
+histogram: each power of two is split into SUB_BUCKETS buckets, so any
+recorded value is known to within about 6% using a fixed, small list of
+counts. Recording a value is a few integer operations, cheap enough to leave
+on all the time.
+Metrics holds a histogram for each pipeline stage, e.g. poll_reply, parse,
+store, dispatch and render, plus named counters.
+FrameMeter measures the display frame rate and the time spent drawing a
+frame over the last FRAME_WINDOW frames. '''
+
+from collections import deque
+import logging
+from time import perf_counter_ns
+
+SUB_BUCKET_BITS = 4
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+# enough buckets for durations up to 2**48 ns, about 3 days
+NUM_BUCKETS = (48 - SUB_BUCKET_BITS) * SUB_BUCKETS + 2 * SUB_BUCKETS
+PERCENTILES = (50, 90, 99, 99.9)
+# frames the frame rate and draw time are measured over
+FRAME_WINDOW = 60
+
+
+def bucket_index(value):
+    ''' Return the bucket for a non negative integer <value>. '''
+    if value < 2 * SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS - 1
+    return shift * SUB_BUCKETS + (value >> shift)
+
+
+def bucket_value(index):
+    ''' Return the middle of the range of values counted in bucket <index>. '''
+    if index < 2 * SUB_BUCKETS:
+        return index
+    shift = index // SUB_BUCKETS - 1
+    top = index - shift * SUB_BUCKETS
+    return (top << shift) + (1 << shift) // 2
+
+
+class LatencyHistogram():
+    def __init__(self):
+        self.counts = [0] * NUM_BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+
+    def percentile(self, percent):
+        ''' Return the value below which <percent> of the recorded values lie. '''
+        if not self.count:
+            return 0
+        target = self.count * percent / 100
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= target:
+                return min(bucket_value(index), self.max)
+        return self.max
+
+
+    def record(self, value):
+        ''' Count one duration <value> in ns. '''
+        value = int(value)
+        if value < 0:
+            value = 0
+        index = bucket_index(value)
+        if index >= NUM_BUCKETS:
+            index = NUM_BUCKETS - 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+
+    def reset(self):
+        self.__init__()
+
+
+    def summary(self):
+        ''' Return a dict of count, mean and percentiles in microseconds. '''
+        result = {'count': self.count,
+            'mean_us': self.total / self.count / 1e3 if self.count else 0.0,
+            'max_us': self.max / 1e3}
+        for percent in PERCENTILES:
+            result['p{}_us'.format(percent)] = self.percentile(percent) / 1e3
+        return result
+
+
+class FrameMeter():
+    ''' Times the frames from when each one starts to the next, rather than
+    smoothing the last interval, so the rate is exact over the window. '''
+    def __init__(self, window=FRAME_WINDOW):
+        # perf_counter_ns at the start of each frame, and the ns spent drawing it
+        self.starts = deque(maxlen=window + 1)
+        self.draw_times = deque(maxlen=window)
+
+
+    def draw_time(self):
+        ''' Return the mean ns spent drawing a frame. '''
+        if not self.draw_times:
+            return 0
+        return sum(self.draw_times) / len(self.draw_times)
+
+
+    def frame_done(self, start_ns):
+        ''' Record that the frame started at <start_ns> has been drawn. '''
+        self.draw_times.append(perf_counter_ns() - start_ns)
+
+
+    def frame_rate(self):
+        ''' Return the frames per second over the window, 0.0 before two frames. '''
+        if len(self.starts) < 2:
+            return 0.0
+        return (len(self.starts) - 1) * 1e9 / (self.starts[-1] - self.starts[0])
+
+
+    def frame_started(self):
+        ''' Record the start of a frame, return its perf_counter_ns. '''
+        start = perf_counter_ns()
+        self.starts.append(start)
+        return start
+
+
+class Metrics():
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+
+
+    def count(self, name, increment=1):
+        ''' Add <increment> to counter <name>. '''
+        self.counters[name] = self.counters.get(name, 0) + increment
+
+
+    def histogram(self, stage):
+        ''' Return the histogram for <stage>, creating it if needed. '''
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = LatencyHistogram()
+        return histogram
+
+
+    def log(self, extra_lines=()):
+        ''' Write the metrics to the log. '''
+        for line in self.text_lines() + list(extra_lines):
+            logging.info(line)
+
+
+    def record(self, stage, duration_ns):
+        ''' Record a duration in ns for <stage>. '''
+        self.histogram(stage).record(duration_ns)
+
+
+    def record_since(self, stage, start_ns):
+        ''' Record the time since <start_ns>, from perf_counter_ns, for <stage>.
+        Returns the time now so that stages can be chained. '''
+        now = perf_counter_ns()
+        self.histogram(stage).record(now - start_ns)
+        return now
+
+
+    def snapshot(self):
+        ''' Return a dict of the histogram summaries and counters. '''
+        return {'histograms': {stage: histogram.summary()
+            for stage, histogram in self.histograms.items()},
+            'counters': dict(self.counters)}
+
+
+    def text_lines(self):
+        ''' Return a short line of text for each histogram and the counters. '''
+        lines = []
+        for stage, histogram in sorted(self.histograms.items()):
+            lines.append('{}: n {} p50 {:0.0f} us p99 {:0.0f} us max {:0.0f} us'.format(
+                stage, histogram.count, histogram.percentile(50) / 1e3,
+                histogram.percentile(99) / 1e3, histogram.max / 1e3))
+        if self.counters:
+            lines.append(' '.join('{}: {}'.format(name, value)
+                for name, value in sorted(self.counters.items())))
+        return lines
@@ -1,10 +1,17 @@
 /* Receive BC Micro:bit radio data and transmit through serial port
 v0.0 Nov 2017 Matthew Oppenheim
+group:G moves this receiver to radio group G, so that several receivers can
+each read their own transmitters, which are moved with rg_N:G.
 */
 
 #include "MicroBit.h"
+#include <stdio.h>
 
 MicroBit uBit;
+// transmitter ids are sent in one byte by protocol version 2
+const int MAX_ID = 255;
+const int DEFAULT_GROUP = 10;
+const int MAX_GROUP = 255;
 
 // Default serial 115200 baud, 8N1
 
@@ -20,34 +27,48 @@ MicroBitImage big_r(5,5,big_r_arr);
 
 void onData(MicroBitEvent)
 // send received data to serial port
+// protocol version 2 frames are binary and may hold 0 bytes, so relay the raw packet
 {
     // uBit.serial.send(" rx ");
-    ManagedString s = uBit.radio.datagram.recv();
+    PacketBuffer p = uBit.radio.datagram.recv();
     // int rssi = uBit.radio.getRSSI();
-    uBit.serial.send(s);
+    uBit.serial.send(p.getBytes(), p.length());
     // uBit.serial.send(rssi);
 }
 
+bool valid_id(ManagedString s)
+// true if s starts with mb_N, ss_N or rg_N and N is a transmitter id
+{
+    int id;
+    if (sscanf(s.toCharArray() + 3, "%d", &id) != 1)
+        return false;
+    return id >= 0 && id <= MAX_ID;
+}
+
+void set_group(ManagedString s)
+// group:G
+{
+    int group;
+    if (sscanf(s.toCharArray(), "group:%d", &group) != 1)
+        return;
+    if (group >= 0 && group <= MAX_GROUP)
+        uBit.radio.setGroup(group);
+}
+
 void onSerial(MicroBitEvent)
 // react to incoming serial data
 {
     ManagedString s = uBit.serial.readUntil("\n");
-    if (s=="mb_0")
-    {
-        // poll sensor 0
-        uBit.radio.datagram.send("mb_0");
-        uBit.display.print(big_r);
-    }
-    if (s=="mb_1")
-    {
-        // poll sensor 1
-        uBit.radio.datagram.send("mb_1");
-        uBit.display.print(big_r);
-    }
-    if (s=="mb_2")
+    // relay polls to the sensors: mb_N for protocol version 1, mb_N:2 for version 2,
+    // the streaming commands ss_N:slot,num_slots,slot_ms, sync and stop
+    // and the radio group command rg_N:G for any transmitter id N
+    ManagedString prefix = s.substring(0, 3);
+    if (s.substring(0, 6) == "group:")
+        set_group(s);
+    else if ((s.length() > 3 && (prefix == "mb_" || prefix == "ss_" || prefix == "rg_")
+        && valid_id(s)) || s == "sync" || s == "stop")
     {
-        // poll sensor 2
-        uBit.radio.datagram.send("mb_2");
+        uBit.radio.datagram.send(s);
         uBit.display.print(big_r);
     }
     uBit.serial.eventAfter(1);
@@ -65,7 +86,7 @@ int main()
     uBit.serial.eventAfter(1);
     uBit.radio.enable();
     //uBit.radio.setFrequencyBand(30);
-    uBit.radio.setGroup(10);
+    uBit.radio.setGroup(DEFAULT_GROUP);
     while(1)
     {
         uBit.sleep(500);
@@ -2,18 +2,32 @@
 Transmit accelerometer data on the BBC micro:bit
 Send through radio
 v1.0 May 2018 Matthew Oppenheim
+Protocol version 2: polled with mb_N:2 the accelerometer is sampled every
+SAMPLE_PERIOD ms and the last MAX_BATCH samples are sent in one binary frame,
+see protocol.py for the frame layout.
+Streaming: ss_N:slot,num_slots,slot_ms sets this unit's time slot, sync starts
+sending a version 2 frame unpolled in that slot of every num_slots * slot_ms
+and stop ends it. sync is sent again now and then to realign the slots.
+rg_N:G moves this unit to radio group G, to be read by the receiver on G.
+Only ID needs changing for each transmitter, 0 to 255, the polls are
+parsed for their id rather than compared with fixed strings.
 */
 
 #include "MicroBit.h"
+#include <stdio.h>
 
 MicroBit uBit;
 int COUNT = 0;
-// ID of this transmitter
-int ID = 2;
-// string sent by the receiver to this unit to select it
-char ID_STR[5] = "mb_2";
-// string displayed on this microbit's LEDs
-char ID_DISPLAY[2] = "2";
+// ID of this transmitter, sent in one byte by protocol version 2
+const int ID = 2;
+
+const int DEFAULT_GROUP = 10;
+const int MAX_GROUP = 255;
+
+// protocol version 2
+const int MAX_BATCH = 3;
+const int SAMPLE_PERIOD = 5;
+const int FRAME_SIZE = 9 + 6 * MAX_BATCH + 2;
 
 // Default serial 115200 baud, 8N1
 
@@ -41,6 +55,19 @@ struct AccString {
     ManagedString zString;
 };
 
+// samples taken for protocol version 2 and not yet sent, oldest first
+AccData samples[MAX_BATCH];
+int num_samples = 0;
+int seq = 0;
+bool sampling = false;
+
+// streaming time slot
+int slot = 0;
+int num_slots = 0;
+int slot_ms = 0;
+bool streaming = false;
+unsigned long frame_start = 0;
+
 AccData getAcc()
 /* return x,y,z accelerometer AccData */
 {
@@ -74,20 +101,171 @@ void transmit_sensors()
     COUNT += 1;
 }
 
+void take_sample()
+// add a sample to the batch, dropping the oldest if the batch is full
+{
+    if (num_samples == MAX_BATCH)
+    {
+        for (int i = 1; i < MAX_BATCH; i++)
+            samples[i - 1] = samples[i];
+        num_samples -= 1;
+    }
+    samples[num_samples] = getAcc();
+    num_samples += 1;
+    COUNT += 1;
+}
+
+void sample_fiber()
+// sample the accelerometer at the local rate for protocol version 2
+{
+    while (1)
+    {
+        take_sample();
+        uBit.sleep(SAMPLE_PERIOD);
+    }
+}
+
+void put_uint16(uint8_t *frame, int pos, int value)
+// little endian
+{
+    frame[pos] = value & 0xff;
+    frame[pos + 1] = (value >> 8) & 0xff;
+}
+
+void transmit_batch()
+// send the samples taken since the last poll in a protocol version 2 frame
+{
+    uint8_t frame[FRAME_SIZE];
+    if (num_samples == 0)
+        take_sample();
+    int first_count = COUNT - num_samples;
+    frame[0] = 0xaa;
+    frame[1] = 0x55;
+    frame[2] = 2;
+    frame[3] = ID;
+    put_uint16(frame, 4, seq);
+    put_uint16(frame, 6, first_count);
+    frame[8] = num_samples;
+    int pos = 9;
+    for (int i = 0; i < num_samples; i++)
+    {
+        put_uint16(frame, pos, samples[i].x_acc);
+        put_uint16(frame, pos + 2, samples[i].y_acc);
+        put_uint16(frame, pos + 4, samples[i].z_acc);
+        pos += 6;
+    }
+    uint16_t checksum = 0;
+    for (int i = 2; i < pos; i++)
+        checksum += frame[i];
+    put_uint16(frame, pos, checksum);
+    pos += 2;
+    uBit.radio.datagram.send(frame, pos);
+    num_samples = 0;
+    seq += 1;
+}
+
+void start_sampling()
+{
+    if (!sampling)
+    {
+        sampling = true;
+        create_fiber(sample_fiber);
+    }
+}
+
+void stream_fiber()
+// send a frame in this unit's slot of every streaming frame
+{
+    while (streaming)
+    {
+        unsigned long frame_ms = num_slots * slot_ms;
+        unsigned long now = uBit.systemTime();
+        unsigned long elapsed = now - frame_start;
+        // start of this unit's next slot
+        unsigned long next = frame_start + (elapsed / frame_ms) * frame_ms + slot * slot_ms;
+        if (next < now)
+            next += frame_ms;
+        uBit.sleep(next - now);
+        if (streaming)
+            transmit_batch();
+    }
+}
+
+void set_slot(ManagedString s)
+// ss_N:slot,num_slots,slot_ms
+{
+    int id, new_slot, new_num_slots, new_slot_ms;
+    if (sscanf(s.toCharArray(), "ss_%d:%d,%d,%d", &id, &new_slot,
+            &new_num_slots, &new_slot_ms) != 4 || id != ID)
+        return;
+    if (new_num_slots < 1 || new_slot_ms < 1)
+        return;
+    slot = new_slot;
+    num_slots = new_num_slots;
+    slot_ms = new_slot_ms;
+}
+
+void set_group(ManagedString s)
+// rg_N:G
+{
+    int id, group;
+    if (sscanf(s.toCharArray(), "rg_%d:%d", &id, &group) != 2 || id != ID)
+        return;
+    if (group >= 0 && group <= MAX_GROUP)
+        uBit.radio.setGroup(group);
+}
+
+int parse_poll(ManagedString s)
+// return the protocol version of a poll for this unit, mb_N or mb_N:2,
+// or 0 if s is not a poll for this unit
+{
+    int id, version, end = 0;
+    const char *chars = s.toCharArray();
+    if (sscanf(chars, "mb_%d%n", &id, &end) != 1 || id != ID)
+        return 0;
+    if (chars[end] == 0)
+        return 1;
+    if (sscanf(chars + end, ":%d", &version) == 1)
+        return version;
+    return 0;
+}
+
 void onData(MicroBitEvent)
 // send sensor data over radio
 {
     ManagedString s = uBit.radio.datagram.recv();
-    if (s == ID_STR)
+    int version = parse_poll(s);
+    if (version == 1)
         transmit_sensors();
+    if (version == 2)
+    {
+        start_sampling();
+        transmit_batch();
+    }
+    if (s.substring(0, 3) == "ss_")
+        set_slot(s);
+    if (s.substring(0, 3) == "rg_")
+        set_group(s);
+    if (s == "sync" && num_slots > 0)
+    {
+        frame_start = uBit.systemTime();
+        if (!streaming)
+        {
+            streaming = true;
+            start_sampling();
+            create_fiber(stream_fiber);
+        }
+    }
+    if (s == "stop")
+        streaming = false;
 }
 
 int main()
 {
     uBit.init();
-    uBit.display.print(ID_DISPLAY);
+    uBit.display.scroll(ID);
     uBit.radio.enable();
-    uBit.radio.setGroup(10);
+    uBit.radio.setGroup(DEFAULT_GROUP);
     uBit.messageBus.listen(MICROBIT_ID_RADIO, MICROBIT_RADIO_EVT_DATAGRAM, onData);
     while (1) {
         uBit.sleep(500);
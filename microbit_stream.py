@@ -0,0 +1,364 @@
+''' Library API for consuming microbit samples without the GUI.
+MicrobitStream is a ReadMicrobits configured with constructor arguments,
+see ReadMicrobits.__init__, which hands out the rows it stores as batches:
+SCAN_DTYPE numpy arrays of the rows stored from one serial read, from any of
+the microbits, in the order they were stored.
+
+Blocking, acquisition runs in a background thread:
+
+    with MicrobitStream(num_microbits=3, fake=True) as stream:
+        for batch in stream.batches():
+            ...
+
+asyncio, the serial port is read by the event loop when it has bytes and
+the polls are sent from a task, so no thread is used:
+
+    async with MicrobitStream(num_microbits=3, protocol=2) as stream:
+        async for batch in stream:
+            ...
+
+Batches wait in a queue of max_batches. When the consumer falls behind,
+overflow=DROP_OLDEST drops the oldest batch, counted in dropped, and
+overflow=BLOCK stops reading the serial port until there is room, so the
+serial port buffers the scans. The throws and catches found in the batches
+are read with stream.detector.events_since, see juggle_events.py.
+The async iterator needs a serial port with a
+fileno, as on Linux and macOS. If the receiver is unplugged, the event loop
+stops reading its port until the ConnectionManager has reopened it. '''
+
+import asyncio
+import logging
+import queue
+from read_microbits import (EMPTY_BATCH, PAUSE_SLICE, RECONNECT_WAIT,
+    REPORT_INTERVAL, SYNC_INTERVAL, ReadMicrobits)
+import threading
+from time import monotonic, monotonic_ns
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop_oldest'
+MAX_BATCHES = 64
+# how often a waiting consumer checks whether acquisition has finished
+FINISH_CHECK = 0.1
+
+
+class MicrobitStream(ReadMicrobits):
+    def __init__(self, num_microbits=3, max_batches=MAX_BATCHES, overflow=DROP_OLDEST,
+            **settings):
+        if overflow not in (BLOCK, DROP_OLDEST):
+            raise ValueError('overflow must be {} or {}'.format(BLOCK, DROP_OLDEST))
+        self.max_batches = max_batches
+        self.overflow = overflow
+        self.queue = queue.Queue(max_batches)
+        self.dropped = 0
+        self.finished = False
+        self.error = None
+        self.thread = None
+        # set when iterated with asyncio
+        self.loop = None
+        self.task = None
+        self.held = None
+        # the file descriptor the event loop is reading
+        self.reader_fd = None
+        super().__init__(num_microbits, run_main=False, dispatch=False, **settings)
+
+
+    def __enter__(self):
+        self.start()
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+    def __iter__(self):
+        return self.batches()
+
+
+    async def __aenter__(self):
+        await self.astart()
+        return self
+
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+
+    def __aiter__(self):
+        return self
+
+
+    async def __anext__(self):
+        if self.loop is None:
+            await self.astart()
+        if self.finished and self.queue.empty():
+            if self.error:
+                raise self.error
+            raise StopAsyncIteration
+        get = asyncio.ensure_future(self.queue.get())
+        finished = asyncio.ensure_future(self.finished_event.wait())
+        await asyncio.wait([get, finished], return_when=asyncio.FIRST_COMPLETED)
+        finished.cancel()
+        if not get.done():
+            get.cancel()
+            return await self.__anext__()
+        if self.held is not None:
+            # there is room again for the batch held back by BLOCK
+            self.queue.put_nowait(self.held)
+            self.held = None
+            self.resume_reading()
+        return get.result()
+
+
+    async def aclose(self):
+        ''' Stop acquisition started by astart and wait for it to finish. '''
+        ReadMicrobits.stop(self)
+        # wake the poll task if it is waiting for the consumer to catch up
+        self.reading.set()
+        if self.task:
+            await self.task
+            self.task = None
+
+
+    async def apoll(self, microbits):
+        ''' Poll the microbits from the event loop until stop is called. '''
+        scheduler = self.create_scheduler(microbits, self.rate, self.min_rate,
+            self.priority)
+        next_report = monotonic() + REPORT_INTERVAL
+        while self.running:
+            await self.reading.wait()
+            if not self.running:
+                break
+            if not self.connection.is_connected():
+                await self.await_reconnect()
+                continue
+            mb_id = scheduler.next_microbit()
+            if not await self.await_pause(scheduler.wait_time(monotonic(), mb_id)):
+                break
+            self.reply_event.clear()
+            self.waiting_for = mb_id
+            self.poll_microbit(mb_id, self.serial_port)
+            scheduler.poll_sent(monotonic(), mb_id)
+            was_healthy = scheduler.healthy(mb_id)
+            try:
+                await asyncio.wait_for(self.reply_event.wait(), scheduler.timeout(mb_id))
+                self.reply_received(mb_id, scheduler, was_healthy)
+            except asyncio.TimeoutError:
+                self.reply_timed_out(mb_id, scheduler, was_healthy)
+            self.heartbeat()
+            if monotonic() >= next_report:
+                self.report_rates()
+                next_report = monotonic() + REPORT_INTERVAL
+
+
+    async def await_pause(self, seconds):
+        ''' pause for the event loop. '''
+        end = monotonic() + seconds
+        while self.running:
+            remaining = end - monotonic()
+            if remaining <= 0:
+                return True
+            await asyncio.sleep(min(remaining, PAUSE_SLICE))
+            self.heartbeat()
+        return False
+
+
+    async def await_reconnect(self):
+        ''' wait_for_reconnect for the event loop. Stops reading the closed
+        port and reads the reopened one once the ConnectionManager has it. '''
+        self.remove_reader()
+        await asyncio.sleep(RECONNECT_WAIT)
+        if self.connection.is_connected():
+            self.reconnected(self.serial_port)
+            if self.reading.is_set():
+                self.resume_reading()
+        self.heartbeat()
+
+
+    async def astart(self):
+        ''' Connect and start acquisition on the running event loop. '''
+        if self.loop is not None:
+            return
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(self.max_batches)
+        self.reply_event = asyncio.Event()
+        self.finished_event = asyncio.Event()
+        self.reading = asyncio.Event()
+        self.waiting_for = None
+        self.Microbit_Serial_Port = self.connect()
+        if not self.Microbit_Serial_Port:
+            raise IOError('microbit not found connected to a serial port')
+        self.resume_reading()
+        microbits = list(self.df_dict)
+        if self.streaming:
+            self.task = self.loop.create_task(self.run_task(self.astream(microbits)))
+        else:
+            self.task = self.loop.create_task(self.run_task(self.apoll(microbits)))
+
+
+    async def astream(self, microbits):
+        ''' Keep the streaming time slots in sync until stop is called. '''
+        self.start_slots(self.serial_port, microbits, self.slot_ms)
+        next_report = monotonic() + REPORT_INTERVAL
+        while self.running:
+            if not self.connection.is_connected():
+                await self.await_reconnect()
+                continue
+            await asyncio.sleep(FINISH_CHECK)
+            self.heartbeat()
+            now = monotonic()
+            if now >= self.next_sync:
+                self.send_command('sync', self.serial_port)
+                self.next_sync = now + SYNC_INTERVAL
+            if now >= next_report:
+                self.report_rates()
+                next_report = now + REPORT_INTERVAL
+        self.send_command('stop', self.serial_port)
+
+
+    def batches(self, timeout=None):
+        ''' Generate batches until stop is called, starting acquisition if needed.
+        With a <timeout> in seconds, an empty batch is generated when no rows
+        arrive for that long, so the consumer can do other work. '''
+        if not self.thread:
+            self.start()
+        waited = 0.0
+        while not (self.finished and self.queue.empty()):
+            try:
+                batch = self.queue.get(timeout=FINISH_CHECK)
+            except queue.Empty:
+                waited += FINISH_CHECK
+                if timeout is not None and waited >= timeout:
+                    waited = 0.0
+                    yield EMPTY_BATCH
+                continue
+            waited = 0.0
+            yield batch
+        if self.error:
+            raise self.error
+
+
+    def on_readable(self):
+        ''' Read and process the bytes waiting at the serial port. '''
+        read_bytes = self.Microbit_Serial_Port.get_serial_data(self.serial_port)
+        if not read_bytes:
+            if not self.connection.is_connected():
+                self.remove_reader()
+            return
+        received = self.process_data(read_bytes, monotonic_ns())
+        if self.waiting_for in received:
+            self.reply_event.set()
+
+
+    def pause_reading(self):
+        ''' Stop reading the serial port until the consumer catches up. '''
+        self.remove_reader()
+        self.reading.clear()
+
+
+    def batch_stored(self, batch, now_ns):
+        ''' Detect events in the rows stored from a read and publish them as a batch. '''
+        super().batch_stored(batch, now_ns)
+        if len(batch):
+            self.publish(batch)
+
+
+    def publish(self, batch):
+        ''' Put <batch> in the queue for the consumer, applying the overflow policy. '''
+        if self.loop:
+            self.publish_async(batch)
+            return
+        if self.overflow == BLOCK:
+            while self.running:
+                try:
+                    self.queue.put(batch, timeout=FINISH_CHECK)
+                    return
+                except queue.Full:
+                    pass
+            return
+        try:
+            self.queue.put_nowait(batch)
+        except queue.Full:
+            self.drop_oldest()
+            self.queue.put_nowait(batch)
+
+
+    def publish_async(self, batch):
+        ''' publish for the event loop, which cannot wait for room in the queue. '''
+        try:
+            self.queue.put_nowait(batch)
+        except asyncio.QueueFull:
+            if self.overflow == BLOCK:
+                self.held = batch
+                self.pause_reading()
+                return
+            self.drop_oldest()
+            self.queue.put_nowait(batch)
+
+
+    def drop_oldest(self):
+        ''' Drop the oldest batch in the queue to make room. '''
+        try:
+            self.queue.get_nowait()
+        except (queue.Empty, asyncio.QueueEmpty):
+            return
+        self.dropped += 1
+        self.metrics.count('batches_dropped')
+
+
+    def remove_reader(self):
+        ''' Stop the event loop reading the serial port. '''
+        if self.reader_fd is not None:
+            self.loop.remove_reader(self.reader_fd)
+            self.reader_fd = None
+
+
+    def resume_reading(self):
+        ''' Read the serial port whenever it has bytes, once it is open. '''
+        if self.connection.is_connected():
+            self.reader_fd = self.serial_port.fileno()
+            self.loop.add_reader(self.reader_fd, self.on_readable)
+        self.reading.set()
+
+
+    def run_thread(self):
+        ''' Acquire in the background thread started by start. '''
+        try:
+            if not self.run():
+                self.error = IOError('microbit not found connected to a serial port')
+        except Exception as e:
+            logging.exception('microbit_stream: acquisition failed')
+            self.error = e
+        finally:
+            self.finished = True
+
+
+    async def run_task(self, acquire):
+        ''' Run the coroutine <acquire>, then stop reading and close. '''
+        self.next_sync = monotonic() + SYNC_INTERVAL
+        try:
+            await acquire
+        except Exception as e:
+            logging.exception('microbit_stream: acquisition failed')
+            self.error = e
+        finally:
+            self.remove_reader()
+            self.close()
+            self.finished = True
+            self.finished_event.set()
+
+
+    def start(self):
+        ''' Start acquisition in a background thread. '''
+        if self.thread:
+            return
+        self.thread = threading.Thread(target=self.run_thread, daemon=True)
+        self.thread.start()
+
+
+    def stop(self):
+        ''' Stop acquisition and wait for the background thread to close the port. '''
+        super().stop()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join()
+
@@ -0,0 +1,343 @@
+''' Reads the microbits through several receiver microbits at once.
+One receiver's serial link and radio channel limit how many scans per second
+can be read, so MultiReceiver opens every receiver microbit found, or the
+ports given, and runs a ReceiverWorker, a ReadMicrobits polling or streaming
+its share of the microbits, for each one in its own thread. The microbits are
+split into contiguous blocks of ids, one block for each receiver, and each
+microbit is only stored by the worker it is assigned to, so every RingBuffer
+still has one writer.
+Each receiver can be given its own radio group with --groups. The worker
+moves its microbits onto the group with rg_N:G, relayed while they are all
+on DEFAULT_GROUP, then moves its receiver with group:G, see
+protocol.group_commands, and moves them all back to DEFAULT_GROUP on close.
+On separate groups the receivers do not hear each other's polls and replies,
+so the total rate grows with the number of receivers. Without --groups every
+receiver hears every reply, and the scans of microbits assigned to another
+receiver are counted as unassigned_scans and dropped.
+The rows stored by all the workers are merged into one time ordered
+RingBuffer, merged, see MergedStore.
+MultiReceiver shares df_dict, trackers and clocks with its workers, so
+snapshot, export_dataframes and delivered_rates cover every microbit.
+
+python multi_receiver.py --fake --receivers 3 --groups 11,12,13 -n 12 '''
+
+import heapq
+import logging
+from read_microbits import REPORT_INTERVAL, ReadMicrobits
+from protocol import DEFAULT_GROUP, group_commands
+from ring_buffer import RingBuffer
+from serial_port import find_serial_ports
+import sys
+import threading
+from time import monotonic, sleep
+
+# how much older a row can be than the read it arrived in, protocol 2
+# batches hold samples taken up to MAX_BATCH periods before they were sent
+MAX_LATENESS_NS = 50000000
+# a receiver with no reads for this long no longer holds back the merge
+MAX_LAG_NS = 100000000
+# how often the MultiReceiver checks on its workers
+CHECK_INTERVAL = 0.1
+
+
+def assign_devices(microbits, num_receivers):
+    ''' Split <microbits> into <num_receivers> contiguous blocks, as evenly as possible. '''
+    num_microbits = len(microbits)
+    return [microbits[index * num_microbits // num_receivers:
+        (index + 1) * num_microbits // num_receivers] for index in range(num_receivers)]
+
+
+class MergedStore():
+    ''' Merges the rows from several sources into one RingBuffer in time order.
+    Each source pushes the rows from each read with the time of the read.
+    Rows wait in a heap until every source has read past their time by
+    MAX_LATENESS_NS, so no source can still push a row ahead of them. A source
+    which has not read for MAX_LAG_NS is not waited for. A row which arrives
+    after later rows were merged is stored out of order and counted in late. '''
+    def __init__(self, num_sources, capacity, max_lateness_ns=MAX_LATENESS_NS,
+            max_lag_ns=MAX_LAG_NS):
+        self.ring = RingBuffer(capacity, check_count=False)
+        self.max_lateness_ns = max_lateness_ns
+        self.max_lag_ns = max_lag_ns
+        # the time of the last read pushed by each source
+        self.progress = [None] * num_sources
+        self.heap = []
+        self.sequence = 0
+        self.last_time = None
+        self.merged = 0
+        self.late = 0
+        self.lock = threading.Lock()
+
+
+    def flush(self, everything=False):
+        ''' Store the rows no source can now come before, or all of them. '''
+        with self.lock:
+            self.store_until(None if everything else self.watermark())
+
+
+    def pending(self):
+        ''' Return how many rows are waiting to be merged. '''
+        return len(self.heap)
+
+
+    def push(self, source, rows, read_ns):
+        ''' Add the SCAN_DTYPE <rows> from a read by <source> at <read_ns>
+        and merge those which are ready. <rows> may be empty. '''
+        with self.lock:
+            for row in rows.tolist():
+                self.sequence += 1
+                heapq.heappush(self.heap, (row[0], self.sequence, row))
+            self.progress[source] = read_ns
+            self.store_until(self.watermark())
+
+
+    def snapshot(self, num_rows=None, column=None, copy=False):
+        ''' Return a consistent read only view, or copy, of the last <num_rows>
+        merged rows, see RingBuffer.snapshot. '''
+        return self.ring.snapshot(num_rows, column, copy)
+
+
+    def store_until(self, limit):
+        ''' Move the rows up to time <limit> from the heap to the ring, None moves all. '''
+        heap = self.heap
+        while heap and (limit is None or heap[0][0] <= limit):
+            time, _, row = heapq.heappop(heap)
+            if self.last_time is not None and time < self.last_time:
+                self.late += 1
+            else:
+                self.last_time = time
+            self.ring.append(row)
+            self.merged += 1
+
+
+    def watermark(self):
+        ''' Return the time up to which the rows are ready to merge. '''
+        progress = [read_ns for read_ns in self.progress if read_ns is not None]
+        if not progress:
+            return None
+        newest = max(progress)
+        return min(read_ns for read_ns in progress
+            if read_ns >= newest - self.max_lag_ns) - self.max_lateness_ns
+
+
+class ReceiverWorker(ReadMicrobits):
+    ''' Polls or streams the <microbits> assigned to one receiver microbit on
+    <port>, optionally moving them to radio <group> first. '''
+    def __init__(self, receiver, index, port, microbits, group=None):
+        self.receiver = receiver
+        self.index = index
+        self.assigned = list(microbits)
+        self.group = group
+        self.connected = False
+        super().__init__(receiver.num_microbits, run_main=False, dispatch=False,
+            port=port, rate=receiver.rate, min_rate=receiver.min_rate,
+            priority=receiver.priority, protocol=receiver.protocol_version,
+            stream=receiver.streaming, slot_ms=receiver.slot_ms,
+            ring_rows=receiver.ring_rows)
+        # each microbit is only detected by one worker, so they can share the state
+        self.detector = receiver.detector
+        self.history = receiver.history
+        self.spectrum = receiver.spectrum
+        self.aligner = receiver.aligner
+
+
+    def close(self):
+        ''' Move the microbits back to DEFAULT_GROUP and close the serial port.
+        The recorder belongs to the MultiReceiver. '''
+        if self.serial_port and self.group is not None:
+            self.set_group(DEFAULT_GROUP)
+        self.recorder = None
+        super().close()
+
+
+    def connect(self):
+        ''' Open the serial port, move to the radio group and share the recorder. '''
+        Microbit_Serial_Port = super().connect()
+        if not Microbit_Serial_Port:
+            return
+        if self.group is not None:
+            self.set_group(self.group)
+        self.recorder = self.receiver.recorder
+        return Microbit_Serial_Port
+
+
+    def create_devices(self, num_microbits):
+        ''' Share the RingBuffer, SequenceTracker and ClockEstimator of the
+        microbits assigned to this receiver with the MultiReceiver. '''
+        self.num_microbits = num_microbits
+        self.df_dict = {mb: self.receiver.df_dict[mb] for mb in self.assigned}
+        self.trackers = {mb: self.receiver.trackers[mb] for mb in self.assigned}
+        self.clocks = {mb: self.receiver.clocks[mb] for mb in self.assigned}
+        self.route_devices()
+
+
+    def batch_stored(self, batch, now_ns):
+        ''' Detect events in the rows stored from a read and pass them to the MergedStore. '''
+        super().batch_stored(batch, now_ns)
+        self.receiver.merged.push(self.index, batch, now_ns)
+
+
+    def reconnected(self, serial_port):
+        ''' Move the receiver back onto its radio group after it was unplugged. '''
+        super().reconnected(serial_port)
+        if self.group is not None:
+            self.set_group(self.group)
+
+
+    def report_rates(self):
+        ''' Log which receiver the rates and metrics that follow are for. '''
+        logging.info('receiver {} on {} group {}'.format(self.index, self.port,
+            DEFAULT_GROUP if self.group is None else self.group))
+        super().report_rates()
+
+
+    def route_devices(self):
+        ''' Index the assigned microbits by integer id, with None for the
+        microbits assigned to other receivers. '''
+        self.devices = [None] * self.num_microbits
+        for ident, mb in enumerate(self.receiver.df_dict):
+            if mb in self.df_dict:
+                self.devices[ident] = (mb, self.df_dict[mb], self.trackers[mb],
+                    self.clocks[mb])
+
+
+    def run(self):
+        ''' Poll or stream until stop is called. Returns False if the receiver
+        could not be opened. '''
+        self.connected = super().run()
+        if not self.connected:
+            logging.info('*** receiver {} not found on {}'.format(self.index, self.port))
+        return self.connected
+
+
+    def set_group(self, group):
+        ''' Move the assigned microbits and then the receiver onto radio <group>. '''
+        for command in group_commands(self.assigned, group):
+            self.send_command(command, self.serial_port)
+
+
+
+class MultiReceiver(ReadMicrobits):
+    def __init__(self, num_microbits=3, run_main=True, ports=None, groups=None,
+            receivers=1, merged_rows=None, **settings):
+        ''' <ports> are the serial ports of the receiver microbits, None opens
+        every microbit found, or <receivers> simulated receivers with fake=True.
+        <groups> is the radio group of each receiver in turn, None leaves a
+        receiver on DEFAULT_GROUP.
+        <merged_rows> is the capacity of merged, by default ring_rows for each microbit.
+        <settings> are those of ReadMicrobits, for every receiver. '''
+        self.ports = ports
+        self.groups = groups
+        self.num_receivers = receivers
+        self.merged_rows = merged_rows
+        self.workers = []
+        self.merged = None
+        super().__init__(num_microbits, run_main=run_main, dispatch=False, **settings)
+
+
+    def create_option_parser(self):
+        ''' Add the receiver options to those of ReadMicrobits. '''
+        parser = super().create_option_parser()
+        parser.add_option('--ports', default=None,
+                    help='Comma separated serial ports of the receivers, '
+                    'instead of opening every microbit found')
+        parser.add_option('--groups', default=None,
+                    help='Comma separated radio group of each receiver')
+        parser.add_option('--receivers', type='int', default=1,
+                    help='Number of receivers to simulate with --fake')
+        return parser
+
+
+    def device_counters(self):
+        ''' Return the loss counters of every microbit, with the timeouts
+        counted by the scheduler of the worker it is assigned to. '''
+        counters = {}
+        for worker in self.workers:
+            counters.update(worker.device_counters())
+        return counters
+
+
+    def main(self):
+        ''' Take the receiver options from the command line, then as ReadMicrobits. '''
+        (options, args) = self.create_option_parser().parse_args()
+        if options.ports:
+            self.ports = options.ports.split(',')
+        if options.groups:
+            self.groups = [int(group) for group in options.groups.split(',')]
+        self.num_receivers = options.receivers
+        super().main()
+
+
+    def open_receivers(self):
+        ''' Return the serial ports of the receivers, starting the fake
+        microbits if asked for. '''
+        if self.fake:
+            print('Fake microbit option detected')
+            import fake_microbits
+            self.fake_microbits = fake_microbits.FakeMicrobits(self.num_microbits,
+                receivers=self.num_receivers, **self.fake_options)
+            self.fake_microbits.start()
+            return self.fake_microbits.ports
+        if self.ports:
+            return self.ports
+        ports = find_serial_ports()
+        logging.info('{} receivers found'.format(len(ports)))
+        return ports
+
+
+    def report_rates(self):
+        ''' Log the total rate and the state of the MergedStore. '''
+        total = sum(self.delivered_rates().values())
+        logging.info('{} receivers {:0.1f} scans/s merged: {} late: {} pending: {}'.format(
+            len(self.workers), total, self.merged.merged, self.merged.late,
+            self.merged.pending()))
+
+
+    def run(self):
+        ''' Run a ReceiverWorker for each receiver until stop is called, then close.
+        Returns False if no receiver is connected. '''
+        ports = self.open_receivers()
+        if not ports:
+            self.close()
+            return False
+        groups = self.groups or []
+        assignment = assign_devices(list(self.df_dict), len(ports))
+        self.merged = MergedStore(len(ports),
+            self.merged_rows or self.ring_rows * self.num_microbits)
+        if self.out:
+            from recorder import SessionRecorder
+            self.recorder = SessionRecorder(self.out)
+        self.workers = [ReceiverWorker(self, index, port, microbits,
+            groups[index] if index < len(groups) else None)
+            for index, (port, microbits) in enumerate(zip(ports, assignment))]
+        for worker in self.workers:
+            print('receiver {}: {} microbits: {}'.format(worker.index, worker.port,
+                worker.assigned))
+        threads = [threading.Thread(target=worker.run, daemon=True)
+            for worker in self.workers]
+        for thread in threads:
+            thread.start()
+        next_report = monotonic() + REPORT_INTERVAL
+        try:
+            while self.running and any(thread.is_alive() for thread in threads):
+                sleep(CHECK_INTERVAL)
+                self.merged.flush()
+                self.heartbeat()
+                if monotonic() >= next_report:
+                    self.report_rates()
+                    next_report = monotonic() + REPORT_INTERVAL
+        finally:
+            for worker in self.workers:
+                worker.stop()
+            for thread in threads:
+                thread.join()
+            self.merged.flush(everything=True)
+            self.close()
+        return any(worker.connected for worker in self.workers)
+
+
+if __name__ == '__main__':
+    try:
+        MultiReceiver()
+    except KeyboardInterrupt:
+        sys.exit(0)
@@ -0,0 +1,171 @@
+''' Decides which microbit to poll next and how long to wait for its reply.
+The next poll is sent as soon as the reply to the current one is parsed,
+or when the reply timeout for that microbit expires.
+The timeout is derived from the measured round trip times for each microbit,
+in the same way as a TCP retransmission timeout: srtt + 4 * rttvar.
+An optional target rate limits how fast each microbit is polled.
+
+The health of each microbit is tracked as a smoothed success rate and a run
+of consecutive timeouts. After FAIL_THRESHOLD timeouts in a row a microbit is
+unresponsive, out of range or with a flat battery, and is only probed after
+a backoff which doubles from BACKOFF_MIN up to BACKOFF_MAX, so it does not
+cost a timeout every round. A reply makes it healthy again.
+Healthy microbits are polled longest waiting first, which is round robin when
+they are all treated the same. Microbits given a minimum rate are polled
+first whenever they fall behind it. With a priority gain, microbits showing
+more acceleration variance than the others, a ball in flight, are polled
+more often. '''
+
+from time import monotonic
+
+# weights for the smoothed round trip time and its variation
+RTT_ALPHA = 0.125
+RTT_BETA = 0.25
+# bounds on the reply timeout in seconds
+MIN_TIMEOUT = 0.005
+MAX_TIMEOUT = 0.5
+# timeout for a microbit which has never replied, after its first poll timed out
+PROBE_TIMEOUT = 0.05
+# weight of each poll in the smoothed success rate
+SUCCESS_ALPHA = 0.1
+# consecutive timeouts before a microbit is treated as unresponsive
+FAIL_THRESHOLD = 3
+# bounds on the time between probes of an unresponsive microbit in seconds
+BACKOFF_MIN = 0.1
+BACKOFF_MAX = 5.0
+
+
+class PollScheduler():
+    def __init__(self, microbits, target_rate=None,
+            min_timeout=MIN_TIMEOUT, max_timeout=MAX_TIMEOUT,
+            min_rates=None, priority_gain=0.0):
+        self.microbits = list(microbits)
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.srtt = {mb_id: None for mb_id in self.microbits}
+        self.rttvar = {mb_id: 0.0 for mb_id in self.microbits}
+        self.timeouts = {mb_id: 0 for mb_id in self.microbits}
+        self.replies = {mb_id: 0 for mb_id in self.microbits}
+        self.success_rate = {mb_id: 1.0 for mb_id in self.microbits}
+        self.failures = {mb_id: 0 for mb_id in self.microbits}
+        self.backoff = {mb_id: 0.0 for mb_id in self.microbits}
+        self.next_probe = {mb_id: 0.0 for mb_id in self.microbits}
+        self.last_polled = {mb_id: None for mb_id in self.microbits}
+        self.activity = {mb_id: 0.0 for mb_id in self.microbits}
+        # {mb_id: polls per second} to keep to while a microbit is healthy
+        self.min_rates = dict(min_rates or {})
+        self.priority_gain = priority_gain
+        self.last_poll_time = None
+        self.set_target_rate(target_rate)
+
+
+    def healthy(self, mb_id):
+        ''' Return False if <mb_id> has stopped replying. '''
+        return self.failures[mb_id] < FAIL_THRESHOLD
+
+
+    def next_microbit(self, now=None):
+        ''' Return the id of the next microbit to poll. '''
+        if now is None:
+            now = monotonic()
+        candidates = [mb_id for mb_id in self.microbits
+            if self.healthy(mb_id) or now >= self.next_probe[mb_id]]
+        if not candidates:
+            # all backing off, wait_time waits for the first probe to be due
+            return min(self.microbits, key=self.next_probe.get)
+        waited = {mb_id: self.waiting(mb_id, now) for mb_id in candidates}
+        behind = [mb_id for mb_id in candidates if mb_id in self.min_rates
+            and waited[mb_id] * self.min_rates[mb_id] >= 1.0]
+        if behind:
+            return max(behind, key=lambda mb_id: waited[mb_id] * self.min_rates[mb_id])
+        if self.priority_gain:
+            mean_activity = sum(self.activity.values()) / len(self.activity)
+            if mean_activity > 0:
+                return max(candidates, key=lambda mb_id: waited[mb_id] * (1.0
+                    + self.priority_gain * self.activity[mb_id] / mean_activity))
+        return max(candidates, key=waited.get)
+
+
+    def poll_sent(self, now, mb_id=None):
+        ''' Record the time that a poll was written to <mb_id>. '''
+        self.last_poll_time = now
+        if mb_id is not None:
+            self.last_polled[mb_id] = now
+
+
+    def reply_received(self, mb_id, now):
+        ''' Update the round trip time estimate for <mb_id> with a reply at <now>.
+        Returns the round trip time. '''
+        rtt = now - self.last_poll_time
+        self.replies[mb_id] += 1
+        self.success_rate[mb_id] += SUCCESS_ALPHA * (1.0 - self.success_rate[mb_id])
+        self.failures[mb_id] = 0
+        self.backoff[mb_id] = 0.0
+        srtt = self.srtt[mb_id]
+        if srtt is None:
+            self.srtt[mb_id] = rtt
+            self.rttvar[mb_id] = rtt / 2
+            return rtt
+        self.rttvar[mb_id] = (1 - RTT_BETA) * self.rttvar[mb_id] + RTT_BETA * abs(srtt - rtt)
+        self.srtt[mb_id] = (1 - RTT_ALPHA) * srtt + RTT_ALPHA * rtt
+        return rtt
+
+
+    def reply_timed_out(self, mb_id, now=None):
+        ''' Record a poll to <mb_id> that had no reply.
+        Returns True if <mb_id> has just become unresponsive. '''
+        if now is None:
+            now = monotonic()
+        self.timeouts[mb_id] += 1
+        self.success_rate[mb_id] -= SUCCESS_ALPHA * self.success_rate[mb_id]
+        self.failures[mb_id] += 1
+        if self.healthy(mb_id):
+            return False
+        self.backoff[mb_id] = min(max(2 * self.backoff[mb_id], BACKOFF_MIN), BACKOFF_MAX)
+        self.next_probe[mb_id] = now + self.backoff[mb_id]
+        return self.failures[mb_id] == FAIL_THRESHOLD
+
+
+    def set_activity(self, mb_id, activity):
+        ''' Set how active <mb_id> is, e.g. its recent acceleration variance. '''
+        self.activity[mb_id] = activity
+
+
+    def set_target_rate(self, target_rate):
+        ''' Set the target number of polls per second for each microbit.
+        None or 0 polls as fast as the replies arrive. '''
+        self.target_rate = target_rate
+        if target_rate:
+            self.min_interval = 1.0 / (target_rate * len(self.microbits))
+        else:
+            self.min_interval = 0.0
+
+
+    def timeout(self, mb_id):
+        ''' Return how long to wait for a reply from <mb_id> in seconds. '''
+        srtt = self.srtt[mb_id]
+        if srtt is None:
+            if self.failures[mb_id]:
+                return min(PROBE_TIMEOUT, self.max_timeout)
+            return self.max_timeout
+        timeout = srtt + 4 * self.rttvar[mb_id]
+        return min(max(timeout, self.min_timeout), self.max_timeout)
+
+
+    def wait_time(self, now, mb_id=None):
+        ''' Return how long to wait before polling <mb_id>, to keep to the
+        target rate and to the backoff of an unresponsive microbit. '''
+        wait = 0.0
+        if self.last_poll_time is not None:
+            wait = self.last_poll_time + self.min_interval - now
+        if mb_id is not None and not self.healthy(mb_id):
+            wait = max(wait, self.next_probe[mb_id] - now)
+        return max(0.0, wait)
+
+
+    def waiting(self, mb_id, now):
+        ''' Return how long <mb_id> has waited since its last poll. '''
+        last_polled = self.last_polled[mb_id]
+        if last_polled is None:
+            return float('inf')
+        return now - last_polled
@@ -0,0 +1,161 @@
+''' Binary radio and serial protocol, version 2.
+Version 1 is the ASCII scan ST,id,count,x_acc,y_acc,z_acc,EN with one sample
+per poll. Version 2 sends a batch of samples per poll in a fixed width little
+endian frame, which fits in one 32 byte microbit radio packet:
+
+offset size field
+0      2    MAGIC_V2, bytes that never appear in a version 1 scan
+2      1    version, 2
+3      1    id of the transmitter
+4      2    seq, frame sequence number, uint16
+6      2    count of the first sample, uint16, the others follow on by 1
+8      1    n, number of samples in the batch, 1 to MAX_BATCH
+9      6n   x_acc, y_acc, z_acc for each sample, int16
+9+6n   2    checksum, uint16 sum of bytes 2 to 8+6n
+
+A transmitter is asked for version 2 by polling mb_N:2 instead of mb_N.
+rg_N:G moves transmitter N to radio group G and group:G moves the receiver
+it is written to, see group_commands.
+decode_frames decodes every frame in a buffer at once with numpy, and
+works out mag_acc for all the samples together with magnitude. '''
+
+import struct
+
+import numpy as np
+
+MAGIC_V2 = b'\xaa\x55'
+VERSION_V2 = 2
+POLL_V2_SUFFIX = ':2'
+HEADER_V2 = struct.Struct('<2sBBHHB')
+CHECKSUM_V2 = struct.Struct('<H')
+SAMPLE_V2 = struct.Struct('<hhh')
+# radio group the firmware starts on
+DEFAULT_GROUP = 10
+# largest batch which fits in a 32 byte radio packet
+MAX_BATCH = 3
+SAMPLE_DTYPE = np.dtype([('id', 'i4'), ('count', 'i4'),
+    ('x_acc', 'i4'), ('y_acc', 'i4'), ('z_acc', 'i4'), ('mag_acc', 'i4')])
+
+
+def checksum(data):
+    ''' Return the version 2 checksum of <data>. '''
+    return sum(data) & 0xffff
+
+
+def magnitude(x_acc, y_acc, z_acc):
+    ''' Return the int magnitudes of arrays of x, y and z acceleration,
+    rounded down like ReadMicrobits.calc_mag. '''
+    x_acc, y_acc, z_acc = (np.asarray(a, dtype=np.float64) for a in (x_acc, y_acc, z_acc))
+    return np.sqrt(x_acc * x_acc + y_acc * y_acc + z_acc * z_acc).astype(np.int32)
+
+
+def encode_frame(ident, seq, first_count, samples):
+    ''' Return a version 2 frame for a list of (x_acc, y_acc, z_acc) samples. '''
+    if not 0 < len(samples) <= MAX_BATCH:
+        raise ValueError('batch must have 1 to {} samples'.format(MAX_BATCH))
+    frame = bytearray(HEADER_V2.pack(MAGIC_V2, VERSION_V2, ident,
+        seq & 0xffff, first_count & 0xffff, len(samples)))
+    for sample in samples:
+        frame += SAMPLE_V2.pack(*sample)
+    frame += CHECKSUM_V2.pack(checksum(frame[len(MAGIC_V2):]))
+    return bytes(frame)
+
+
+def frame_length(num_samples):
+    ''' Return the length in bytes of a frame holding <num_samples>. '''
+    return HEADER_V2.size + num_samples * SAMPLE_V2.size + CHECKSUM_V2.size
+
+
+def partial_magic(data):
+    ''' Return how many bytes at the end of <data> could start a frame. '''
+    start = MAGIC_V2 + bytes([VERSION_V2])
+    for keep in (3, 2, 1):
+        if len(data) >= keep and bytes(data[-keep:]) == start[:keep]:
+            return keep
+    return 0
+
+
+def poll_string(mb_id, version=1):
+    ''' Return the poll for <mb_id> asking for protocol <version>. '''
+    if version == VERSION_V2:
+        return mb_id + POLL_V2_SUFFIX
+    return mb_id
+
+
+def group_commands(mb_ids, group):
+    ''' Return the commands which move the transmitters <mb_ids>, then the
+    receiver they are written to, onto radio <group>. '''
+    commands = ['rg_{}:{}'.format(mb_id[len('mb_'):], group) for mb_id in mb_ids]
+    commands.append('group:{}'.format(group))
+    return commands
+
+
+def decode_frames(buffer):
+    ''' Decode all the version 2 frames in <buffer>.
+    Returns (samples, consumed, bad_frames):
+    samples is a SAMPLE_DTYPE array, one row per sample, in buffer order
+    consumed is the number of bytes from the front of buffer which are done
+    with, the rest may be the start of a frame completed by a later read
+    bad_frames counts frame starts which failed the checksum '''
+    data = np.frombuffer(bytes(buffer), dtype=np.uint8)
+    length = len(data)
+    empty = np.zeros(0, dtype=SAMPLE_DTYPE)
+    if length < len(MAGIC_V2) + 1:
+        return empty, 0, 0
+    starts = np.flatnonzero((data[:-2] == MAGIC_V2[0]) & (data[1:-1] == MAGIC_V2[1])
+        & (data[2:] == VERSION_V2))
+    if not len(starts):
+        return empty, length - partial_magic(data), 0
+    num = np.zeros(len(starts), dtype=np.int64)
+    has_header = starts + HEADER_V2.size <= length
+    num[has_header] = data[starts[has_header] + HEADER_V2.size - 1]
+    ends = starts + HEADER_V2.size + SAMPLE_V2.size * num + CHECKSUM_V2.size
+    complete = has_header & (ends <= length)
+    sane = (num >= 1) & (num <= MAX_BATCH)
+    # sum of bytes 2 to end-3 of each frame from a running total
+    totals = np.concatenate(([0], np.cumsum(data, dtype=np.int64)))
+    valid = complete & sane
+    sums = np.zeros(len(starts), dtype=np.int64)
+    stored = np.zeros(len(starts), dtype=np.int64)
+    sums[valid] = (totals[ends[valid] - 2] - totals[starts[valid] + 2]) & 0xffff
+    stored[valid] = (data[ends[valid] - 2].astype(np.int64)
+        | (data[ends[valid] - 1].astype(np.int64) << 8))
+    good = valid & (sums == stored)
+    bad_frames = int(np.count_nonzero(valid & ~good))
+    # frames cannot overlap, a magic inside a good frame is payload
+    selected = []
+    next_free = 0
+    for i in np.flatnonzero(good):
+        if starts[i] >= next_free:
+            selected.append(i)
+            next_free = ends[i]
+    # an incomplete frame after the last good one waits for more bytes
+    pending = np.flatnonzero(~complete & (starts >= next_free) & (sane | ~has_header))
+    if len(pending):
+        consumed = int(starts[pending[0]])
+    else:
+        consumed = max(next_free, length - partial_magic(data))
+    if not selected:
+        return empty, int(consumed), bad_frames
+    selected = np.array(selected)
+    frame_starts = starts[selected]
+    frame_num = num[selected]
+    idents = data[frame_starts + 3].astype(np.int32)
+    first_counts = (data[frame_starts + 6].astype(np.int32)
+        | (data[frame_starts + 7].astype(np.int32) << 8))
+    # one entry per sample: its frame and its position in the batch
+    frame_of_sample = np.repeat(np.arange(len(selected)), frame_num)
+    position = np.arange(len(frame_of_sample)) - np.repeat(
+        np.cumsum(frame_num) - frame_num, frame_num)
+    sample_offsets = (frame_starts[frame_of_sample] + HEADER_V2.size
+        + SAMPLE_V2.size * position)
+    byte_index = sample_offsets[:, None] + np.arange(SAMPLE_V2.size)
+    values = data[byte_index].copy().view('<i2').astype(np.int32)
+    samples = np.empty(len(frame_of_sample), dtype=SAMPLE_DTYPE)
+    samples['id'] = idents[frame_of_sample]
+    samples['count'] = (first_counts[frame_of_sample] + position) & 0xffff
+    samples['x_acc'] = values[:, 0]
+    samples['y_acc'] = values[:, 1]
+    samples['z_acc'] = values[:, 2]
+    samples['mag_acc'] = magnitude(values[:, 0], values[:, 1], values[:, 2])
+    return samples, int(consumed), bad_frames
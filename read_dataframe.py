@@ -11,10 +11,13 @@ Pandas dataframe row format is:
 dispatcher message is of format:
 microbit dataframe, number of scans
 
+get_mag_acc also takes the path of a session log or recording, and reads
+only its last scans, see session_analysis.tail, so it works on files too
+large to load.
+
 Matthew Oppenheim May 2108'''
 
 from io import StringIO
-import pandas as pd
 from pydispatch import dispatcher
 
 
@@ -39,9 +42,6 @@ TEST_DATA = StringIO("""2018-05-14 16:26:22.465195,1,30,-240,336,240,477
 2018-05-14 16:26:36.415481,1,45,432,352,-224,600
 2018-05-14 16:26:37.346161,1,46,-2032,352,-656,2164""")
 
-dispatcher.connect(dispatcher_receive, signal='get_data', sender='main')
-
-
 def dispatcher_receive(message):
     ''' Handle dispatcher message. '''
     # message is of form microbit dataframe, number of scans to extract
@@ -54,13 +54,27 @@ def dispatcher_send(message_txt, signal, sender):
     dispatcher.send(signal=signal, message=message_txt, sender=sender)
 
 
-def get_mag_acc(df, scans):
-    ''' Return the last <scans> of mag_acc from df. '''
-    mag_acc = df.loc[df.index[-scans:],'mag_acc'].values.tolist()
+def get_mag_acc(df, scans, ident=None):
+    ''' Return the last <scans> of mag_acc from df, a DataFrame or the path
+    of a session log or recording, of microbit <ident> if given. '''
+    if isinstance(df, str):
+        from session_analysis import tail
+        mag_acc = tail(df, scans, ident)['mag_acc'].tolist()
+    else:
+        if ident is not None:
+            df = df[df['id'] == ident]
+        mag_acc = df.loc[df.index[-scans:],'mag_acc'].values.tolist()
     dispatcher_send(mag_acc, signal='mag_acc_list', sender='read_dataframe')
+    return mag_acc
+
+
+# connected once dispatcher_receive is defined
+dispatcher.connect(dispatcher_receive, signal='get_data', sender='main')
 
 
 if __name__ == '__main__':
+    # pandas is slow to import and only needed to build the test DataFrame
+    import pandas as pd
     scans = 5
     test_df = pd.read_csv(TEST_DATA, header=None, index_col=0,
         names=DF_COL_NAMES)
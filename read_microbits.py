@@ -7,40 +7,56 @@ The transmitter microbit passes this data back through the USB port.
 
 input: ManagedStrings from microbit
 format: ST,count,x_acc,y_acc,z_acc,adc, EN
+or with --protocol 2, binary frames holding a batch of samples, see protocol.py
 output: parse and display the accelerometer data for each microbit
-Uses a pandas dataframe for storing data for each microbit
-Incoming scans from the microbit are parsed to a one row dataframe
-for each scan
-These scan dataframes are reconfigured and added to the microbit dataframe
-For a single microbit, we can tack partial scans together.
-with multiple microbits, we don't know where the partial scans come from
-So we can only parse complete scans
+Uses a preallocated numpy RingBuffer for storing data for each microbit
+Bytes from the serial port are fed to a ScanFramer, see scan_framer.py,
+which returns every complete scan
+Each scan is parsed to a row tuple and appended to its RingBuffer in O(1)
+The rows stored from each serial read are passed on by batch_stored
 optparse used for argument parsing as this works with the notebook as well as scripts '''
 
 
 from datetime import datetime
-from pydispatch import dispatcher
 import logging
 import math
-from serial_port import SerialPort
 import numpy as np
-from optparse import OptionParser
+from alignment import Aligner
+from clock_sync import ClockEstimator
+from connection_manager import ConnectionManager
+from history import History
+from juggle_events import EventDetector
+from metrics import Metrics
+from poll_scheduler import PollScheduler
+from protocol import poll_string
+from ring_buffer import SCAN_DTYPE, RingBuffer
+from scan_framer import ScanFramer
+from sequence_tracker import SequenceTracker
+from spectrum import Spectrum
 import sys
-from serial_port import SerialPort
-from time import sleep
-import pandas as pd
-import pathlib
+from time import monotonic, monotonic_ns, perf_counter_ns, sleep
 
 
 BAUD = 115200
 DF_COL_NAMES = ['time', 'id', 'count', 'x_acc', 'y_acc', 'z_acc', 'mag_acc']
-# The time between data scans. Sample frequency = 1/(num_microbits * SCAN_DELAY)
 END_SCAN = 'EN'
 MAX_ROWS = 100
-OUT_FILEPATH = '/home/matthew/data/documents/infolab21/progs/jupyter_notebooks/microbit/out_data.txt'
+# samples of mag_acc the activity of a microbit is measured over for --priority
+ACTIVITY_SAMPLES = 20
 PID_MICROBIT = 516
+# how often to report the delivered rate and metrics and resync the streaming time slots
+REPORT_INTERVAL = 5.0
+SYNC_INTERVAL = 5.0
+# default streaming time slot length in ms
+SLOT_MS = 5
+# how long the loops wait at a time for a lost receiver to be reopened
+RECONNECT_WAIT = 0.1
+# longest the polling loop sleeps at a time, so the heartbeat is kept and stop is seen
+PAUSE_SLICE = 0.1
+# The longest time to wait for the reply to a poll.
 SCAN_DELAY = 0.5
 SCAN_COL_NAMES = ['id', 'count', 'x_acc', 'y_acc', 'z_acc']
+EMPTY_BATCH = np.zeros(0, dtype=SCAN_DTYPE)
 START_SCAN = 'ST'
 VID_MICROBIT = 3368
 
@@ -55,28 +71,64 @@ def system_exit(message):
 
 
 class ReadMicrobits():
-    def __init__(self, num_microbits=3):
+    def __init__(self, num_microbits=3, run_main=True, dispatch=True, ring_rows=MAX_ROWS,
+            **settings):
+        ''' <ring_rows> is the capacity of the RingBuffer of each microbit,
+        at least the number of samples the display draws.
+        <settings> are the keyword arguments of configure:
+        port: serial port to open, None scans for a microbit
+        fake: poll a FakeMicrobits simulator instead
+        fake_options: keyword arguments for FakeMicrobits, e.g. loss
+        rate: target scans per second for each microbit, None as fast as possible
+        min_rate: minimum polls per second for each responsive microbit
+        priority: poll priority given to microbits with more acceleration variance
+        protocol: 1 ASCII or 2 binary
+        stream: microbits send in time slots instead of being polled
+        slot_ms: streaming time slot length in ms
+        out: directory to record the scans to
+        run_main=True runs main, which takes the settings from the command line.
+        Otherwise call run, in a thread of the caller's choice, to use <settings>.
+        dispatch=True answers request_data signals from pydispatch. '''
         logging.info(' **** {} started ****'.format(self.now_time()))
-        self.num_microbits = num_microbits
-        logging.info('logging {} microbits'.format(self.num_microbits))
-        dispatcher.connect(self.dispatcher_receive_data_request,
-            signal='request_data', sender='main')
-        self.main()
-
-
-    def calc_mag(self, df_scan):
-        ''' calculate mag_acc from x, y, z acceleration in df_scan '''
-        mag_acc = int(math.sqrt(df_scan['x_acc']**2 +
-            df_scan['y_acc']**2 + df_scan['z_acc']**2))
+        self.running = True
+        # a SessionRecorder when scans are being recorded to disk
+        self.recorder = None
+        self.serial_port = None
+        # the ConnectionManager which opened serial_port
+        self.connection = None
+        self.fake_microbits = None
+        self.ring_rows = ring_rows
+        self.configure(**settings)
+        self.create_devices(num_microbits)
+        self.framer = ScanFramer()
+        self.metrics = Metrics()
+        # rows stored from the serial read being processed
+        self.rows = []
+        self.detector = EventDetector(num_microbits)
+        self.history = History()
+        self.spectrum = Spectrum(num_microbits)
+        self.aligner = Aligner(num_microbits)
+        # the PollScheduler while polling, for the timeout counts
+        self.scheduler = None
+        # the options parsed by main
+        self.options = None
+        if dispatch:
+            self.connect_dispatcher()
+        if run_main:
+            self.main()
+
+
+    def calc_mag(self, x_acc, y_acc, z_acc):
+        ''' calculate mag_acc from x, y, z acceleration '''
+        mag_acc = int(math.sqrt(x_acc**2 + y_acc**2 + z_acc**2))
         return mag_acc
 
 
-    def check_for_duplicate_counts(self, df_scan, df_dict):
-        ''' flag if there are any duplicates in the count column '''
-        # print('df_scan[\'count\']:{}'.format(df_scan['count'].values[0]))
-        if df_scan['count'].values[0] in set(df_dict['count']):
+    def check_for_duplicate_counts(self, scan_row, ring):
+        ''' flag if scan_row repeats the last count stored in ring '''
+        if scan_row[2] == ring.last_count:
             print('found replicated count: {} id: {}'.format(
-                df_scan['count'].values[0], df_scan['id'].values[0]))
+                scan_row[2], scan_row[1]))
 
 
     def create_blank_scan(self, ident):
@@ -90,54 +142,67 @@ class ReadMicrobits():
         return blank_scan
 
 
+    def create_devices(self, num_microbits):
+        ''' Create the RingBuffer, SequenceTracker and ClockEstimator of each microbit. '''
+        self.num_microbits = num_microbits
+        logging.info('logging {} microbits'.format(self.num_microbits))
+        # df_dict is a dict of RingBuffers, one for each microbit, in id order
+        self.df_dict = self.create_df_dict()
+        self.trackers = {mb: SequenceTracker() for mb in self.df_dict}
+        self.clocks = {mb: ClockEstimator() for mb in self.df_dict}
+        self.route_devices()
+
+
+    def route_devices(self):
+        ''' Index the state of each microbit by its integer id, so store_scan
+        finds it without building the mb_N name for every scan. '''
+        self.devices = [(mb, self.df_dict[mb], self.trackers[mb], self.clocks[mb])
+            for mb in self.df_dict]
+
+
     def create_df_dict(self):
-        ''' create a dictionary of dataframes to store the microbit data '''
+        ''' create a dictionary of RingBuffers to store the microbit data '''
         mb_names = ['mb_{}'.format(id_x) for id_x in range(self.num_microbits)]
-        df_dict = {name: pd.DataFrame(columns=DF_COL_NAMES) for name in mb_names}
-        for mb_id in df_dict.keys():
-            df_dict[mb_id] = df_dict[mb_id].set_index('time')
-            # df_mb = df_mb.set_index('time')
+        df_dict = {name: RingBuffer(self.ring_rows) for name in mb_names}
         return df_dict
 
 
-    def create_df_scan(self, scan, now_time):
-        ''' create a df_scan '''
-        df_scan = self.unpack_scan(scan)
-        if df_scan.empty:
+    def create_scan_row(self, scan, now_ns):
+        ''' create a row tuple in the DF_COL_NAMES order from scan
+        scan is a version 1 str or a version 2 tuple decoded by the framer
+        now_ns is the time.monotonic_ns the scan was read at '''
+        if isinstance(scan, tuple):
+            # version 2 samples have mag_acc worked out for the whole read
+            return (now_ns,) + scan
+        values = self.unpack_scan(scan)
+        if not values:
             return
-        df_scan['mag_acc'] = self.calc_mag(df_scan)
-        df_scan['time'] = self.timestring(now_time)
-        df_scan = df_scan.set_index('time')
-        return df_scan
-
-
-    def create_multi_scans_dict(self):
-        ''' create multi_scans lists for keeping scan fragments for each microbit '''
-        mb_names = ['mb_{}'.format(id_x) for id_x in range(self.num_microbits)]
-        multi_scans_dict = {name:'' for name in mb_names}
-        print('multi_scans_dict created: {}'.format(multi_scans_dict))
-        return multi_scans_dict
+        ident, count, x_acc, y_acc, z_acc = values
+        mag_acc = self.calc_mag(x_acc, y_acc, z_acc)
+        return (now_ns, ident, count, x_acc, y_acc, z_acc, mag_acc)
 
 
     def create_dispatcher_data(self, num_samples=MAX_ROWS):
         ''' Assemble the data to be dispatched and plotted in main.py. '''
-        # Return a dict {mb_id: np array of scans}
+        # Return a dict {mb_id: np array of mag_acc}
         plot_data = {}
         for mb in self.df_dict.keys():
-            idx = num_samples
-            df = self.df_dict[mb]
-            len_df = len(df)
-            if len_df < num_samples:
-                idx  = len_df
-
-            # Get the mag_acc column for the last num_samples.
-            plot_data[mb] = df['mag_acc'].tail(idx).values.tolist()
-            # logging.info('mb: {} df: {}'.format(mb, df))
+            # Copy the mag_acc column for the last num_samples.
+            # main.py rolls the arrays it receives in place.
+            plot_data[mb] = np.array(self.df_dict[mb].tail(num_samples)['mag_acc'])
         return plot_data
 
 
+    def connect_dispatcher(self):
+        ''' Answer request_data signals with plot_data. '''
+        from pydispatch import dispatcher
+        dispatcher.connect(self.dispatcher_receive_data_request,
+            signal='request_data', sender='main')
+
+
     def dispatcher_receive_data_request(self, message):
         ''' Dispatch microbit data. '''
+        from pydispatch import dispatcher
         data_to_send = self.create_dispatcher_data()
         dispatcher.send(message=data_to_send,
             sender='read_microbits', signal='plot_data')
@@ -156,31 +221,327 @@ class ReadMicrobits():
             # print('get_single_scan: {} input: {}'.format(e, scans))
             return ""
 
+    def heartbeat(self):
+        ''' Called on every pass of the poll and stream loops. '''
+        pass
+
+
     def now_time(self):
         '''returns the local time as a string'''
         now_time = datetime.now()
         return now_time.strftime("%H:%M:%S.%f")
 
+    def poll(self, Microbit_Serial_Port, serial_port, microbits, rate=None,
+            min_rate=None, priority=0.0):
+        ''' Poll the microbits, in the order the scheduler picks, until stop is called. '''
+        scheduler = self.create_scheduler(microbits, rate, min_rate, priority)
+        next_report = monotonic() + REPORT_INTERVAL
+        while self.running:
+            if not Microbit_Serial_Port.is_connected():
+                self.wait_for_reconnect(Microbit_Serial_Port, serial_port)
+                continue
+            # have base station act as controller and poll each of the sensor microbits
+            # the next poll is sent as soon as the reply to the last one arrives
+            mb_id = scheduler.next_microbit()
+            self.poll_and_wait(mb_id, Microbit_Serial_Port, serial_port, scheduler)
+            self.heartbeat()
+            if monotonic() >= next_report:
+                self.report_rates()
+                next_report = monotonic() + REPORT_INTERVAL
+
+
+    def poll_and_wait(self, mb_id, Microbit_Serial_Port, serial_port, scheduler):
+        ''' Poll <mb_id> then read until its reply is parsed or the timeout expires.
+        Scans from other microbits that arrive meanwhile are stored as well. '''
+        if not self.pause(scheduler.wait_time(monotonic(), mb_id)):
+            return False
+        self.poll_microbit(mb_id, serial_port)
+        sent_time = monotonic()
+        scheduler.poll_sent(sent_time, mb_id)
+        deadline = sent_time + scheduler.timeout(mb_id)
+        was_healthy = scheduler.healthy(mb_id)
+        while True:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                self.reply_timed_out(mb_id, scheduler, was_healthy)
+                return False
+            read_bytes = Microbit_Serial_Port.wait_serial_data(serial_port, remaining)
+            if not read_bytes:
+                continue
+            received = self.process_data(read_bytes, monotonic_ns())
+            if mb_id in received:
+                self.reply_received(mb_id, scheduler, was_healthy)
+                return True
+
+
+    def pause(self, seconds):
+        ''' Sleep for <seconds>, which is seconds while every microbit is
+        backing off, see PollScheduler.wait_time, in slices of PAUSE_SLICE
+        with a heartbeat after each.
+        Returns False if stop was called meanwhile. '''
+        end = monotonic() + seconds
+        while self.running:
+            remaining = end - monotonic()
+            if remaining <= 0:
+                return True
+            sleep(min(remaining, PAUSE_SLICE))
+            self.heartbeat()
+        return False
+
+
+    def create_scheduler(self, microbits, rate=None, min_rate=None, priority=0.0):
+        ''' Create the PollScheduler for polling <microbits>. '''
+        min_rates = {mb_id: min_rate for mb_id in microbits} if min_rate else None
+        self.scheduler = PollScheduler(microbits, target_rate=rate,
+            max_timeout=SCAN_DELAY, min_rates=min_rates, priority_gain=priority)
+        return self.scheduler
+
+
+    def reply_received(self, mb_id, scheduler, was_healthy):
+        ''' Tell the scheduler about the reply to the last poll of <mb_id>. '''
+        rtt = scheduler.reply_received(mb_id, monotonic())
+        self.metrics.record('poll_reply', rtt * 1e9)
+        if not was_healthy:
+            logging.info('*** {} {} responding again'.format(self.now_time(), mb_id))
+        if scheduler.priority_gain:
+            scheduler.set_activity(mb_id, float(np.var(
+                self.df_dict[mb_id].tail(ACTIVITY_SAMPLES)['mag_acc'])))
+
+
+    def reply_timed_out(self, mb_id, scheduler, was_healthy):
+        ''' Tell the scheduler the last poll of <mb_id> had no reply. '''
+        if scheduler.reply_timed_out(mb_id):
+            logging.info('*** {} {} unresponsive, backing off'.format(
+                self.now_time(), mb_id))
+        elif was_healthy:
+            logging.info('*** {} no reply mb_id: {}'.format(self.now_time(), mb_id))
+
+
     def poll_microbit(self, mb_id, serial_port):
         ''' Poll a microbit connected to serial with its id. '''
+        self.send_command(poll_string(mb_id, self.protocol_version), serial_port)
+
+
+    def device_counters(self):
+        ''' Return a dict {mb_id: dict of loss counters} for each microbit.
+        Malformed scans cannot be traced to a microbit and are counted for
+        the serial stream as a whole, see report_rates. '''
+        counters = {}
+        for mb, tracker in self.trackers.items():
+            timed_out = 0
+            success = 1.0
+            if self.scheduler:
+                timed_out = self.scheduler.timeouts.get(mb, 0)
+                success = self.scheduler.success_rate.get(mb, 1.0)
+            counters[mb] = {'received': tracker.received,
+                'duplicated': tracker.duplicated, 'gap_lost': tracker.gap_lost,
+                'reordered': tracker.reordered, 'timed_out': timed_out,
+                'success': success}
+        return counters
+
+
+    def report_rates(self):
+        ''' Log the delivered rate and loss counters of each microbit
+        and the latency histograms of each stage. '''
+        for mb, counters in self.device_counters().items():
+            logging.info('{} {:0.1f} scans/s received: {received} gap lost: {gap_lost} '
+                'reordered: {reordered} duplicated: {duplicated} '
+                'timed out: {timed_out} success: {success:0.2f}'.format(mb, self.trackers[mb].rate, **counters))
+        for mb, clock in self.clocks.items():
+            if clock.minima:
+                logging.info('{} clock drift: {:0.1f} ppm'.format(mb, clock.drift_ppm()))
+        self.metrics.log(['malformed: {} discarded bytes: {}'.format(
+            self.framer.malformed, self.framer.discarded_bytes)])
+
+
+    def send_command(self, command, serial_port):
+        ''' Write a line to the receiver microbit which relays it over the radio. '''
         try:
-            serial_port.write((mb_id + '\n').encode())
+            serial_port.write((command + '\n').encode())
         except AttributeError as e:
                 print(e)
+        except OSError as e:
+            # unplugged, the ConnectionManager reopens the port
+            if self.connection:
+                self.connection.lost(e)
+
+
+    def stream(self, Microbit_Serial_Port, serial_port, microbits, slot_ms=SLOT_MS):
+        ''' Give each microbit a time slot, then read the scans they send
+        unsolicited until stop is called. '''
+        num_slots = len(microbits)
+        self.start_slots(serial_port, microbits, slot_ms)
+        next_sync = monotonic() + SYNC_INTERVAL
+        next_report = monotonic() + REPORT_INTERVAL
+        while self.running:
+            if not Microbit_Serial_Port.is_connected():
+                self.wait_for_reconnect(Microbit_Serial_Port, serial_port)
+                continue
+            read_bytes = Microbit_Serial_Port.wait_serial_data(serial_port,
+                num_slots * slot_ms / 1000)
+            if read_bytes:
+                self.process_data(read_bytes, monotonic_ns())
+            self.heartbeat()
+            now = monotonic()
+            if now >= next_sync:
+                # realign the transmitter clocks so the slots do not drift into each other
+                self.send_command('sync', serial_port)
+                next_sync = now + SYNC_INTERVAL
+            if now >= next_report:
+                self.report_rates()
+                next_report = now + REPORT_INTERVAL
+        self.send_command('stop', serial_port)
+
+    def start_slots(self, serial_port, microbits, slot_ms=SLOT_MS):
+        ''' Give each microbit a streaming time slot and start the slots. '''
+        num_slots = len(microbits)
+        for slot, mb_id in enumerate(microbits):
+            # ss_N:slot,num_slots,slot_ms
+            self.send_command('ss_{}:{},{},{}'.format(mb_id[len('mb_'):], slot,
+                num_slots, slot_ms), serial_port)
+        self.send_command('sync', serial_port)
+
+
+    def reconnected(self, serial_port):
+        ''' Called when the receiver has been reopened after being unplugged.
+        Drops the partial scan from before and restarts streaming, as the
+        receiver may have been reset. '''
+        self.framer.reset()
+        if self.streaming:
+            self.start_slots(serial_port, list(self.df_dict), self.slot_ms)
+
+
+    def wait_for_reconnect(self, Microbit_Serial_Port, serial_port):
+        ''' Wait up to RECONNECT_WAIT for the lost receiver to be reopened. '''
+        if Microbit_Serial_Port.wait_connected(RECONNECT_WAIT):
+            self.reconnected(serial_port)
+        self.heartbeat()
+
+
+    def process_data(self, read_bytes, now_ns):
+        ''' Feed read_bytes, read at monotonic_ns <now_ns>, to the framer
+        and store every complete scan.
+        Returns a list of the microbit id's that scans were stored for. '''
+        received = []
+        start = perf_counter_ns()
+        scans = self.framer.feed(read_bytes)
+        start = self.metrics.record_since('parse', start)
+        for scan in scans:
+            ident = self.store_scan(scan, now_ns)
+            if ident:
+                received.append(ident)
+            start = self.metrics.record_since('store', start)
+        self.store_rows(now_ns)
+        return received
+
+
+    def batch_stored(self, batch, now_ns):
+        ''' Called after each serial read at monotonic_ns <now_ns> with a
+        SCAN_DTYPE array of the rows stored from it, in the order they were
+        stored, which may be empty. Runs the EventDetector over them, see
+        juggle_events.py, and adds them to the History, Spectrum and
+        Aligner, see history.py, spectrum.py and alignment.py. '''
+        if len(batch):
+            start = perf_counter_ns()
+            self.detector.process(batch['time'], batch['id'], batch['mag_acc'])
+            start = self.metrics.record_since('detect', start)
+            self.history.extend(batch['time'], batch['id'], batch['mag_acc'])
+            start = self.metrics.record_since('history', start)
+            self.spectrum.process(batch['time'], batch['id'], batch['mag_acc'])
+            start = self.metrics.record_since('spectrum', start)
+            self.aligner.process(batch['time'], batch['id'], batch['mag_acc'])
+            self.metrics.record_since('align', start)
+
+
+    def reset(self):
+        ''' Forget every sample stored, in the ring buffers, the trackers and
+        clocks and every stage run by batch_stored, e.g. after a seek. '''
+        for ring in self.df_dict.values():
+            ring.clear()
+        for mb in self.df_dict:
+            self.trackers[mb] = SequenceTracker()
+            self.clocks[mb] = ClockEstimator()
+        self.route_devices()
+        self.rows = []
+        self.detector.reset()
+        self.history.reset()
+        self.spectrum.reset()
+        self.aligner.reset()
+
+
+    def sequences(self):
+        ''' Return a dict {mb_id: sequence of its RingBuffer}, which changes
+        whenever a row is stored, so the display can skip unchanged microbits. '''
+        return {mb: ring.sequence for mb, ring in self.df_dict.items()}
+
+
+    def snapshot(self, num_samples=MAX_ROWS, column='mag_acc', mbs=None, copy=False):
+        ''' Return a dict {mb_id: read only numpy view of the last num_samples},
+        for the microbits in <mbs>, or every microbit, or copies with copy=True,
+        see RingBuffer.snapshot for how long a view is valid for.
+        Called from the display thread without a lock or a dispatcher round trip. '''
+        start = perf_counter_ns()
+        df_dict = self.df_dict
+        snapshot = {mb: df_dict[mb].snapshot(num_samples, column, copy)
+            for mb in (df_dict if mbs is None else mbs)}
+        self.metrics.record_since('dispatch', start)
+        return snapshot
+
+
+    def stop(self):
+        ''' Stop the polling loop in main after the current poll. '''
+        self.running = False
+
+
+    def store_rows(self, now_ns):
+        ''' Pass the rows stored since the last call, from a read at
+        monotonic_ns <now_ns>, to batch_stored as a SCAN_DTYPE batch. '''
+        if self.rows:
+            batch = np.array(self.rows, dtype=SCAN_DTYPE)
+            self.rows = []
+        else:
+            batch = EMPTY_BATCH
+        self.batch_stored(batch, now_ns)
+
+
+    def store_scan(self, scan, now_ns):
+        ''' Parse a single scan and add it to df_dict.
+        Returns the microbit id or None if the scan was not stored. '''
+        scan_row = self.create_scan_row(scan, now_ns)
+        if not scan_row:
+            logging.info('*** failed to create scan_row: {}'.format(scan))
+            return
+        # the integer microbit id from the scan is its slot in devices
+        if not 0 <= scan_row[1] < len(self.devices):
+            logging.info('*** unknown microbit id: {}'.format(scan_row[1]))
+            return
+        device = self.devices[scan_row[1]]
+        if device is None:
+            # heard by this receiver, but stored by the receiver it is assigned to
+            self.metrics.count('unassigned_scans')
+            return
+        ident, ring, tracker, clock = device
+        # duplicated and late scans are counted by the tracker and not stored
+        if not tracker.update(scan_row[2]):
+            return
+        if isinstance(scan, tuple):
+            # version 2 counts follow the transmitter sample clock
+            scan_row = (clock.update(scan_row[2], now_ns),) + scan_row[1:]
+        if not self.update_df_dict(scan_row, ring):
+            return
+        if self.recorder:
+            self.recorder.record(scan_row)
+        return ident
 
-    def process_data(self, read_bytes, multi_scans):
-        ''' process data from serial port
-        return scan: '''
-        scan = ''
-        multi_scans = multi_scans + read_bytes
-        # print('process_data, read_bytes: {}'.format(read_bytes))
-        try:
-            scan = (self.get_single_scan(read_bytes))
-                # if all the scans are processed a ValueError will be raised
-                # by get_single_scan
-        except ValueError as e:
-            print('process_data, ValueError: {}'.format(e))
-        return (scan)
+
+    def delivered_rates(self):
+        ''' Return a dict {mb_id: scans per second received} '''
+        return {mb: tracker.rate for mb, tracker in self.trackers.items()}
+
+
+    def export_dataframes(self, num_rows=None):
+        ''' Return a dict of pandas DataFrames, one for each microbit. '''
+        return {mb: ring.to_dataframe(num_rows) for mb, ring in self.df_dict.items()}
 
 
     def text_all_scan(self, df_dict):
@@ -188,129 +549,158 @@ class ReadMicrobits():
         out_text = []
         for dict in df_dict:
             last_row = df_dict[dict].tail(1)
-            last_row_text = last_row.values.flatten().tolist()
+            last_row_text = last_row.tolist()
             out_text.append(last_row_text)
         return out_text
 
 
-    def timestring(self, timestamp):
-        ''' create a string from timestamp '''
-        return timestamp.strftime("%Y-%m-%d %H:%M:%S.%f")
-
-
-    def trim_df(self, df):
-        ''' trim dataframe to be MAX_ROWS long '''
-        length = len(df)
-        if length > MAX_ROWS:
-            excess = length - MAX_ROWS
-            df = df.drop(df.index[:excess])
-        return df
-
-
     def unpack_scan(self, scan):
-        ''' unpack a single scan into a DataFrame
+        ''' unpack a single scan into a tuple of ints
         ip: ST,id,count,x_acc,y_acc,z_acc,EN
-        op: DataFrame as a single row '''
+        op: (id, count, x_acc, y_acc, z_acc) '''
         if not scan:
             return
         a = (scan.split(','))
         # remove ST and EN markers
         a = a[1:-1]
+        if len(a) != len(SCAN_COL_NAMES):
+            print('unpack_scan: wrong number of fields: {}'.format(scan))
+            return
         try:
-            a = [int(a[i]) for i in range(len(a))]
+            a = tuple(int(field) for field in a)
         except ValueError as e:
             logging.info('ValueError in unpack_scan')
             return
-        column_names = list(SCAN_COL_NAMES)
-        try:
-            df = pd.DataFrame([a],columns=column_names)
-        except AssertionError as e:
-            print('unpack_scan: {}'.format(e))
-        return df
-
-
-    def update_df_dict(self, df_scan, df_mb):
-        ''' update df_dict for a microbit with a single scan '''
-        df_mb = df_mb.append(df_scan)
-        # print('update_df_dict, df_mb.tail(1): {}'.format(df_mb.tail(1)))
-        df_mb = df_mb.drop_duplicates(['count'])
-        # trim the df to the maximum permitted length
-        df_mb = self.trim_df(df_mb)
-        return df_mb
-
-
-    def write_file(self, file_path):
-        ''' create a file if it does not exist '''
-        path = pathlib.Path(file_path)
-        if not path.is_file():
+        return a
+
+
+    def update_df_dict(self, scan_row, ring):
+        ''' update the RingBuffer for a microbit with a single scan row
+        and keep it for the batch of the serial read
+        returns False if the scan duplicates the last count '''
+        if not ring.append(scan_row):
+            return False
+        self.rows.append(scan_row)
+        return True
+
+
+    def close(self):
+        ''' Close the serial port, recorder and fake microbits opened by connect. '''
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+            self.serial_port = None
+        if self.recorder:
+            self.recorder.close()
+            self.recorder = None
+        if self.fake_microbits:
+            self.fake_microbits.close()
+            self.fake_microbits = None
+
+
+    def connect(self):
+        ''' Open the serial port, and the fake microbits and recorder if asked for.
+        Returns the ConnectionManager, or None if no microbit is connected. '''
+        port = self.port
+        if self.fake:
+            print('Fake microbit option detected')
+            import fake_microbits
+            self.fake_microbits = fake_microbits.FakeMicrobits(self.num_microbits,
+                **self.fake_options)
+            port = self.fake_microbits.start()
+        Microbit_Serial_Port = ConnectionManager(port=port, metrics=self.metrics)
+        self.connection = Microbit_Serial_Port
+        self.serial_port = Microbit_Serial_Port.get_serial_port()
+        print('serial_port: {}'.format(self.serial_port))
+        if not self.serial_port:
+            self.close()
             return
+        if self.out:
+            from recorder import SessionRecorder
+            self.recorder = SessionRecorder(self.out)
+        return Microbit_Serial_Port
 
 
-    def main(self):
+    def create_option_parser(self):
+        ''' Return the OptionParser for the command line settings. '''
+        from optparse import OptionParser
         parser = OptionParser()
-        parser.add_option('-f', '--fake',
-                          default='False',
+        parser.add_option('-n', '--num_microbits', type='int', default=None,
+                    help='Number of microbits, with ids 0 to n - 1')
+        parser.add_option('-f', '--fake', action='store_true',
+                          default=False,
                     help='Fake microbits')
-        (options,args) = parser.parse_args()
+        parser.add_option('-r', '--rate', type='float', default=None,
+                    help='Target scans per second for each microbit')
+        parser.add_option('-o', '--out', default=None,
+                    help='Directory to record the scans to')
+        parser.add_option('-m', '--min_rate', type='float', default=None,
+                    help='Minimum polls per second for each responsive microbit')
+        parser.add_option('--priority', type='float', default=0.0,
+                    help='Poll priority given to microbits with more acceleration variance')
+        parser.add_option('-p', '--protocol', type='int', default=1,
+                    help='Protocol version to poll with, 1 ASCII or 2 binary')
+        parser.add_option('-s', '--stream', action='store_true', default=False,
+                    help='Microbits send in time slots instead of being polled')
+        parser.add_option('--slot', type='int', default=SLOT_MS,
+                    help='Streaming time slot length in ms')
+        parser.add_option('--port', default=None,
+                    help='Serial port to open instead of scanning for a microbit')
+        return parser
+
+
+    def main(self):
+        ''' Run with the settings given on the command line. '''
+        (options,args) = self.create_option_parser().parse_args()
+        self.options = options
+        if options.num_microbits and options.num_microbits != self.num_microbits:
+            self.create_devices(options.num_microbits)
         print('options:{} args: {}'.format(options, args))
-        if options.fake:
-            print('Fake microbit option detected')
-        # serial = open_serial_port()
-        Microbit_Serial_Port = SerialPort()
-        serial_port = Microbit_Serial_Port.get_serial_port()
-        print('serial_port: {}'.format(serial_port))
-        if not serial_port:
+        self.configure(port=options.port, fake=options.fake, rate=options.rate,
+            min_rate=options.min_rate, priority=options.priority,
+            protocol=options.protocol, stream=options.stream,
+            slot_ms=options.slot, out=options.out)
+        if not self.run():
             system_exit('microbit not found connected to a serial port')
-        # df_dict is a dict of pandas DataFrames, one for each microbit
-        self.df_dict = self.create_df_dict()
-        microbits = [a for a in sorted(self.df_dict.keys())]
+
+
+    def configure(self, port=None, fake=False, rate=None, min_rate=None,
+            priority=0.0, protocol=1, stream=False, slot_ms=SLOT_MS, out=None,
+            fake_options=None):
+        ''' Set how run acquires the scans, see __init__. '''
+        self.port = port
+        self.fake = fake
+        self.fake_options = fake_options or {}
+        self.rate = rate
+        self.min_rate = min_rate
+        self.priority = priority
+        self.protocol_version = protocol
+        self.streaming = stream
+        self.slot_ms = slot_ms
+        self.out = out
+
+
+    def run(self):
+        ''' Connect and poll or stream until stop is called, then close.
+        Returns False if no microbit is connected. '''
+        Microbit_Serial_Port = self.connect()
+        if not Microbit_Serial_Port:
+            return False
+        microbits = list(self.df_dict)
         print('microbit id\'s: {}'.format(microbits))
-        old_time = datetime.now()
-        while (1):
-            # have base station act as controller and poll each of the sensor microbits
-            now_time = datetime.now()
-            # time_delta = now_time - old_time
-            # old_time = now_time
-            # print(time_delta.total_seconds())
-            # print(text_all_scan(df_dict))
-            for mb_id in microbits:
-                # poll each microbit in turn by transmitting their id
-                self.poll_microbit(mb_id, serial_port)
-                # scan = ''
-                # requested data, now wait for data, then read data
-
-                # This sleep command controls the frequency of data collection.
-                sleep(SCAN_DELAY)
-                # logging.info('polling: {}'.format(mb_id))
-                read_bytes = Microbit_Serial_Port.get_serial_data(serial_port)
-                # logging.info('poll: {} read_bytes: {}'.format(mb_id, read_bytes))
-                if not read_bytes:
-                    logging.info('*** {} no read_bytes mb_id: {}'.format(self.now_time(), mb_id))
-                    continue
-                try:
-                    scan = self.get_single_scan(read_bytes)
-                except (TypeError, ValueError, AttributeError) as e:
-                    logging.info('get_single_scan error: {}'.format(e))
-                    scan = self.create_blank_scan(mb_id)
-                if len(scan.split(',')) != len(SCAN_COL_NAMES)+2:
-                    logging.info('*** short scan: {} mb_id: {} read_bytes: {}'.format(
-                        scan, mb_id, read_bytes))
-                    continue
-                df_scan = self.create_df_scan(scan, now_time)
-                if df_scan.empty:
-                    logging.info('*** failed to create df_scan')
-                    continue
-                # get microbit id from scan
-                ident = 'mb_{}'.format(df_scan['id'].values[0])
-                # check_for_duplicate_counts(df_scan, df_dict[ident])
-                logging.info('{} scan: {} polled: {} received: {}'.format(
-                     self.now_time(), scan, mb_id, ident))
-                self.df_dict[ident] = self.update_df_dict(df_scan,
-                    self.df_dict[ident])
-                #  looging.info.(df_dict[ident].to_csv()))
+        try:
+            if self.streaming:
+                self.stream(Microbit_Serial_Port, self.serial_port, microbits,
+                    self.slot_ms)
+            else:
+                self.poll(Microbit_Serial_Port, self.serial_port, microbits,
+                    self.rate, self.min_rate, self.priority)
+        finally:
+            self.close()
+        return True
 
 
 if __name__ == '__main__':
     print('starting ReadMicrobits')
-    sys.argv = ['--fake', 'True']
+    sys.argv = [sys.argv[0], '--fake']
     read_microbits = ReadMicrobits(num_microbits=3)
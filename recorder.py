@@ -0,0 +1,165 @@
+''' Records every parsed scan to disk in a compact binary format.
+Scans are put on a queue by the polling loop and written in batches by a
+background thread, so disk I/O never blocks polling. If the queue is full the
+scan is dropped and counted instead of waiting.
+
+File format, little endian:
+8 bytes MAGIC
+uint32 VERSION
+uint32 length of the JSON metadata
+JSON metadata: record dtype, start times, padded with spaces so that the
+    records start on a multiple of HEADER_ALIGN bytes
+fixed size RECORD_DTYPE records, appended until the file is rotated
+
+Files are rotated when they reach max_bytes or max_seconds. '''
+
+import json
+import logging
+import os
+import queue
+import struct
+import threading
+from datetime import datetime
+from time import monotonic, monotonic_ns, time_ns
+
+import numpy as np
+
+MAGIC = b'MBJUGREC'
+VERSION = 1
+HEADER_ALIGN = 64
+PREAMBLE = struct.Struct('<8sII')
+RECORD_DTYPE = np.dtype([('time_ns', '<i8'), ('id', '<i4'), ('count', '<i4'),
+    ('x_acc', '<i4'), ('y_acc', '<i4'), ('z_acc', '<i4'), ('mag_acc', '<i4')])
+BATCH_SIZE = 512
+QUEUE_SIZE = 65536
+MAX_BYTES = 256 * 1024 * 1024
+MAX_SECONDS = 3600
+# longest time a scan waits in the queue before it is written
+FLUSH_INTERVAL = 0.5
+SUFFIX = '.mbrec'
+
+
+def write_header(out_file):
+    ''' Write the file header to <out_file>. '''
+    metadata = {
+        'dtype': RECORD_DTYPE.descr,
+        'start_time_ns': time_ns(),
+        'start_monotonic_ns': monotonic_ns(),
+    }
+    text = json.dumps(metadata).encode()
+    length = PREAMBLE.size + len(text)
+    padding = -length % HEADER_ALIGN
+    text += b' ' * padding
+    out_file.write(PREAMBLE.pack(MAGIC, VERSION, len(text)))
+    out_file.write(text)
+
+
+def read_header(in_file):
+    ''' Return (metadata dict, offset of the first record) from an open file. '''
+    magic, version, length = PREAMBLE.unpack(in_file.read(PREAMBLE.size))
+    if magic != MAGIC:
+        raise ValueError('not a microbit recording')
+    if version != VERSION:
+        raise ValueError('unknown recording version: {}'.format(version))
+    metadata = json.loads(in_file.read(length).decode())
+    return metadata, PREAMBLE.size + length
+
+
+def open_recording(file_path):
+    ''' Return a read only memory map of the records in <file_path>. '''
+    with open(file_path, 'rb') as in_file:
+        metadata, offset = read_header(in_file)
+    if np.dtype([tuple(field) for field in metadata['dtype']]) != RECORD_DTYPE:
+        raise ValueError('unexpected record layout in {}'.format(file_path))
+    return np.memmap(file_path, dtype=RECORD_DTYPE, mode='r', offset=offset)
+
+
+class SessionRecorder():
+    def __init__(self, directory, max_bytes=MAX_BYTES, max_seconds=MAX_SECONDS,
+            queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.batch_size = batch_size
+        self.queue = queue.Queue(queue_size)
+        self.recorded = 0
+        self.dropped = 0
+        self.files = []
+        self.out_file = None
+        self.running = True
+        os.makedirs(directory, exist_ok=True)
+        self.thread = threading.Thread(target=self.run, name='recorder', daemon=True)
+        self.thread.start()
+
+
+    def close(self):
+        ''' Write the scans still queued and close the file. '''
+        if not self.running:
+            return
+        self.running = False
+        self.queue.put(None)
+        self.thread.join()
+        logging.info('recorder: {} scans recorded, {} dropped'.format(
+            self.recorded, self.dropped))
+
+
+    def new_file(self):
+        ''' Close the current file and start a new one. '''
+        if self.out_file:
+            self.out_file.close()
+        file_name = 'session_{}{}'.format(
+            datetime.now().strftime('%Y%m%d_%H%M%S_%f'), SUFFIX)
+        file_path = os.path.join(self.directory, file_name)
+        self.out_file = open(file_path, 'wb')
+        write_header(self.out_file)
+        self.file_start = monotonic()
+        self.files.append(file_path)
+        logging.info('recorder: writing {}'.format(file_path))
+
+
+    def record(self, row):
+        ''' Queue a scan without blocking. Returns False if it was dropped.
+        row: (time_ns, id, count, x_acc, y_acc, z_acc, mag_acc) '''
+        try:
+            self.queue.put_nowait(row)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+
+    def run(self):
+        ''' Write batches of scans from the queue until close is called. '''
+        self.new_file()
+        finished = False
+        while not finished:
+            batch = []
+            try:
+                row = self.queue.get(timeout=FLUSH_INTERVAL)
+            except queue.Empty:
+                continue
+            # None is queued by close
+            while row is not None:
+                batch.append(row)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    row = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            if batch:
+                self.write_batch(batch)
+            finished = row is None
+        self.out_file.close()
+        self.out_file = None
+
+
+    def write_batch(self, batch):
+        ''' Write a list of rows as records, rotating the file if due. '''
+        if (self.out_file.tell() >= self.max_bytes or
+                monotonic() - self.file_start >= self.max_seconds):
+            self.new_file()
+        records = np.array(batch, dtype=RECORD_DTYPE)
+        self.out_file.write(records.tobytes())
+        self.out_file.flush()
+        self.recorded += len(records)
@@ -0,0 +1,178 @@
+''' Replays sessions recorded by SessionRecorder through the live data path.
+ReplayMicrobits is a ReadMicrobits which takes its scans from recording files
+instead of polling, so MicrobitJuggle and anything listening for plot_data
+work unchanged.
+The files are memory mapped, not loaded, so long recordings open at once and
+only the pages being played are read.
+speed 1.0 plays in real time, 2.0 twice as fast, 0 as fast as possible.
+seek() jumps to a time from the start of the session.
+Protocol 2 rows are timestamped with the estimated time each sample was
+taken, so the rows of different microbits, stored in the order they
+arrived, are not in time order. Seeks bisect the maximum time of each
+block of CHUNK records instead, worked out only for the blocks a search
+reads, then the running maximum of the one block they land in, and playback
+searches the running maximum of the block being played, so a long
+recording opens and seeks reading only a few blocks.
+Each block of records played is stored and passed to batch_stored as if
+it had been read from the serial port, so the sequence trackers, metrics
+and every stage of a live session, such as the EventDetector, see the
+recording as they would see the microbits. '''
+
+import logging
+import numpy as np
+from read_microbits import MAX_ROWS, ReadMicrobits, system_exit
+from recorder import open_recording
+import sys
+from time import monotonic, monotonic_ns, perf_counter_ns, sleep
+
+# rows fed per step when playing as fast as possible
+CHUNK = 1024
+# longest sleep between steps when playing in real time
+REPLAY_INTERVAL = 0.01
+
+
+class ReplayMicrobits(ReadMicrobits):
+    def __init__(self, file_paths, num_microbits=3, speed=1.0, loop=False,
+            run_main=True, ring_rows=MAX_ROWS):
+        ''' <file_paths> is one recording or a list of the rotated files of a session.
+        <ring_rows> is the capacity of each RingBuffer, see ReadMicrobits. '''
+        if isinstance(file_paths, str):
+            file_paths = [file_paths]
+        self.segments = [records for records in
+            (open_recording(path) for path in sorted(file_paths)) if len(records)]
+        if not self.segments:
+            system_exit('no records in {}'.format(file_paths))
+        # the maximum time of each block of CHUNK records of each segment,
+        # -1 until it is read, see block_max
+        self.maxima = [np.full(-(-len(records) // CHUNK), -1, dtype=np.int64)
+            for records in self.segments]
+        # the rows at the start of a file may be a little out of order
+        self.start_ns = int(self.segments[0]['time_ns'][:CHUNK].min())
+        self.end_ns = self.block_max(-1, -1)
+        self.speed = speed
+        self.loop = loop
+        self.segment = 0
+        self.position = 0
+        self.seek_request = None
+        self.clock_ns = self.start_ns
+        self.clock_start = monotonic()
+        super().__init__(num_microbits=num_microbits, run_main=run_main, ring_rows=ring_rows)
+
+
+    def block_max(self, segment, block):
+        ''' Return the maximum time of <block> of the records of <segment>. '''
+        maxima = self.maxima[segment]
+        block %= len(maxima)
+        if maxima[block] < 0:
+            maxima[block] = self.segments[segment]['time_ns'][
+                block * CHUNK:(block + 1) * CHUNK].max()
+        return int(maxima[block])
+
+
+    def duration(self):
+        ''' Return the length of the session in seconds. '''
+        return (self.end_ns - self.start_ns) / 1e9
+
+
+    def feed(self, records):
+        ''' Store a block of records, as a serial read would, and pass them to batch_stored. '''
+        start = perf_counter_ns()
+        devices = self.devices
+        for row in records.tolist():
+            if not 0 <= row[1] < len(devices):
+                continue
+            _, ring, tracker, _ = devices[row[1]]
+            # the rows were timestamped when they were recorded
+            if tracker.update(row[2]):
+                self.update_df_dict(row, ring)
+        self.metrics.record_since('store', start)
+        self.store_rows(monotonic_ns())
+
+
+    def locate(self, time_ns):
+        ''' Return (segment, position) of the first record at or after <time_ns>. '''
+        for segment, maxima in enumerate(self.maxima):
+            if self.block_max(segment, -1) < time_ns:
+                continue
+            # the first block reaching <time_ns>
+            low, high = 0, len(maxima) - 1
+            while low < high:
+                middle = (low + high) // 2
+                if self.block_max(segment, middle) < time_ns:
+                    low = middle + 1
+                else:
+                    high = middle
+            times = self.segments[segment]['time_ns'][low * CHUNK:(low + 1) * CHUNK]
+            return segment, low * CHUNK + int(np.searchsorted(
+                np.maximum.accumulate(times), time_ns))
+        return len(self.segments), 0
+
+
+    def main(self):
+        ''' Play the session into df_dict until it ends or stop is called. '''
+        logging.info('replaying {:0.1f} s at speed {}'.format(self.duration(), self.speed))
+        self.seek(0)
+        while self.running:
+            if self.seek_request is not None:
+                self.do_seek(self.seek_request)
+            if self.segment >= len(self.segments):
+                if not self.loop:
+                    break
+                self.seek(0)
+                continue
+            records = self.segments[self.segment]
+            if self.speed:
+                # session time that should have been played by now
+                target_ns = self.clock_ns + (monotonic() - self.clock_start) * self.speed * 1e9
+                end = self.played_until(records, target_ns)
+            else:
+                end = min(self.position + CHUNK, len(records))
+            if end > self.position:
+                self.feed(records[self.position:end])
+                self.position = end
+            if self.position >= len(records):
+                self.segment += 1
+                self.position = 0
+                continue
+            if self.speed:
+                wait = (records['time_ns'][self.position] - target_ns) / 1e9 / self.speed
+                sleep(min(max(wait, 0), REPLAY_INTERVAL))
+        logging.info('replay finished')
+
+
+    def do_seek(self, seconds):
+        ''' Move playback to <seconds> from the start of the session. '''
+        self.seek_request = None
+        time_ns = self.start_ns + int(seconds * 1e9)
+        self.segment, self.position = self.locate(time_ns)
+        self.reset()
+        self.clock_ns = time_ns
+        self.clock_start = monotonic()
+
+
+    def played_until(self, records, time_ns):
+        ''' Return the index after the <records> from position to the end of
+        its block whose running maximum time is up to <time_ns>. '''
+        end = min((self.position // CHUNK + 1) * CHUNK, len(records))
+        times = np.maximum.accumulate(records['time_ns'][self.position:end])
+        return self.position + int(np.searchsorted(times, time_ns, side='right'))
+
+
+    def seek(self, seconds):
+        ''' Ask playback to jump to <seconds> from the start of the session. '''
+        self.seek_request = seconds
+
+
+    def set_speed(self, speed):
+        ''' Change the playback speed without jumping. '''
+        if self.speed:
+            self.clock_ns = self.clock_ns + (monotonic() - self.clock_start) * self.speed * 1e9
+        elif self.segment < len(self.segments):
+            self.clock_ns = int(self.segments[self.segment]['time_ns'][self.position])
+        self.clock_start = monotonic()
+        self.speed = speed
+
+
+if __name__ == '__main__':
+    replay = ReplayMicrobits(sys.argv[1:], speed=0)
+    print({mb: len(ring) for mb, ring in replay.df_dict.items()})
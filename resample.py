@@ -0,0 +1,164 @@
+''' Resamples the samples of many microbits onto uniform grids with numpy.
+The samples of a microbit do not arrive at a steady rate, and those of
+different microbits are interleaved as they are polled one after another.
+StagedResampler holds the samples of every microbit back, up to STAGE_ROWS
+of them, until the newest is flush_interval_ns past the last flush, then
+passes them to add grouped by microbit, so the cost of each numpy call is
+shared by the samples of every microbit over that time rather than paid for
+each serial read.
+Each microbit carries its last sample over to the next flush, so values on
+its grid can be interpolated between the last sample of one flush and the
+first of the next. A gap longer than max_gap_ns, or time going backwards
+after a seek, restarts the microbit from its first sample instead.
+interpolate works out the grid values of every microbit with one np.interp,
+each moved along to its own stretch of the x axis.
+Spectrum, see spectrum.py, and Aligner, see alignment.py, are StagedResamplers. '''
+
+import threading
+
+import numpy as np
+
+# most samples held back to be resampled together
+STAGE_ROWS = 4096
+# a longer gap between two samples of a microbit restarts it
+MAX_GAP_NS = 1000000000
+
+
+def interpolate(grid, grid_stretches, times, mags, starts, lengths):
+    ''' Return the values at the <grid> times, each within the stretch of
+    samples given by <grid_stretches>, interpolated between <times> and
+    <mags>. Stretch n is the <lengths>[n] samples from <starts>[n]. '''
+    base = times[starts].astype(np.float64)
+    span = float((times[starts + lengths - 1] - base).max()) + 1
+    sample_stretches = np.repeat(np.arange(len(starts)), lengths)
+    return np.interp(grid - base[grid_stretches] + grid_stretches * span,
+        times - base[sample_stretches] + sample_stretches * span, mags)
+
+
+class StagedResampler():
+    def __init__(self, num_microbits, flush_interval_ns, max_gap_ns=MAX_GAP_NS):
+        ''' <flush_interval_ns> is the time between flushes, in the time of the samples. '''
+        self.flush_interval_ns = int(flush_interval_ns)
+        self.max_gap_ns = max_gap_ns
+        # the samples waiting to be resampled, see stage
+        self.staged_times = np.empty(STAGE_ROWS, dtype=np.int64)
+        self.staged_ids = np.empty(STAGE_ROWS, dtype=np.int64)
+        self.staged_mags = np.empty(STAGE_ROWS, dtype=np.float64)
+        self.num_staged = 0
+        self.flush_ns = None
+        self.lock = threading.Lock()
+        self.create_state(num_microbits)
+
+
+    def add(self, devices, times, mags, starts, lengths, restart):
+        ''' Called on each flush with the samples of each microbit in <devices>,
+        the <lengths>[n] <times> and <mags> from <starts>[n], oldest first.
+        Each stretch starts with the sample carried over from the last flush,
+        except where <restart> is True. '''
+        pass
+
+
+    def carry(self, devices, times, mags, starts):
+        ''' Return (times, mags, starts, lengths, restart), with the last sample
+        of each microbit in <devices> carried over in front of its <times>
+        and <mags> from <starts>, unless it restarts. '''
+        ends = np.append(starts[1:], len(times))
+        first = times[starts]
+        last_time = self.last_time[devices]
+        restart = (last_time < 0) | (first < last_time) | (first - last_time > self.max_gap_ns)
+        carried = np.flatnonzero(~restart)
+        times = np.insert(times, starts[carried], last_time[carried])
+        mags = np.insert(mags, starts[carried], self.last_mag[devices[carried]])
+        lengths = ends - starts + ~restart
+        starts = np.cumsum(lengths) - lengths
+        self.last_time[devices] = times[starts + lengths - 1]
+        self.last_mag[devices] = mags[starts + lengths - 1]
+        return times, mags, starts, lengths, restart
+
+
+    def create_state(self, num_microbits):
+        ''' Start every microbit with no samples. Extended with the state of
+        subclasses, which must be listed by state. '''
+        self.num_microbits = num_microbits
+        # the last sample of each microbit, carried over to the next flush
+        self.last_time = np.full(num_microbits, -1, dtype=np.int64)
+        self.last_mag = np.zeros(num_microbits, dtype=np.float64)
+
+
+    def flush(self):
+        ''' Pass the staged samples to add, grouped by microbit. '''
+        num_staged, self.num_staged = self.num_staged, 0
+        if not num_staged:
+            return
+        times = self.staged_times[:num_staged]
+        ids = self.staged_ids[:num_staged]
+        mags = self.staged_mags[:num_staged]
+        top = int(ids.max()) + 1
+        if top > self.num_microbits:
+            self.grow(top)
+        # the samples of each microbit together, in order
+        if ids[0] == ids[-1] and (ids == ids[0]).all():
+            starts = np.zeros(1, dtype=np.int64)
+        else:
+            order = np.argsort(ids, kind='stable')
+            ids, times, mags = ids[order], times[order], mags[order]
+            starts = np.flatnonzero(np.concatenate(([True], ids[1:] != ids[:-1])))
+        devices = ids[starts]
+        self.add(devices, *self.carry(devices, times, mags, starts))
+
+
+    def grow(self, num_microbits):
+        ''' Make room for the state of <num_microbits>, keeping the state held. '''
+        held = self.state()
+        self.create_state(num_microbits)
+        for new, array in zip(self.state(), held):
+            new[:len(array)] = array
+
+
+    def process(self, times, ids, mags):
+        ''' Add a batch of samples given as arrays of their times in ns,
+        microbit ids and mag_acc, in the order they were taken for each
+        microbit. '''
+        with self.lock:
+            for start in range(0, len(ids), STAGE_ROWS):
+                self.stage(times[start:start + STAGE_ROWS], ids[start:start + STAGE_ROWS],
+                    mags[start:start + STAGE_ROWS])
+
+
+    def reset(self):
+        ''' Forget every sample, e.g. after a seek. '''
+        with self.lock:
+            self.create_state(self.num_microbits)
+            self.num_staged = 0
+            self.flush_ns = None
+
+
+    def stage(self, times, ids, mags):
+        ''' Hold up to STAGE_ROWS samples until the newest of them is
+        flush_interval_ns past the last flush, or past the oldest held
+        after a reset, then flush them. '''
+        num_samples = len(ids)
+        newest = int(times[-1])
+        if self.flush_ns is not None and newest < self.flush_ns - 2 * self.flush_interval_ns:
+            # time has gone backwards, after a seek, resample the samples before it apart
+            self.flush()
+            self.flush_ns = None
+        if self.num_staged + num_samples > STAGE_ROWS:
+            self.flush()
+        end = self.num_staged + num_samples
+        self.staged_times[self.num_staged:end] = times
+        self.staged_ids[self.num_staged:end] = ids
+        self.staged_mags[self.num_staged:end] = mags
+        self.num_staged = end
+        if self.flush_ns is None:
+            # from the oldest sample, so a batch spanning the interval is flushed at once
+            self.flush_ns = int(times[0]) + self.flush_interval_ns
+        if newest >= self.flush_ns:
+            self.flush()
+            self.flush_ns = newest + self.flush_interval_ns
+
+
+    def state(self):
+        ''' Return the arrays of the state of every microbit, indexed by
+        microbit id on their first axis, for grow. '''
+        return [self.last_time, self.last_mag]
@@ -0,0 +1,103 @@
+''' Fixed size ring buffer for storing the scans from one microbit.
+Replaces the pandas DataFrame that was rebuilt for every scan.
+Rows are held in a preallocated numpy structured array with the
+DF_COL_NAMES layout: 'time', 'id', 'count', 'x_acc', 'y_acc', 'z_acc', 'mag_acc'
+time is an int64 in ns from time.monotonic_ns.
+The array is twice the capacity and each row is written twice, so the last
+n rows are always a contiguous slice and tail(n) can return a view.
+pandas is only imported when a DataFrame export is asked for.
+
+One thread appends, other threads read with snapshot() without a lock.
+sequence is odd while a row is being written, like a seqlock, so a reader
+retries if it overlaps a write. A snapshot of n rows is a view which stays
+unchanged for the next capacity - n appends, so use it before then, or ask
+for a copy, which is taken inside the retry loop. Anything which keeps the
+samples past that, such as a plot curve, needs a copy. '''
+
+import numpy as np
+from time import sleep
+
+CAPACITY = 100
+SCAN_DTYPE = np.dtype([('time', 'i8'), ('id', 'i4'), ('count', 'i4'),
+    ('x_acc', 'i4'), ('y_acc', 'i4'), ('z_acc', 'i4'), ('mag_acc', 'i4')])
+
+
+class RingBuffer():
+    def __init__(self, capacity=CAPACITY, check_count=True):
+        ''' check_count=False stores rows from several microbits, whose counts
+        may repeat from one row to the next. '''
+        self.capacity = capacity
+        self.check_count = check_count
+        self.data = np.zeros(2 * capacity, dtype=SCAN_DTYPE)
+        # next row to write, always in the range [0, capacity)
+        self.index = 0
+        self.length = 0
+        self.last_count = None
+        self.sequence = 0
+
+
+    def __len__(self):
+        return self.length
+
+
+    def append(self, row):
+        ''' Add <row> in O(1). Return False if its count repeats the last one.
+        row: (time, id, count, x_acc, y_acc, z_acc, mag_acc) '''
+        count = row[2]
+        if self.check_count and count == self.last_count:
+            return False
+        self.sequence += 1
+        self.data[self.index] = row
+        self.data[self.index + self.capacity] = row
+        self.index = (self.index + 1) % self.capacity
+        if self.length < self.capacity:
+            self.length += 1
+        self.last_count = count
+        self.sequence += 1
+        return True
+
+
+    def clear(self):
+        ''' Forget all stored rows. '''
+        self.sequence += 1
+        self.index = 0
+        self.length = 0
+        self.last_count = None
+        self.sequence += 1
+
+
+    def snapshot(self, num_rows=None, column=None, copy=False):
+        ''' Return a consistent read only view of the last <num_rows> rows.
+        <column> selects a single column, e.g. 'mag_acc'. copy=True returns
+        a copy owned by the caller instead of a view. Safe to call from a
+        thread other than the one calling append. '''
+        while True:
+            sequence = self.sequence
+            if sequence & 1:
+                # a write is in progress, let the writer finish
+                sleep(0)
+                continue
+            view = self.tail(num_rows)
+            if column:
+                view = view[column]
+            if copy:
+                view = view.copy()
+            if self.sequence == sequence:
+                return view
+
+
+    def tail(self, num_rows=None):
+        ''' Return a read only view of the last <num_rows> rows, oldest first. '''
+        if num_rows is None or num_rows > self.length:
+            num_rows = self.length
+        end = self.index + self.capacity
+        view = self.data[end - num_rows:end]
+        view.flags.writeable = False
+        return view
+
+
+    def to_dataframe(self, num_rows=None):
+        ''' Return the last <num_rows> rows as a pandas DataFrame indexed by time. '''
+        import pandas as pd
+        df = pd.DataFrame(self.tail(num_rows).copy())
+        return df.set_index('time')
@@ -0,0 +1,132 @@
+''' Incremental framer for the scans sent by the receiver microbit.
+Bytes are fed in as they arrive from the serial port, in any sized chunks.
+Every complete scan of the form ST,id,count,x_acc,y_acc,z_acc,EN is returned.
+Version 2 binary frames, see protocol.py, are detected by their MAGIC_V2 and
+each of their samples is returned as an (id, count, x_acc, y_acc, z_acc) tuple.
+A stream is expected to use one version at a time, scans straddling a switch
+from one version to the other may be lost.
+Partial scans are kept until the rest arrives with a later read.
+Garbage before a START_SCAN marker is dropped, so the framer resyncs on the
+next scan. The search for END_SCAN restarts from where the last search
+stopped, so bytes are not scanned twice. '''
+
+import logging
+from protocol import MAGIC_V2, decode_frames
+
+END_SCAN = b'EN'
+# a scan is a few tens of bytes, anything much longer without EN is garbage
+MAX_BUFFER = 256
+NUM_FIELDS = 7
+START_SCAN = b'ST'
+
+
+class ScanFramer():
+    def __init__(self, start_scan=START_SCAN, end_scan=END_SCAN, max_buffer=MAX_BUFFER):
+        self.start_scan = start_scan
+        self.end_scan = end_scan
+        self.max_buffer = max_buffer
+        self.buffer = bytearray()
+        # index in buffer to restart the search for end_scan from
+        self.search_pos = 0
+        self.discarded_bytes = 0
+        self.malformed = 0
+        # protocol version of the last scan framed
+        self.version = None
+
+
+    def discard(self, num_bytes):
+        ''' Drop <num_bytes> from the front of the buffer. '''
+        del self.buffer[:num_bytes]
+        self.discarded_bytes += num_bytes
+        self.search_pos = 0
+
+
+    def feed(self, read_bytes):
+        ''' Add <read_bytes> to the buffer and return a list of complete scans.
+        Version 1 scans are returned as str, version 2 samples as tuples. '''
+        if isinstance(read_bytes, str):
+            read_bytes = read_bytes.encode()
+        self.buffer += read_bytes
+        scans = []
+        while self.buffer:
+            if not self.sync():
+                break
+            if self.buffer.startswith(MAGIC_V2):
+                if not self.feed_v2(scans):
+                    break
+                continue
+            end = self.buffer.find(self.end_scan,
+                max(self.search_pos, len(self.start_scan)))
+            if end < 0:
+                if len(self.buffer) > self.max_buffer:
+                    logging.info('scan_framer: no end_scan, resync')
+                    self.discard(len(self.start_scan))
+                    continue
+                # the end_scan marker may be split across reads
+                self.search_pos = max(len(self.start_scan),
+                    len(self.buffer) - len(self.end_scan) + 1)
+                break
+            end += len(self.end_scan)
+            # a START_SCAN inside the record means the earlier scan was truncated
+            restart = self.buffer.rfind(self.start_scan, len(self.start_scan), end)
+            if restart > 0:
+                self.malformed += 1
+                self.discard(restart)
+                continue
+            record = bytes(self.buffer[:end])
+            del self.buffer[:end]
+            self.search_pos = 0
+            scan = self.validate(record)
+            if scan:
+                self.version = 1
+                scans.append(scan)
+        return scans
+
+
+    def feed_v2(self, scans):
+        ''' Decode the version 2 frames at the front of the buffer into scans.
+        Returns False if the buffer only holds the start of a frame. '''
+        samples, consumed, bad_frames = decode_frames(self.buffer)
+        self.malformed += bad_frames
+        if not consumed:
+            return False
+        if len(samples):
+            self.version = 2
+            scans.extend(samples.tolist())
+        del self.buffer[:consumed]
+        self.search_pos = 0
+        return True
+
+
+    def reset(self):
+        ''' Drop any buffered partial scan. '''
+        self.discard(len(self.buffer))
+
+
+    def sync(self):
+        ''' Move the buffer on to the next start_scan or MAGIC_V2 marker.
+        Return True if the buffer now starts with one of them. '''
+        if self.buffer.startswith(self.start_scan) or self.buffer.startswith(MAGIC_V2):
+            return True
+        starts = [start for start in (self.buffer.find(self.start_scan),
+            self.buffer.find(MAGIC_V2)) if start >= 0]
+        if not starts:
+            # keep a trailing byte which may be the first half of a marker
+            self.discard(len(self.buffer) - 1)
+            return False
+        self.discard(min(starts))
+        return True
+
+
+    def validate(self, record):
+        ''' Return record as a str if it has the scan layout, else None. '''
+        try:
+            scan = record.decode('ascii')
+        except UnicodeDecodeError:
+            self.malformed += 1
+            return
+        if scan.count(',') != NUM_FIELDS - 1:
+            logging.info('scan_framer: malformed scan: {}'.format(scan))
+            self.malformed += 1
+            return
+        return scan
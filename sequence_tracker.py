@@ -0,0 +1,55 @@
+''' Tracks the count sequence of the scans from one microbit.
+Counts go up by one for each sample a transmitter takes. A jump of more than
+one is a gap, samples which were lost. A count older than the last one is a
+late, reordered scan, which fills in one sample of an earlier gap.
+Protocol version 2 counts are 16 bit and wrap, so counts are compared modulo
+COUNT_MODULUS. The delivered rate is measured over RATE_WINDOW seconds. '''
+
+from time import monotonic
+
+COUNT_MODULUS = 1 << 16
+RATE_WINDOW = 1.0
+
+
+class SequenceTracker():
+    def __init__(self, modulus=COUNT_MODULUS, rate_window=RATE_WINDOW):
+        self.modulus = modulus
+        self.rate_window = rate_window
+        self.last_count = None
+        self.received = 0
+        self.duplicated = 0
+        self.gap_lost = 0
+        self.reordered = 0
+        self.window_start = monotonic()
+        self.window_received = 0
+        self.rate = 0.0
+
+
+    def update(self, count, now=None):
+        ''' Check <count> against the sequence so far.
+        Returns True if the scan is new and in order, False if it is a
+        duplicate or arrived after a later count. '''
+        if now is None:
+            now = monotonic()
+        if now - self.window_start >= self.rate_window:
+            self.rate = (self.received - self.window_received) / (now - self.window_start)
+            self.window_start = now
+            self.window_received = self.received
+        if self.last_count is None:
+            self.last_count = count
+            self.received += 1
+            return True
+        step = (count - self.last_count) % self.modulus
+        if step == 0:
+            self.duplicated += 1
+            return False
+        self.received += 1
+        if step > self.modulus // 2:
+            # older than the last count, it was counted as lost in a gap
+            self.reordered += 1
+            if self.gap_lost:
+                self.gap_lost -= 1
+            return False
+        self.gap_lost += step - 1
+        self.last_count = count
+        return True
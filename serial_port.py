@@ -2,21 +2,34 @@
 Matthew Oppenheim May 2018. '''
 
 import logging
+import select
 import serial
 import serial.tools.list_ports as list_ports
-from time import sleep
+from time import monotonic, perf_counter_ns, sleep
 
 BAUD = 115200
 PID_MICROBIT = 516
 VID_MICROBIT = 3368
 TIMEOUT = 0.1
+# polling interval when the serial port cannot be used with select
+WAIT_INTERVAL = 0.001
 
 logging.basicConfig(level=logging.DEBUG, format='%(message)s')
 
 
+def find_serial_ports(pid=PID_MICROBIT, vid=VID_MICROBIT):
+    ''' Return the device paths of every port with pid and vid, sorted,
+    for opening several receiver microbits. '''
+    return sorted(str(p.device) for p in list_ports.comports()
+        if p.pid == pid and p.vid == vid)
+
+
 class SerialPort():
-    def __init__(self, pid=PID_MICROBIT, vid=VID_MICROBIT, baud=BAUD, timeout=TIMEOUT):
-        self.serial_port = self.open_serial_port(pid, vid, baud, timeout)
+    def __init__(self, pid=PID_MICROBIT, vid=VID_MICROBIT, baud=BAUD, timeout=TIMEOUT,
+            port=None, metrics=None):
+        # a Metrics to record the time taken by each read and the bytes read
+        self.metrics = metrics
+        self.serial_port = self.open_serial_port(pid, vid, baud, timeout, port)
 
 
     def count_same_ports(self, ports, pid, vid):
@@ -25,12 +38,40 @@ class SerialPort():
 
 
     def get_serial_data(self, serial_port):
-        ''' get serial port data '''
-        inWaiting = serial_port.inWaiting()
-        read_bytes = serial_port.readline(inWaiting)
-        if not read_bytes:
+        ''' get the bytes waiting at the serial port
+        scans may be split or merged, pass the bytes to a ScanFramer '''
+        in_waiting = serial_port.in_waiting
+        if not in_waiting:
             return
-        return read_bytes.decode()
+        if not self.metrics:
+            return serial_port.read(in_waiting)
+        start = perf_counter_ns()
+        read_bytes = serial_port.read(in_waiting)
+        self.metrics.record_since('serial_read', start)
+        self.metrics.count('bytes_read', len(read_bytes))
+        return read_bytes
+
+
+    def wait_serial_data(self, serial_port, timeout):
+        ''' wait up to <timeout> seconds for bytes at the serial port
+        returns the bytes as soon as any arrive, or None '''
+        if hasattr(serial_port, 'fileno'):
+            # posix serial ports can be waited on directly
+            if serial_port.in_waiting:
+                return self.get_serial_data(serial_port)
+            ready, _, _ = select.select([serial_port], [], [], max(timeout, 0))
+            if not ready:
+                return
+            if not serial_port.in_waiting:
+                # ready with nothing waiting is a hang up, which read raises an error for
+                return serial_port.read(1)
+            return self.get_serial_data(serial_port)
+        deadline = monotonic() + timeout
+        while True:
+            read_bytes = self.get_serial_data(serial_port)
+            if read_bytes or monotonic() >= deadline:
+                return read_bytes
+            sleep(WAIT_INTERVAL)
 
 
     def get_serial_port(self):
@@ -38,12 +79,17 @@ class SerialPort():
         return self.serial_port
 
 
-    def open_serial_port(self, pid=PID_MICROBIT, vid=VID_MICROBIT, baud=BAUD, timeout=TIMEOUT):
-        ''' open a serial connection '''
-        print('looking for attached microbit on a serial port')
-        # serial = find_comport(pid, vid, baud)
+    def open_serial_port(self, pid=PID_MICROBIT, vid=VID_MICROBIT, baud=BAUD, timeout=TIMEOUT,
+            port=None):
+        ''' open a serial connection
+        <port> opens that device instead of scanning for a microbit '''
         serial_port = serial.Serial(timeout=timeout)
         serial_port.baudrate = baud
+        if port:
+            serial_port.port = port
+            return self.start_serial_port(serial_port)
+        print('looking for attached microbit on a serial port')
+        # serial = find_comport(pid, vid, baud)
         ports = list(list_ports.comports())
         print('scanning ports')
         num_mb = self.count_same_ports(ports, pid, vid)
@@ -57,19 +103,24 @@ class SerialPort():
                 print('found target device pid: {} vid: {} port: {}'.format(
                     p.pid, p.vid, p.device))
                 serial_port.port = str(p.device)
-        if not serial:
+        if not serial_port.port:
             print('no serial port found')
             return None
+        return self.start_serial_port(serial_port)
+
+
+    def start_serial_port(self, serial_port):
+        ''' open and flush serial_port, return None if it cannot be opened
+        stale input is dropped instead of waiting a fixed time for it '''
         try:
             serial_port.open()
             serial_port.flush()
-            print('opened serial port: {}'.format(serial))
+            serial_port.reset_input_buffer()
+            print('opened serial port: {}'.format(serial_port.port))
         # except (AttributeError, SerialException) as e:
         except Exception as e:
             print('cannot open serial port: {}'.format(e))
             return None
-        # 100ms delay
-        sleep(0.1)
         return serial_port
 
 
@@ -0,0 +1,389 @@
+''' Analyses recorded sessions offline a chunk at a time, so that session
+logs of any size are read in bounded memory.
+The logs are CSV files in the DF_COL_NAMES layout, with the time either as
+an int64 in ns or as a date and time, with or without a header line, or
+binary recordings written by SessionRecorder, see recorder.py. read_chunks
+yields either as RECORD_DTYPE arrays of up to CHUNK_ROWS rows. CSV files are
+parsed by pandas with the explicit CSV_DTYPES and recordings are memory
+mapped, so only the chunk being analysed is held.
+SessionAnalysis makes a single pass over the chunks of a file, keeping for
+each microbit a DeviceStats of:
+- the number of samples, the first and last time and the min, max, mean and
+  standard deviation of mag_acc, from running sums
+- the duplicated, reordered and lost samples found from count, compared as
+  by a SequenceTracker, see sequence_tracker.py, over a chunk at a time
+- the throws, catches, airtimes and throws per minute found by an
+  EventDetector, see juggle_events.py, fed as the live reader feeds it
+and optionally writes mag_acc resampled onto a uniform grid to a CSV file
+of time_ns, id and mag_acc rows with a ResampledExport.
+analyse_files analyses several files, each on its own, optionally spread
+across a pool of processes.
+tail returns the last rows of a file, optionally of one microbit, reading
+back from the end of the file instead of loading it, for
+read_dataframe.get_mag_acc.
+
+python session_analysis.py sessions/*.csv recordings/*.mbrec --processes 4 --export resampled '''
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import json
+from optparse import OptionParser
+import os
+import sys
+
+import numpy as np
+
+from alignment import Aligner
+from juggle_events import CATCH, THROW, EventDetector
+from recorder import RECORD_DTYPE, SUFFIX, open_recording
+from resample import STAGE_ROWS
+from sequence_tracker import COUNT_MODULUS
+
+# rows read from a file at a time
+CHUNK_ROWS = 1 << 20
+DF_COL_NAMES = ['time', 'id', 'count', 'x_acc', 'y_acc', 'z_acc', 'mag_acc']
+# the time is parsed by parse_times, as it may be ns or a date and time
+CSV_DTYPES = {'time': str, 'id': 'int32', 'count': 'int32', 'x_acc': 'int32',
+    'y_acc': 'int32', 'z_acc': 'int32', 'mag_acc': 'int32'}
+# rows passed to the EventDetector at a time, every event of which is kept
+EVENT_ROWS = 65536
+# rate of the resampled export in Hz
+EXPORT_RATE = 50
+EXPORT_SUFFIX = '.resampled.csv'
+EXPORT_DTYPE = np.dtype([('time_ns', 'i8'), ('id', 'i4'), ('mag_acc', 'f8')])
+# bytes read back from the end of a CSV file at a time by tail
+TAIL_BLOCK = 65536
+
+
+def analyse_file(path, chunk_rows=CHUNK_ROWS, export_dir=None, export_rate=EXPORT_RATE):
+    ''' Return the summary of the session in <path>, see SessionAnalysis,
+    writing its resampled mag_acc to <export_dir> if given. '''
+    export_file = None
+    if export_dir:
+        os.makedirs(export_dir, exist_ok=True)
+        export_file = open(os.path.join(export_dir,
+            os.path.basename(path) + EXPORT_SUFFIX), 'w')
+    try:
+        analysis = SessionAnalysis(export_file, export_rate)
+        for records in read_chunks(path, chunk_rows):
+            analysis.add(records)
+        summary = analysis.summary()
+    finally:
+        if export_file:
+            export_file.close()
+    summary['path'] = path
+    return summary
+
+
+def analyse_files(paths, processes=1, **options):
+    ''' Return the summaries of the sessions in <paths>, in order, analysed
+    by up to <processes> processes. <options> are those of analyse_file. '''
+    analyse = partial(analyse_file, **options)
+    if processes > 1 and len(paths) > 1:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            return list(pool.map(analyse, paths))
+    return [analyse(path) for path in paths]
+
+
+def csv_chunks(path, chunk_rows=CHUNK_ROWS):
+    ''' Yield the rows of the CSV file <path> as RECORD_DTYPE arrays of up
+    to <chunk_rows> rows. '''
+    # pandas is slow to import and only needed for CSV files
+    import pandas as pd
+    with open(path) as in_file:
+        header = not is_row(in_file.readline())
+    for frame in pd.read_csv(path, header=0 if header else None, names=DF_COL_NAMES,
+            dtype=CSV_DTYPES, chunksize=chunk_rows):
+        records = np.empty(len(frame), dtype=RECORD_DTYPE)
+        records['time_ns'] = parse_times(frame['time'].to_numpy())
+        for name in DF_COL_NAMES[1:]:
+            records[name] = frame[name].to_numpy()
+        yield records
+
+
+def csv_tail(path, scans, ident=None):
+    ''' Return the last <scans> rows of the CSV file <path>, of microbit
+    <ident> if given, as a RECORD_DTYPE array, reading back from the end
+    TAIL_BLOCK bytes at a time and keeping only the rows wanted. '''
+    found = []
+    with open(path, 'rb') as in_file:
+        position = in_file.seek(0, os.SEEK_END)
+        partial_line = b''
+        while position > 0 and len(found) < scans:
+            size = min(TAIL_BLOCK, position)
+            position -= size
+            in_file.seek(position)
+            lines = (in_file.read(size) + partial_line).split(b'\n')
+            # the first line may carry on from the block before
+            partial_line = lines.pop(0) if position else b''
+            for line in reversed(lines):
+                if is_row(line, ident):
+                    found.append(line)
+                    if len(found) == scans:
+                        break
+    fields = [line.decode().strip().split(',') for line in reversed(found)]
+    records = np.empty(len(fields), dtype=RECORD_DTYPE)
+    records['time_ns'] = parse_times(np.array([row[0] for row in fields], dtype=object))
+    for column, name in enumerate(DF_COL_NAMES[1:], 1):
+        records[name] = [int(row[column]) for row in fields]
+    return records
+
+
+def is_row(line, ident=None):
+    ''' Return True if <line> of a CSV file is a row, not a header or blank,
+    of microbit <ident> if given. '''
+    fields = line.split(b',' if isinstance(line, bytes) else ',')
+    if len(fields) != len(DF_COL_NAMES) or not fields[1].strip().isdigit():
+        return False
+    return ident is None or int(fields[1]) == ident
+
+
+def parse_times(values):
+    ''' Return the times in the CSV time column <values> as int64 ns. '''
+    try:
+        return values.astype(np.int64)
+    except ValueError:
+        return values.astype('datetime64[ns]').astype(np.int64)
+
+
+def read_chunks(path, chunk_rows=CHUNK_ROWS):
+    ''' Yield the rows of the session log or recording <path> as RECORD_DTYPE
+    arrays of up to <chunk_rows> rows. '''
+    if path.endswith(SUFFIX):
+        return recording_chunks(path, chunk_rows)
+    return csv_chunks(path, chunk_rows)
+
+
+def recording_chunks(path, chunk_rows=CHUNK_ROWS):
+    ''' Yield the records of the recording <path> in chunks of <chunk_rows>,
+    read only views of the memory map. '''
+    records = open_recording(path)
+    for start in range(0, len(records), chunk_rows):
+        yield records[start:start + chunk_rows]
+
+
+def tail(path, scans, ident=None):
+    ''' Return the last <scans> rows of the session log or recording <path>,
+    of microbit <ident> if given, as a RECORD_DTYPE array, without loading
+    the whole file. '''
+    if not path.endswith(SUFFIX):
+        return csv_tail(path, scans, ident)
+    records = open_recording(path)
+    if ident is None:
+        return np.array(records[max(len(records) - scans, 0):])
+    found = []
+    end = len(records)
+    while end > 0 and sum(len(rows) for rows in found) < scans:
+        start = max(end - CHUNK_ROWS, 0)
+        rows = records[start:end]
+        found.insert(0, np.array(rows[rows['id'] == ident]))
+        end = start
+    return np.concatenate(found)[-scans:] if found else np.zeros(0, dtype=RECORD_DTYPE)
+
+
+class DeviceStats():
+    ''' The statistics of one microbit, added to a chunk at a time. '''
+    def __init__(self, modulus=COUNT_MODULUS):
+        self.modulus = modulus
+        self.samples = 0
+        self.first_time = None
+        self.last_time = None
+        self.mag_min = None
+        self.mag_max = None
+        self.mag_sum = 0.0
+        self.mag_squares = 0.0
+        # the last count, unwrapped, and the newest count so far
+        self.last_count = None
+        self.newest_count = None
+        self.duplicated = 0
+        self.reordered = 0
+        self.gaps = 0
+        self.throws = 0
+        self.catches = 0
+        self.airtime_sum = 0
+        self.airtime_max = 0
+        self.peak_rate = 0.0
+
+
+    def add(self, times, counts, mags):
+        ''' Add the samples of this microbit from a chunk, in the order they were taken. '''
+        if self.first_time is None:
+            self.first_time = int(times[0])
+            self.mag_min = self.mag_max = int(mags[0])
+        self.samples += len(times)
+        self.last_time = int(times[-1])
+        self.mag_min = min(self.mag_min, int(mags.min()))
+        self.mag_max = max(self.mag_max, int(mags.max()))
+        mags = mags.astype(np.float64)
+        self.mag_sum += mags.sum()
+        self.mag_squares += (mags * mags).sum()
+        self.add_counts(counts.astype(np.int64))
+
+
+    def add_counts(self, counts):
+        ''' Count the duplicated and reordered samples and the gaps. Each count
+        is unwrapped from the one before, then compared with the newest so
+        far, as SequenceTracker compares it with the last in order count. '''
+        if self.last_count is None:
+            self.last_count = self.newest_count = int(counts[0])
+            counts = counts[1:]
+            if not len(counts):
+                return
+        steps = np.diff(counts, prepend=self.last_count % self.modulus) % self.modulus
+        steps[steps > self.modulus // 2] -= self.modulus
+        unwrapped = self.last_count + np.cumsum(steps)
+        newest = np.maximum.accumulate(np.concatenate(([self.newest_count], unwrapped)))
+        steps = unwrapped - newest[:-1]
+        self.duplicated += int((steps == 0).sum())
+        self.reordered += int((steps < 0).sum())
+        self.gaps += int((steps[steps > 0] - 1).sum())
+        self.last_count = int(unwrapped[-1])
+        self.newest_count = int(newest[-1])
+
+
+    def add_event(self, kind, airtime_ns, rate):
+        ''' Add a throw or a catch found by the EventDetector. '''
+        if kind == THROW:
+            self.throws += 1
+            self.peak_rate = max(self.peak_rate, rate)
+        elif kind == CATCH:
+            self.catches += 1
+            self.airtime_sum += airtime_ns
+            self.airtime_max = max(self.airtime_max, airtime_ns)
+
+
+    def summary(self):
+        ''' Return a dict of the statistics. '''
+        duration = (self.last_time - self.first_time) / 1e9
+        mean = float(self.mag_sum / self.samples)
+        return {
+            'samples': self.samples,
+            'first_time_ns': self.first_time,
+            'last_time_ns': self.last_time,
+            'duration_s': duration,
+            'rate': (self.samples - 1) / duration if duration > 0 else 0.0,
+            'mag_min': self.mag_min,
+            'mag_max': self.mag_max,
+            'mag_mean': mean,
+            'mag_std': max(float(self.mag_squares / self.samples) - mean * mean, 0.0) ** 0.5,
+            'duplicated': self.duplicated,
+            'reordered': self.reordered,
+            # a reordered sample fills in one lost in a gap
+            'lost': max(self.gaps - self.reordered, 0),
+            'throws': self.throws,
+            'catches': self.catches,
+            'throws_per_minute': self.throws * 60 / duration if duration > 0 else 0.0,
+            'peak_throws_per_minute': self.peak_rate,
+            'mean_airtime_ms': self.airtime_sum / self.catches / 1e6 if self.catches else 0.0,
+            'max_airtime_ms': self.airtime_max / 1e6,
+        }
+
+
+class ResampledExport(Aligner):
+    ''' An Aligner which writes the columns it fills to <out_file> as CSV
+    rows of time_ns, id and mag_acc, in time order, instead of keeping them. '''
+    def __init__(self, out_file, sample_rate=EXPORT_RATE):
+        self.out_file = out_file
+        self.out_file.write(','.join(EXPORT_DTYPE.names) + '\n')
+        # the staged samples are only flushed once STAGE_ROWS have arrived
+        super().__init__(sample_rate=sample_rate, window=1, flush_columns=STAGE_ROWS)
+
+
+    def add(self, devices, times, mags, starts, lengths, restart):
+        ''' Write the new columns of each microbit in <devices>, see StagedResampler.add. '''
+        ids, columns, values = self.fill(devices, times, mags, starts, lengths, restart)
+        order = np.lexsort((ids, columns))
+        rows = np.empty(len(order), dtype=EXPORT_DTYPE)
+        rows['time_ns'] = columns[order] * self.period_ns
+        rows['id'] = ids[order]
+        rows['mag_acc'] = values[order]
+        np.savetxt(self.out_file, rows, fmt=['%d', '%d', '%.1f'], delimiter=',')
+
+
+    def close(self):
+        ''' Write the columns of the samples still staged. '''
+        with self.lock:
+            self.flush()
+
+
+class SessionAnalysis():
+    def __init__(self, export_file=None, export_rate=EXPORT_RATE):
+        ''' <export_file> is an open text file for the resampled mag_acc, at <export_rate>. '''
+        self.rows = 0
+        self.chunks = 0
+        # the DeviceStats of each microbit id
+        self.devices = {}
+        self.detector = EventDetector(max_events=EVENT_ROWS)
+        self.event_sequence = 0
+        self.export = ResampledExport(export_file, export_rate) if export_file else None
+
+
+    def add(self, records):
+        ''' Add a chunk of RECORD_DTYPE <records>, in the order they were stored. '''
+        if not len(records):
+            return
+        self.rows += len(records)
+        self.chunks += 1
+        ids = records['id']
+        order = np.argsort(ids, kind='stable')
+        sorted_ids = ids[order]
+        starts = np.flatnonzero(np.concatenate(([True], sorted_ids[1:] != sorted_ids[:-1])))
+        ends = np.append(starts[1:], len(order))
+        for start, end in zip(starts, ends):
+            ident = int(sorted_ids[start])
+            rows = records[order[start:end]]
+            stats = self.devices.get(ident)
+            if stats is None:
+                stats = self.devices[ident] = DeviceStats()
+            stats.add(rows['time_ns'], rows['count'], rows['mag_acc'])
+        for start in range(0, len(records), EVENT_ROWS):
+            rows = records[start:start + EVENT_ROWS]
+            self.detector.process(rows['time_ns'], rows['id'], rows['mag_acc'])
+            self.event_sequence, events = self.detector.events_since(self.event_sequence)
+            for _, ident, kind, airtime_ns, rate in events:
+                self.devices[ident].add_event(kind, airtime_ns, rate)
+        if self.export:
+            self.export.process(records['time_ns'], records['id'], records['mag_acc'])
+
+
+    def summary(self):
+        ''' Return a dict of the rows and chunks read and the statistics of
+        each microbit by id, finishing the export. '''
+        if self.export:
+            self.export.close()
+        return {'rows': self.rows, 'chunks': self.chunks, 'devices':
+            {ident: stats.summary() for ident, stats in sorted(self.devices.items())}}
+
+
+def main():
+    parser = OptionParser(usage='%prog [options] FILE...')
+    parser.add_option('--processes', type='int', default=1,
+                help='Number of processes to analyse the files with')
+    parser.add_option('--chunk-rows', type='int', default=CHUNK_ROWS,
+                help='Rows read from a file at a time')
+    parser.add_option('--export', default=None,
+                help='Directory to write the resampled mag_acc of each file to')
+    parser.add_option('--rate', type='float', default=EXPORT_RATE,
+                help='Rate of the resampled mag_acc in Hz')
+    parser.add_option('--json', action='store_true', default=False,
+                help='Print each summary as a JSON line')
+    (options, paths) = parser.parse_args()
+    if not paths:
+        parser.error('no session files given')
+    summaries = analyse_files(paths, options.processes, chunk_rows=options.chunk_rows,
+        export_dir=options.export, export_rate=options.rate)
+    for summary in summaries:
+        if options.json:
+            print(json.dumps(summary))
+            continue
+        print('{}: {} rows'.format(summary['path'], summary['rows']))
+        for ident, stats in summary['devices'].items():
+            print('mb_{} samples: {} {:0.1f}/s mag_acc: {:0.0f} +/- {:0.0f} lost: {} '
+                'duplicated: {} reordered: {} throws: {} {:0.1f}/min airtime: {:0.0f} ms'.format(
+                ident, stats['samples'], stats['rate'], stats['mag_mean'], stats['mag_std'],
+                stats['lost'], stats['duplicated'], stats['reordered'], stats['throws'],
+                stats['throws_per_minute'], stats['mean_airtime_ms']))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
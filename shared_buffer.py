@@ -0,0 +1,302 @@
+''' Run ReadMicrobits in a separate process with a shared memory sample buffer.
+Serial reading and parsing then no longer compete with the display for the GIL.
+
+The reader process writes scans into one ring buffer per microbit held in a
+multiprocessing.shared_memory block. The display process maps the same block
+read only and takes snapshots the same way as from ReadMicrobits.
+
+Shared memory layout, all int64 apart from the rows:
+header: HEADER_FIELDS
+one counter block per microbit: DEVICE_FIELDS
+one ring of 2 * capacity SCAN_DTYPE rows per microbit, as in RingBuffer
+
+The reader updates the heartbeat on every pass of its loop. The display can tell that
+the reader has stalled or died from the heartbeat and the process state,
+and carries on drawing the last samples it has. '''
+
+import logging
+from multiprocessing import Process, shared_memory
+import os
+import sys
+from time import monotonic_ns, sleep
+
+import numpy as np
+
+from read_microbits import MAX_ROWS, ReadMicrobits
+from ring_buffer import RingBuffer, SCAN_DTYPE
+
+HEADER_FIELDS = ['magic', 'num_microbits', 'capacity', 'heartbeat_ns',
+    'writer_pid', 'state']
+DEVICE_FIELDS = ['sequence', 'index', 'length', 'last_count']
+MAGIC = 0x6d626a67
+# no count received yet, counts from the microbits are never negative
+NO_COUNT = -1
+# values of the state field
+STARTING = 0
+RUNNING = 1
+STOP_REQUESTED = 2
+STOPPED = 3
+# seqlock retries before a reader gives up on a writer which died mid write
+MAX_RETRIES = 1000
+MAX_RESTARTS = 3
+STALL_TIMEOUT = 2.0
+JOIN_TIMEOUT = 2.0
+
+
+def buffer_size(num_microbits, capacity):
+    ''' Return the number of bytes needed for the shared buffer. '''
+    return (8 * (len(HEADER_FIELDS) + num_microbits * len(DEVICE_FIELDS))
+        + num_microbits * 2 * capacity * SCAN_DTYPE.itemsize)
+
+
+class SharedRingBuffer(RingBuffer):
+    ''' RingBuffer whose rows and counters are held in shared memory. '''
+    def __init__(self, data, counters):
+        self.capacity = len(data) // 2
+        self.check_count = True
+        self.data = data
+        self.counters = counters
+
+
+    def counter(field):
+        ''' Make a property for one of the DEVICE_FIELDS. '''
+        i = DEVICE_FIELDS.index(field)
+        def get(self):
+            return int(self.counters[i])
+        def set(self, value):
+            self.counters[i] = value
+        return property(get, set)
+
+    sequence = counter('sequence')
+    index = counter('index')
+    length = counter('length')
+    _last_count = counter('last_count')
+    del counter
+
+
+    @property
+    def last_count(self):
+        count = self._last_count
+        if count == NO_COUNT:
+            return None
+        return count
+
+
+    @last_count.setter
+    def last_count(self, count):
+        self._last_count = NO_COUNT if count is None else count
+
+
+    def snapshot(self, num_rows=None, column=None, copy=False):
+        ''' As RingBuffer.snapshot, but never spins for ever on a dead writer. '''
+        for _ in range(MAX_RETRIES):
+            sequence = self.sequence
+            if sequence & 1:
+                sleep(0)
+                continue
+            view = self.tail(num_rows)
+            if column:
+                view = view[column]
+            if copy:
+                view = view.copy()
+            if self.sequence == sequence:
+                return view
+        logging.info('shared_buffer: inconsistent snapshot')
+        view = self.tail(num_rows)
+        if column:
+            view = view[column]
+        return view.copy() if copy else view
+
+
+class SharedSampleBuffer():
+    def __init__(self, num_microbits=3, capacity=MAX_ROWS, name=None, readonly=False):
+        ''' Create a new shared buffer, or attach to the one called <name>. '''
+        self.readonly = readonly
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True,
+                size=buffer_size(num_microbits, capacity))
+            self.owner = True
+        else:
+            self.shm = self.attach(name)
+            self.owner = False
+        self.name = self.shm.name
+        num_header = len(HEADER_FIELDS)
+        self.header = np.ndarray((num_header,), dtype=np.int64, buffer=self.shm.buf)
+        if self.owner:
+            self.header[:] = 0
+            self.header[HEADER_FIELDS.index('magic')] = MAGIC
+            self.header[HEADER_FIELDS.index('num_microbits')] = num_microbits
+            self.header[HEADER_FIELDS.index('capacity')] = capacity
+        elif self.header[HEADER_FIELDS.index('magic')] != MAGIC:
+            raise ValueError('shared memory {} is not a sample buffer'.format(name))
+        num_microbits = self.num_microbits = int(self.header[HEADER_FIELDS.index('num_microbits')])
+        capacity = self.capacity = int(self.header[HEADER_FIELDS.index('capacity')])
+        counters = np.ndarray((num_microbits, len(DEVICE_FIELDS)), dtype=np.int64,
+            buffer=self.shm.buf, offset=8 * num_header)
+        offset = 8 * (num_header + counters.size)
+        rows = np.ndarray((num_microbits, 2 * capacity), dtype=SCAN_DTYPE,
+            buffer=self.shm.buf, offset=offset)
+        if self.owner:
+            counters[:] = 0
+            counters[:, DEVICE_FIELDS.index('last_count')] = NO_COUNT
+        if readonly:
+            for array in (self.header, counters, rows):
+                array.flags.writeable = False
+        self.df_dict = {'mb_{}'.format(i): SharedRingBuffer(rows[i], counters[i])
+            for i in range(num_microbits)}
+
+
+    def attach(self, name):
+        ''' Open an existing shared memory block without taking ownership of it. '''
+        try:
+            return shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # before python 3.13 there is no track option, the reader process
+            # shares the resource tracker of the process which created the block
+            return shared_memory.SharedMemory(name=name)
+
+
+    def close(self):
+        ''' Unmap the buffer, and remove it if this process created it. '''
+        self.header = None
+        self.df_dict = {}
+        try:
+            self.shm.close()
+        except BufferError:
+            # a snapshot view is still held, the mapping goes when it is freed
+            logging.info('shared_buffer: snapshot still in use at close')
+        if self.owner:
+            self.shm.unlink()
+
+
+    def get_field(self, field):
+        return int(self.header[HEADER_FIELDS.index(field)])
+
+
+    def heartbeat(self):
+        ''' Record that the writer is alive. '''
+        self.header[HEADER_FIELDS.index('heartbeat_ns')] = monotonic_ns()
+
+
+    def heartbeat_age(self):
+        ''' Return the seconds since the last heartbeat, None if there has not been one. '''
+        heartbeat = self.get_field('heartbeat_ns')
+        if not heartbeat:
+            return None
+        return (monotonic_ns() - heartbeat) / 1e9
+
+
+    def set_field(self, field, value):
+        self.header[HEADER_FIELDS.index(field)] = value
+
+
+    def sequences(self):
+        ''' Return a dict {mb_id: sequence of its ring}, which changes whenever a row is stored. '''
+        return {mb: ring.sequence for mb, ring in self.df_dict.items()}
+
+
+    def snapshot(self, num_samples=MAX_ROWS, column='mag_acc', mbs=None, copy=False):
+        ''' Return a dict {mb_id: read only numpy view of the last num_samples},
+        for the microbits in <mbs>, or every microbit, or copies with copy=True. '''
+        df_dict = self.df_dict
+        return {mb: df_dict[mb].snapshot(num_samples, column, copy)
+            for mb in (df_dict if mbs is None else mbs)}
+
+
+class SharedMemoryReader(ReadMicrobits):
+    ''' ReadMicrobits which stores its scans in a SharedSampleBuffer. '''
+    def __init__(self, shared, run_main=True):
+        self.shared = shared
+        super().__init__(num_microbits=shared.num_microbits, run_main=False,
+            ring_rows=shared.capacity)
+        self.df_dict = shared.df_dict
+        self.route_devices()
+        shared.set_field('writer_pid', os.getpid())
+        shared.set_field('state', RUNNING)
+        shared.heartbeat()
+        if run_main:
+            self.main()
+
+
+    def heartbeat(self):
+        ''' Update the shared heartbeat and check for a stop request. '''
+        self.shared.heartbeat()
+        if self.shared.get_field('state') == STOP_REQUESTED:
+            self.stop()
+
+
+def run_reader(name, argv):
+    ''' Entry point of the reader process. '''
+    sys.argv = argv
+    shared = SharedSampleBuffer(name=name)
+    try:
+        SharedMemoryReader(shared)
+    finally:
+        shared.set_field('state', STOPPED)
+        shared.close()
+
+
+class AcquisitionProcess():
+    ''' Starts, watches and stops ReadMicrobits running in its own process. '''
+    def __init__(self, num_microbits=3, capacity=MAX_ROWS, max_restarts=MAX_RESTARTS):
+        self.shared = SharedSampleBuffer(num_microbits, capacity)
+        # the display only reads, through its own read only mapping
+        self.view = SharedSampleBuffer(name=self.shared.name, readonly=True)
+        self.max_restarts = max_restarts
+        self.restarts = 0
+        self.process = None
+        self.stopping = False
+
+
+    def check(self):
+        ''' Restart the reader process if it has died. Returns a status string. '''
+        if self.process is None or self.stopping:
+            return 'stopped'
+        if not self.process.is_alive():
+            logging.info('reader process exited with code {}'.format(self.process.exitcode))
+            if self.restarts >= self.max_restarts:
+                return 'reader died, exit code {}'.format(self.process.exitcode)
+            self.restarts += 1
+            self.start()
+            return 'reader restarted'
+        age = self.shared.heartbeat_age()
+        if age is not None and age > STALL_TIMEOUT:
+            return 'reader stalled for {:0.1f} s'.format(age)
+        return 'reader running'
+
+
+    def sequences(self):
+        ''' Return the sequence of the ring of each microbit, see SharedSampleBuffer. '''
+        return self.view.sequences()
+
+
+    def snapshot(self, num_samples=MAX_ROWS, column='mag_acc', mbs=None, copy=False):
+        ''' Return read only views, or copies, of the latest samples. Never
+        blocks on the reader. '''
+        return self.view.snapshot(num_samples, column, mbs, copy)
+
+
+    def start(self):
+        ''' Start the reader process. '''
+        self.shared.set_field('state', STARTING)
+        for ring in self.shared.df_dict.values():
+            # a reader which died mid write left its sequence odd, which would
+            # make every snapshot of that ring retry until it gave up
+            ring.sequence += ring.sequence & 1
+        self.process = Process(target=run_reader, args=(self.shared.name, sys.argv),
+            name='read_microbits', daemon=True)
+        self.process.start()
+
+
+    def stop(self):
+        ''' Ask the reader to stop, then remove the shared buffer. '''
+        self.stopping = True
+        if self.process is not None and self.process.is_alive():
+            self.shared.set_field('state', STOP_REQUESTED)
+            self.process.join(JOIN_TIMEOUT)
+            if self.process.is_alive():
+                logging.info('reader process did not stop, terminating')
+                self.process.terminate()
+                self.process.join()
+        self.view.close()
+        self.shared.close()
@@ -0,0 +1,162 @@
+''' Works out the spectrum of mag_acc of each microbit as the samples arrive.
+Juggling is periodic, so the spectrum shows the rhythm of each ball as a
+peak at its dominant frequency.
+The samples of a microbit do not arrive at a steady rate, so they are first
+resampled onto a uniform grid of its own at SAMPLE_RATE by linear
+interpolation between the sample times. Spectrum is a StagedResampler, see
+resample.py, which resamples the samples of every microbit together every
+HOP periods of the grid, carrying the next grid time of each microbit over
+to the next flush. A restart, after a gap or a seek, starts the grid again.
+The resampled values of every microbit are held in one devices x BLOCK_SIZE
+array of rings. Each time HOP new values have arrived for a microbit its
+last BLOCK_SIZE values, less their mean, are windowed with a Hann window
+and transformed, together with those of every other microbit due in the
+same batch, with one rfft over the rows. The overlapped blocks cost
+BLOCK_SIZE log BLOCK_SIZE / HOP per sample, whatever the length of the
+session, and the state kept for each microbit is fixed in size.
+The dominant frequency is the largest peak from MIN_FREQ to MAX_FREQ,
+refined between the bins by fitting a parabola through the log magnitudes
+either side of it. '''
+
+import numpy as np
+
+from resample import MAX_GAP_NS, StagedResampler, interpolate
+
+# rate of the uniform grid the samples are resampled onto in Hz
+SAMPLE_RATE = 50
+# values in each transformed block, about 5 seconds
+BLOCK_SIZE = 256
+# new values between the transforms of a microbit
+HOP = 16
+# band searched for the dominant frequency in Hz, juggling is a few throws a second
+MIN_FREQ = 0.5
+MAX_FREQ = 10.0
+
+
+class Spectrum(StagedResampler):
+    def __init__(self, num_microbits=3, sample_rate=SAMPLE_RATE, block_size=BLOCK_SIZE,
+            hop=HOP, min_freq=MIN_FREQ, max_freq=MAX_FREQ, max_gap_ns=MAX_GAP_NS):
+        self.period_ns = 1e9 / sample_rate
+        self.block_size = block_size
+        self.hop = hop
+        self.frequencies = np.fft.rfftfreq(block_size, 1 / sample_rate)
+        self.band = np.flatnonzero((self.frequencies >= min_freq)
+            & (self.frequencies <= max_freq))
+        self.window = np.hanning(block_size)
+        # scales the magnitudes to the amplitude of a sine wave in milli-g
+        self.scale = 2 / self.window.sum()
+        # the samples are resampled each time a hop of values could be due
+        super().__init__(num_microbits, hop * self.period_ns, max_gap_ns)
+
+
+    def add(self, devices, times, mags, starts, lengths, restart):
+        ''' Add the values on the grid of each microbit in <devices> up to its
+        newest sample, see StagedResampler.add, and transform the blocks of
+        the microbits which are due. '''
+        if restart.any():
+            # start again from the first sample
+            self.filled[devices[restart]] = 0
+            self.pending[devices[restart]] = 0
+            self.next_time[devices[restart]] = times[starts[restart]]
+        newest = times[starts + lengths - 1]
+        next_time = self.next_time[devices]
+        num_values = np.maximum((newest - next_time) // self.period_ns + 1, 0).astype(np.int64)
+        self.next_time[devices] = next_time + num_values * self.period_ns
+        # only the last block_size values of a long stretch are kept
+        kept = np.minimum(num_values, self.block_size)
+        total = int(kept.sum())
+        if total:
+            stretches = np.repeat(np.arange(len(devices)), kept)
+            position = np.arange(total) - np.repeat(np.cumsum(kept) - kept, kept)
+            grid = next_time[stretches] + (position + (num_values - kept)[stretches]) * self.period_ns
+            values = interpolate(grid, stretches, times, mags, starts, lengths)
+            index = self.index[devices]
+            self.blocks[devices[stretches], (index[stretches] + position) % self.block_size] = values
+            self.index[devices] = (index + kept) % self.block_size
+            self.filled[devices] = np.minimum(self.filled[devices] + kept, self.block_size)
+            self.pending[devices] += num_values
+        due = np.flatnonzero(self.pending >= self.hop)
+        if len(due):
+            self.transform(due)
+
+
+    def create_state(self, num_microbits):
+        ''' Start every microbit with no samples. '''
+        super().create_state(num_microbits)
+        self.blocks = np.zeros((num_microbits, self.block_size), dtype=np.float64)
+        # next value to write in each ring of blocks
+        self.index = np.zeros(num_microbits, dtype=np.int64)
+        # values held in each ring, up to block_size
+        self.filled = np.zeros(num_microbits, dtype=np.int64)
+        # values added since the last transform
+        self.pending = np.zeros(num_microbits, dtype=np.int64)
+        # time of the next grid point of each microbit
+        self.next_time = np.zeros(num_microbits, dtype=np.float64)
+        self.spectra = np.zeros((num_microbits, len(self.frequencies)), dtype=np.float32)
+        self.dominant = np.zeros(num_microbits, dtype=np.float64)
+        # number of transforms of each microbit, changes when its spectrum does
+        self.transforms = np.zeros(num_microbits, dtype=np.int64)
+
+
+    def dominant_frequencies(self):
+        ''' Return {id: dominant frequency in Hz} for each microbit with a spectrum. '''
+        with self.lock:
+            return {int(ident): float(self.dominant[ident])
+                for ident in np.flatnonzero(self.transforms)}
+
+
+    def peaks(self, magnitudes):
+        ''' Return the dominant frequency of each row of <magnitudes>. '''
+        band = magnitudes[:, self.band]
+        peak = band.argmax(axis=1)
+        rows = np.arange(len(band))
+        # a parabola through the log magnitudes of the peak bin and its neighbours
+        inside = (peak > 0) & (peak < band.shape[1] - 1)
+        offset = np.zeros(len(band))
+        if inside.any():
+            log = np.log(band[rows[inside, None], peak[inside, None] + [-1, 0, 1]] + 1e-9)
+            curve = log[:, 0] - 2 * log[:, 1] + log[:, 2]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                offset[inside] = np.where(curve < 0, 0.5 * (log[:, 0] - log[:, 2]) / curve, 0)
+        step = self.frequencies[1]
+        return self.frequencies[self.band[peak]] + offset * step
+
+
+    def sequences(self):
+        ''' Return {id: sequence}, where the sequence of a microbit changes
+        whenever its spectrum does. '''
+        with self.lock:
+            return {int(ident): int(self.transforms[ident])
+                for ident in np.flatnonzero(self.transforms)}
+
+
+    def spectrum(self, ident):
+        ''' Return (frequencies in Hz, a copy of the magnitudes in milli-g) of
+        microbit <ident>, or None if it has no spectrum yet. '''
+        with self.lock:
+            if ident >= len(self.transforms) or not self.transforms[ident]:
+                return None
+            return self.frequencies, self.spectra[ident].copy()
+
+
+    def state(self):
+        ''' Return the arrays of the state of every microbit, for grow. '''
+        return super().state() + [self.blocks, self.index, self.filled, self.pending,
+            self.next_time, self.spectra, self.dominant, self.transforms]
+
+
+    def transform(self, due):
+        ''' Transform the last block_size values of each microbit in <due>
+        which has that many. '''
+        self.pending[due] = 0
+        due = due[self.filled[due] >= self.block_size]
+        if not len(due):
+            return
+        # each ring in time order, oldest first
+        columns = (self.index[due, None] + np.arange(self.block_size)) % self.block_size
+        blocks = self.blocks[due[:, None], columns]
+        blocks -= blocks.mean(axis=1, keepdims=True)
+        magnitudes = np.abs(np.fft.rfft(blocks * self.window, axis=1)) * self.scale
+        self.spectra[due] = magnitudes
+        self.dominant[due] = self.peaks(magnitudes)
+        self.transforms[due] += 1
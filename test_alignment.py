@@ -0,0 +1,85 @@
+''' Tests for the columns filled by Aligner and the lags found by correlate. '''
+
+import numpy as np
+
+from alignment import Aligner
+
+# samples of each microbit a second, polled one after another
+POLL_RATE = 80
+# seconds microbit 1 follows microbit 0 by in test_lag
+DELAY = 0.2
+
+
+def signal(seconds):
+    ''' A throw-like signal which does not repeat within a second. '''
+    return 1000 + sum(amplitude * np.sin(2 * np.pi * frequency * seconds + phase)
+        for amplitude, frequency, phase in ((300, 0.7, 0), (200, 1.3, 1), (100, 2.9, 2)))
+
+
+def polled(num_microbits, seconds, delays=None, seed=0):
+    ''' Return the times, ids and mags of microbits polled in turn for
+    <seconds>, each sampling the signal <delays>[id] seconds late. '''
+    rng = np.random.default_rng(seed)
+    num_polls = int(seconds * POLL_RATE)
+    ids = np.tile(np.arange(num_microbits), num_polls)
+    times = (np.repeat(np.arange(num_polls), num_microbits) + (ids + rng.random(
+        len(ids)) * 0.5) / num_microbits) * (1e9 / POLL_RATE)
+    delays = np.zeros(num_microbits) if delays is None else np.array(delays)
+    mags = signal(times / 1e9 - delays[ids])
+    return times.astype(np.int64), ids, mags
+
+
+def feed(aligner, times, ids, mags, batch=24):
+    for start in range(0, len(ids), batch):
+        aligner.process(times[start:start + batch], ids[start:start + batch],
+            mags[start:start + batch])
+
+
+def test_fill_matches_interp():
+    aligner = Aligner(3)
+    times, ids, mags = polled(3, 5)
+    feed(aligner, times, ids, mags)
+    column_times, matrix = aligner.window()
+    assert matrix.shape == (3, len(column_times))
+    assert len(column_times) > 200
+    assert (np.diff(column_times) == aligner.period_ns).all()
+    for ident in range(3):
+        mine = ids == ident
+        inside = column_times >= times[mine][0]
+        expected = np.interp(column_times[inside], times[mine], mags[mine])
+        assert np.allclose(matrix[ident, inside], expected)
+        # no samples before the first
+        assert np.isnan(matrix[ident, ~inside]).all()
+
+
+def test_gap_is_nan():
+    aligner = Aligner(2)
+    times, ids, mags = polled(2, 4)
+    # microbit 1 goes quiet for a second
+    quiet = (ids == 1) & (times > 2e9) & (times < 3e9)
+    feed(aligner, times[~quiet], ids[~quiet], mags[~quiet])
+    column_times, matrix = aligner.window()
+    in_gap = (column_times > 2.1e9) & (column_times < 2.9e9)
+    assert np.isnan(matrix[1, in_gap]).all()
+    assert not np.isnan(matrix[0, in_gap]).any()
+
+
+def test_lag():
+    aligner = Aligner(2)
+    feed(aligner, *polled(2, 8, delays=[0, DELAY]))
+    lags = aligner.correlate()
+    # a positive lag means that microbit a follows microbit b
+    lag, correlation = lags[(0, 1)]
+    assert abs(lag + DELAY) < 0.01
+    assert correlation > 0.95
+    lag, _ = aligner.correlate(pairs=[(1, 0)])[(1, 0)]
+    assert abs(lag - DELAY) < 0.01
+
+
+def test_reset():
+    aligner = Aligner(2)
+    feed(aligner, *polled(2, 4))
+    aligner.reset()
+    column_times, matrix = aligner.window()
+    assert len(column_times) == 0
+    assert aligner.correlate() == {}
@@ -0,0 +1,51 @@
+''' Tests for the host time estimates of ClockEstimator. '''
+
+import numpy as np
+
+from clock_sync import COUNT_MODULUS, SAMPLE_PERIOD_NS, ClockEstimator
+
+# the device clock runs this much slow against the host
+DRIFT = 1e-4
+LEAST_LATENCY_NS = 2000000
+
+
+def simulate(num_samples, first_count=0, seed=0):
+    ''' Return (raw counts, true sample times, arrival times) of a drifting
+    device whose samples arrive after a random latency. '''
+    rng = np.random.default_rng(seed)
+    counts = np.arange(num_samples)
+    sampled = 10 ** 9 + (counts * SAMPLE_PERIOD_NS * (1 + DRIFT)).astype(np.int64)
+    latency = LEAST_LATENCY_NS + rng.exponential(3e6, num_samples).astype(np.int64)
+    return (first_count + counts) % COUNT_MODULUS, sampled, sampled + latency
+
+
+def test_converges_to_least_latency():
+    clock = ClockEstimator()
+    raw_counts, sampled, arrived = simulate(6000)
+    estimates = np.array([clock.update(int(count), int(host_ns))
+        for count, host_ns in zip(raw_counts, arrived)])
+    assert (estimates <= arrived).all()
+    # once fitted, every sample is placed at its time plus the least latency
+    error = estimates[-1000:] - (sampled[-1000:] + LEAST_LATENCY_NS)
+    assert np.abs(error).max() < 200000
+    assert abs(clock.drift_ppm() + DRIFT * 1e6) < 10
+
+
+def test_count_wraps():
+    clock = ClockEstimator()
+    raw_counts, sampled, arrived = simulate(6000, first_count=COUNT_MODULUS - 3000)
+    estimates = np.array([clock.update(int(count), int(host_ns))
+        for count, host_ns in zip(raw_counts, arrived)])
+    assert (np.diff(estimates[-4000:]) > 0).all()
+    error = estimates[-1000:] - (sampled[-1000:] + LEAST_LATENCY_NS)
+    assert np.abs(error).max() < 200000
+
+
+def test_late_sample_keeps_its_count_time():
+    clock = ClockEstimator()
+    raw_counts, sampled, arrived = simulate(4000)
+    for count, host_ns in zip(raw_counts, arrived):
+        clock.update(int(count), int(host_ns))
+    # a reordered sample, delivered after later ones
+    late = clock.update(int(raw_counts[-10]), int(arrived[-1]))
+    assert abs(late - (sampled[-10] + LEAST_LATENCY_NS)) < 200000
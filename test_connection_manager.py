@@ -0,0 +1,115 @@
+''' Tests for the reconnect backoff of ConnectionManager, with its clock injected. '''
+
+import os
+
+import pytest
+
+import connection_manager
+from connection_manager import BACKOFF_MAX, BACKOFF_MIN, ConnectionManager
+from metrics import Metrics
+
+
+class Clock():
+    ''' Stands in for monotonic_ns and for the closing Event, whose wait
+    moves the clock on instead of sleeping. '''
+    def __init__(self):
+        self.now_ns = 10 ** 12
+        self.waits = []
+        self.closed = False
+        # close after this many waits, if set
+        self.close_after = None
+
+    def __call__(self):
+        return self.now_ns
+
+    def is_set(self):
+        return self.closed
+
+    def set(self):
+        self.closed = True
+
+    def wait(self, timeout):
+        self.waits.append(timeout)
+        self.now_ns += int(timeout * 1e9)
+        if self.close_after is not None and len(self.waits) >= self.close_after:
+            self.closed = True
+        return self.closed
+
+
+@pytest.fixture
+def connection(monkeypatch):
+    ''' A ConnectionManager on a pty, whose reopen fails <failures> times. '''
+    master, slave = os.openpty()
+    clock = Clock()
+    monkeypatch.setattr(connection_manager, 'monotonic_ns', clock)
+    connection = ConnectionManager(port=os.ttyname(slave), metrics=Metrics())
+    connection.closing = clock
+    connection.clock = clock
+    connection.failures = 0
+    attempts = []
+
+    def reopen():
+        attempts.append(clock())
+        return len(attempts) > connection.failures
+
+    connection.reopen = reopen
+    connection.attempts = attempts
+    yield connection
+    clock.closed = True
+    connection.close()
+    os.close(master)
+    os.close(slave)
+
+
+def test_backoff_doubles_to_its_cap(connection):
+    connection.failures = 8
+    connection.lost(OSError('unplugged'))
+    connection.thread.join(5)
+    assert connection.is_connected()
+    waits = connection.clock.waits
+    assert waits == [0.02, 0.04, 0.08, 0.16, 0.32, 0.5, 0.5, 0.5]
+    assert waits[0] == BACKOFF_MIN and max(waits) == BACKOFF_MAX
+    assert len(connection.attempts) == 9
+    assert (connection.disconnects, connection.reconnects) == (1, 1)
+    metrics = connection.metrics
+    assert metrics.counters == {'disconnects': 1, 'reconnects': 1}
+    # the reconnect took the sum of the waits
+    assert metrics.histogram('reconnect').max == pytest.approx(sum(waits) * 1e9)
+
+
+def test_first_attempt_at_once(connection):
+    connection.lost(OSError('unplugged'))
+    connection.thread.join(5)
+    assert connection.is_connected()
+    assert connection.clock.waits == []
+    assert connection.metrics.histogram('reconnect').max == 0
+
+
+def test_backoff_settings(connection):
+    connection.backoff_min = 0.1
+    connection.backoff_max = 0.25
+    connection.failures = 4
+    connection.lost(OSError('unplugged'))
+    connection.thread.join(5)
+    assert connection.clock.waits == [0.1, 0.2, 0.25, 0.25]
+
+
+def test_close_stops_reconnecting(connection):
+    connection.failures = 100
+    connection.clock.close_after = 3
+    connection.lost(OSError('unplugged'))
+    connection.thread.join(5)
+    assert not connection.thread.is_alive()
+    assert not connection.is_connected()
+    assert len(connection.attempts) == 3
+    assert connection.reconnects == 0
+
+
+def test_lost_once(connection):
+    connection.failures = 100
+    connection.clock.close_after = 2
+    connection.lost(OSError('unplugged'))
+    # a second error while reconnecting is the same disconnect
+    connection.lost(OSError('unplugged'))
+    connection.thread.join(5)
+    assert connection.disconnects == 1
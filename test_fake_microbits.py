@@ -0,0 +1,83 @@
+''' Round trips through ReadMicrobits polling the FakeMicrobits simulator on a pty. '''
+
+import threading
+from time import sleep
+
+import numpy as np
+
+from read_microbits import ReadMicrobits
+
+DURATION = 1.5
+
+
+def run_reader(**settings):
+    ''' Return a ReadMicrobits which has polled three fake microbits for DURATION. '''
+    reader = ReadMicrobits(3, run_main=False, dispatch=False, fake=True,
+        fake_options={'seed': 1}, **settings)
+    thread = threading.Thread(target=reader.run, daemon=True)
+    thread.start()
+    sleep(DURATION)
+    reader.stop()
+    thread.join(5)
+    assert not thread.is_alive()
+    return reader
+
+
+def check_stored(reader, gaps=False):
+    ''' Every microbit has samples in count order, with no malformed scans,
+    and no gaps unless <gaps>. '''
+    assert reader.framer.malformed == 0
+    for mb, ring in reader.df_dict.items():
+        rows = ring.tail()
+        assert len(rows) > 10, mb
+        assert (rows['id'] == int(mb[len('mb_'):])).all()
+        steps = np.diff(rows['count'].astype(np.int64)) % (1 << 16)
+        if gaps:
+            assert (steps >= 1).all()
+        else:
+            assert (steps == 1).all()
+            assert reader.trackers[mb].gap_lost == 0
+    assert reader.history.latest() is not None
+
+
+def test_round_trip_protocol_1():
+    reader = run_reader(protocol=1)
+    check_stored(reader)
+    assert reader.framer.version == 1
+
+
+def test_round_trip_protocol_2():
+    reader = run_reader(protocol=2)
+    # a poll only returns the last MAX_BATCH samples taken since the one before
+    check_stored(reader, gaps=True)
+    assert reader.framer.version == 2
+    assert sum(tracker.received for tracker in reader.trackers.values()) > (
+        2 * reader.metrics.histogram('poll_reply').count)
+
+
+def test_round_trip_streaming():
+    reader = run_reader(protocol=2, stream=True)
+    # a slot sent late by the simulator thread can miss a sample
+    check_stored(reader, gaps=True)
+    for tracker in reader.trackers.values():
+        assert tracker.gap_lost < tracker.received / 20
+
+
+def test_reconnects_after_unplug():
+    reader = ReadMicrobits(3, run_main=False, dispatch=False, fake=True,
+        fake_options={'seed': 1}, protocol=1)
+    thread = threading.Thread(target=reader.run, daemon=True)
+    thread.start()
+    sleep(DURATION / 2)
+    reader.fake_microbits.unplug()
+    sleep(DURATION / 2)
+    before = {mb: len(ring) for mb, ring in reader.df_dict.items()}
+    reader.fake_microbits.replug()
+    sleep(DURATION)
+    reader.stop()
+    thread.join(5)
+    assert not thread.is_alive()
+    assert reader.metrics.counters.get('disconnects') >= 1
+    assert reader.metrics.counters.get('reconnects') >= 1
+    for mb, ring in reader.df_dict.items():
+        assert len(ring) > before[mb] + 10, mb
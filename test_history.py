@@ -0,0 +1,113 @@
+''' Tests for the levels of HistoryPyramid and History.window. '''
+
+import numpy as np
+
+from history import LEVEL_DTYPE, History, HistoryPyramid
+
+# small levels, so that a few thousand samples fill several of them
+SETTINGS = dict(full_rows=64, level_rows=64, factor=4, num_levels=4)
+PERIOD_NS = 10000000
+
+
+def samples(num_samples, seed=0):
+    ''' Return the times and mags of <num_samples> random samples. '''
+    rng = np.random.default_rng(seed)
+    times = np.arange(num_samples, dtype=np.int64) * PERIOD_NS
+    return times, rng.integers(0, 4000, num_samples).astype(np.int32)
+
+
+def brute_force(times, mags, size, start_ns=0, summarised=None):
+    ''' Return the LEVEL_DTYPE bins from <start_ns> of every <size> samples
+    up to <summarised> samples, then one bin of the rest. '''
+    if summarised is None:
+        summarised = len(times)
+    bounds = list(range(0, summarised, size)) + [summarised, len(times)]
+    bins = np.array([(times[start], mags[start:end].min(), mags[start:end].max(),
+        mags[start:end].mean()) for start, end in zip(bounds, bounds[1:]) if end > start],
+        dtype=LEVEL_DTYPE)
+    return bins[bins['time'] >= start_ns]
+
+
+def expected(pyramid, number, times, mags, start_ns=0):
+    ''' Return the bins <pyramid> holds at level <number> from <start_ns>,
+    worked out from every sample added to it. '''
+    size = SETTINGS['factor'] ** number
+    return brute_force(times, mags, size, start_ns, pyramid.totals[number] * size)
+
+
+def check_bins(bins, expected):
+    assert bins['time'].tolist() == expected['time'].tolist()
+    assert bins['min'].tolist() == expected['min'].tolist()
+    assert bins['max'].tolist() == expected['max'].tolist()
+    assert np.allclose(bins['mean'], expected['mean'])
+
+
+def test_window_of_whole_history():
+    times, mags = samples(1000)
+    pyramid = HistoryPyramid(**SETTINGS)
+    pyramid.extend(times, mags)
+    # levels 0 and 1 have dropped their oldest bins, level 2 holds 62 and a partial one
+    number, bins = pyramid.window(0, times[-1], 100)
+    assert number == 2
+    check_bins(bins, expected(pyramid, 2, times, mags))
+
+
+def test_window_of_recent_samples():
+    times, mags = samples(1000)
+    pyramid = HistoryPyramid(**SETTINGS)
+    pyramid.extend(times, mags)
+    number, bins = pyramid.window(times[-50], times[-1], 100)
+    assert number == 0
+    check_bins(bins, expected(pyramid, 0, times, mags, times[-50]))
+    # too many samples for max_bins, so the bins of four
+    number, bins = pyramid.window(times[-48], times[-1], 20)
+    assert number == 1
+    check_bins(bins, expected(pyramid, 1, times, mags, times[-48]))
+
+
+def test_coarsest_level_when_nothing_fits():
+    times, mags = samples(1000)
+    pyramid = HistoryPyramid(**SETTINGS)
+    pyramid.extend(times, mags)
+    number, bins = pyramid.window(0, times[-1], 5)
+    assert number == 3
+    check_bins(bins, expected(pyramid, 3, times, mags))
+
+
+def test_batches_of_any_size():
+    times, mags = samples(3000, seed=1)
+    whole = HistoryPyramid(**SETTINGS)
+    whole.extend(times, mags)
+    batched = HistoryPyramid(**SETTINGS)
+    sizes = np.random.default_rng(2).integers(1, 40, len(times))
+    start = 0
+    for size in sizes:
+        batched.extend(times[start:start + size], mags[start:start + size])
+        start += size
+        if start >= len(times):
+            break
+    for max_bins in (5, 60, 100):
+        for start_ns in (0, times[-200], times[-30]):
+            for pyramid in (whole, batched):
+                number, bins = pyramid.window(start_ns, times[-1], max_bins)
+                assert number == whole.window(start_ns, times[-1], max_bins)[0]
+                check_bins(bins, expected(pyramid, number, times, mags, start_ns))
+
+
+def test_history_splits_microbits():
+    times, mags = samples(600)
+    ids = np.arange(600) % 3
+    history = History(**SETTINGS)
+    for start in range(0, 600, 25):
+        history.extend(times[start:start + 25], ids[start:start + 25],
+            mags[start:start + 25])
+    assert history.origin_ns == 0
+    assert history.latest() == times[-1]
+    for ident in range(3):
+        mine = ids == ident
+        number, bins = history.window(ident, 0, times[-1], 100)
+        assert number == 1
+        check_bins(bins, expected(history.pyramids[ident], 1, times[mine], mags[mine]))
+    assert history.window(3, 0, times[-1], 100) == (0, None)
+    history.reset()
+    assert history.latest() is None
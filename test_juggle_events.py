@@ -0,0 +1,135 @@
+''' Tests for the throws and catches found by EventDetector in synthetic traces. '''
+
+import numpy as np
+
+from juggle_events import (CATCH, FREE_FALL, LANDED, MIN_AIRTIME_NS, THROW,
+    EventDetector)
+
+PERIOD_NS = 10000000
+MS = 1000000
+IN_HAND = 1000
+IN_FLIGHT = 50
+# between the thresholds, which changes nothing
+MIDDLE = (FREE_FALL + LANDED) // 2
+
+
+def trace(flights, length_ns, start_ns=0):
+    ''' Return the times and mags of a microbit sampled every PERIOD_NS,
+    in the hand apart from the (start, airtime) <flights> in ns. '''
+    times = start_ns + np.arange(0, length_ns, PERIOD_NS, dtype=np.int64)
+    mags = np.full(len(times), IN_HAND)
+    # noise in the hand which crosses the middle but not LANDED or FREE_FALL
+    mags[::3] = MIDDLE + 100
+    for start, airtime in flights:
+        flight = (times >= start_ns + start) & (times < start_ns + start + airtime)
+        mags[flight] = IN_FLIGHT
+        # wobbles in flight which stay under LANDED
+        mags[flight & (np.arange(len(times)) % 4 == 0)] = MIDDLE
+    return times, mags
+
+
+def expected_events(flights, ident=0):
+    ''' The events of <flights> sampled by trace, each throw a second after
+    the last, landing at the first sample above LANDED after the flight. '''
+    times, mags = trace(flights, flights[-1][0] + flights[-1][1] + 100 * MS)
+    events = []
+    for number, (start, airtime) in enumerate(flights):
+        landed = int(times[(times >= start + airtime) & (mags > LANDED)][0])
+        rate = 60.0 if number else 0.0
+        events.append((start, ident, THROW, 0, rate))
+        events.append((landed, ident, CATCH, landed - start, 0.0))
+    return events
+
+
+FLIGHTS = [(500 * MS + second * 1000 * MS, airtime * MS)
+    for second, airtime in enumerate((300, 400, 500, 600))]
+
+
+def test_throws_and_catches():
+    times, mags = trace(FLIGHTS, 5000 * MS)
+    detector = EventDetector(1)
+    detector.process(times, np.zeros(len(times), dtype=np.int64), mags)
+    sequence, events = detector.events_since(0)
+    assert sequence == 8
+    assert events == expected_events(FLIGHTS)
+    assert detector.device_stats() == {0: (4, 600 * MS, 60.0)}
+
+
+def test_short_dip_ignored():
+    flights = [(500 * MS, MIN_AIRTIME_NS // 2), (1500 * MS, 300 * MS)]
+    times, mags = trace(flights, 3000 * MS)
+    detector = EventDetector(1)
+    detector.process(times, np.zeros(len(times), dtype=np.int64), mags)
+    _, events = detector.events_since(0)
+    assert [event[2] for event in events] == [THROW, CATCH]
+    assert events[0][0] == 1500 * MS
+
+
+def test_batches_of_any_size():
+    times, mags = trace(FLIGHTS, 5000 * MS)
+    ids = np.zeros(len(times), dtype=np.int64)
+    detector = EventDetector(1)
+    sizes = np.random.default_rng(0).integers(1, 20, len(times))
+    events = []
+    sequence = start = 0
+    for size in sizes:
+        detector.process(times[start:start + size], ids[start:start + size],
+            mags[start:start + size])
+        sequence, new = detector.events_since(sequence)
+        events += new
+        start += size
+        if start >= len(times):
+            break
+    assert events == expected_events(FLIGHTS)
+
+
+def test_throw_before_landing():
+    times, mags = trace([(500 * MS, 800 * MS)], 900 * MS)
+    detector = EventDetector(1)
+    ids = np.zeros(len(times), dtype=np.int64)
+    # still in flight at the end of the batch, but for longer than MIN_AIRTIME_NS
+    detector.process(times, ids, mags)
+    _, events = detector.events_since(0)
+    assert events == [(500 * MS, 0, THROW, 0, 0.0)]
+
+
+def test_microbits_apart_and_grown():
+    detector = EventDetector(2)
+    rows = []
+    for ident in (0, 4):
+        flights = [(start + ident * 10 * MS, airtime) for start, airtime in FLIGHTS]
+        times, mags = trace(flights, 5000 * MS)
+        rows.append((times, np.full(len(times), ident), mags))
+    # the samples of the microbits interleaved, as they are stored
+    times, ids, mags = (np.stack(columns, axis=1).ravel() for columns in zip(*rows))
+    detector.process(times, ids, mags)
+    assert len(detector.state) == 5
+    _, events = detector.events_since(0)
+    for ident in (0, 4):
+        flights = [(start + ident * 10 * MS, airtime) for start, airtime in FLIGHTS]
+        assert [event for event in events if event[1] == ident] == expected_events(
+            flights, ident)
+    assert set(detector.device_stats()) == {0, 4}
+
+
+def test_events_since_keeps_max_events():
+    times, mags = trace(FLIGHTS, 5000 * MS)
+    detector = EventDetector(1, max_events=3)
+    detector.process(times, np.zeros(len(times), dtype=np.int64), mags)
+    sequence, events = detector.events_since(0)
+    assert sequence == 8
+    assert events == expected_events(FLIGHTS)[-3:]
+    assert detector.events_since(sequence) == (sequence, [])
+    assert detector.events_since(sequence - 1)[1] == events[-1:]
+
+
+def test_reset():
+    times, mags = trace([(500 * MS, 800 * MS)], 900 * MS)
+    ids = np.zeros(len(times), dtype=np.int64)
+    detector = EventDetector(1)
+    detector.process(times, ids, mags)
+    detector.reset()
+    assert detector.device_stats() == {}
+    # the flight in progress is forgotten, so landing is not a catch
+    detector.process(np.array([1000 * MS]), np.array([0]), np.array([IN_HAND]))
+    assert detector.events_since(1) == (1, [])
@@ -0,0 +1,56 @@
+''' Tests for the drawing helpers of main.py. '''
+
+import numpy as np
+import pytest
+
+pytest.importorskip('pyqtgraph')
+from main import peak_downsample, plot_grid
+
+
+def test_short_runs_drawn_as_they_are():
+    samples = np.arange(50, dtype=np.int32)
+    x, y = peak_downsample(samples, 10, 100)
+    assert x.tolist() == list(range(10, 60))
+    assert y.tolist() == samples.tolist()
+    # setData keeps y, so it must not change when the ring buffer does
+    assert not np.shares_memory(y, samples)
+    samples[0] = 99
+    assert y[0] == 0
+
+
+def test_short_run_of_a_read_only_view():
+    samples = np.arange(10, dtype=np.int32)
+    samples.flags.writeable = False
+    _, y = peak_downsample(samples, 0, 100)
+    assert not np.shares_memory(y, samples)
+    assert y.flags.writeable
+
+
+def test_min_and_max_kept_per_bin():
+    rng = np.random.default_rng(0)
+    samples = rng.integers(0, 4000, 1003).astype(np.int32)
+    # single sample peaks, which a plain stride would drop
+    samples[501] = 9999
+    samples[777] = -5
+    x, y = peak_downsample(samples, 0, 100)
+    assert not np.shares_memory(y, samples)
+    size = -(-2 * len(samples) // 100)
+    num_bins = len(samples) // size
+    # about max_points, with the samples left over after the last whole bin
+    assert len(y) < 100 + size
+    bins = samples[:num_bins * size].reshape(num_bins, size)
+    assert y[:2 * num_bins:2].tolist() == bins.min(axis=1).tolist()
+    assert y[1:2 * num_bins:2].tolist() == bins.max(axis=1).tolist()
+    assert y[2 * num_bins:].tolist() == samples[num_bins * size:].tolist()
+    assert y.max() == 9999 and y.min() == -5
+    # the points are in x order, each bin at its middle
+    assert (np.diff(x) >= 0).all()
+    assert x[0] == x[1] == size / 2
+    assert x[-1] == len(samples) - 1
+
+
+def test_plot_grid():
+    assert plot_grid(3) == (3, 1)
+    assert plot_grid(1) == (1, 1)
+    rows, columns = plot_grid(20)
+    assert rows * columns >= 20 and columns > 1
@@ -0,0 +1,84 @@
+''' Tests for the buckets and percentiles of LatencyHistogram and for Metrics. '''
+
+import numpy as np
+import pytest
+
+from metrics import (NUM_BUCKETS, SUB_BUCKETS, LatencyHistogram, Metrics, bucket_index,
+    bucket_value)
+
+# the largest error of a bucket value, half a bucket of 1 / SUB_BUCKETS of its power of two
+BUCKET_ERROR = 1 / SUB_BUCKETS
+
+
+def test_small_values_exact():
+    for value in range(2 * SUB_BUCKETS):
+        assert bucket_value(bucket_index(value)) == value
+
+
+def test_bucket_value_error():
+    rng = np.random.default_rng(0)
+    values = [int(value) for value in np.unique(np.concatenate((
+        rng.integers(0, 1 << 20, 2000), 2 ** rng.uniform(0, 48, 2000))).astype(np.int64))]
+    values += [2 ** 48 - 1, 2 ** 48, 2 ** 48 + 1]
+    indices = [bucket_index(value) for value in values]
+    assert max(indices) < NUM_BUCKETS
+    # the buckets are in the order of their values
+    assert indices == sorted(indices)
+    for value, index in zip(values, indices):
+        assert abs(bucket_value(index) - value) <= BUCKET_ERROR * value
+
+
+def test_percentiles_match_numpy():
+    rng = np.random.default_rng(1)
+    # latencies spread over several powers of two, from 0 to near 2 ** 48
+    values = np.concatenate((rng.lognormal(12, 2, 20000), [0] * 50,
+        rng.integers(2 ** 47, 2 ** 48, 20))).astype(np.int64)
+    histogram = LatencyHistogram()
+    for value in values:
+        histogram.record(value)
+    assert histogram.count == len(values)
+    assert histogram.max == values.max()
+    for percent in (0.1, 1, 10, 50, 90, 99, 99.9, 99.99, 100):
+        expected = np.percentile(values, percent, method='inverted_cdf')
+        assert abs(histogram.percentile(percent) - expected) <= BUCKET_ERROR * expected
+
+
+def test_percentiles_of_zero():
+    histogram = LatencyHistogram()
+    assert histogram.percentile(50) == 0
+    for value in (0, 0, -5):
+        histogram.record(value)
+    assert histogram.percentile(99) == 0
+    assert histogram.max == 0
+
+
+def test_values_beyond_the_last_bucket():
+    histogram = LatencyHistogram()
+    histogram.record(2 ** 60)
+    assert histogram.counts[-1] == 1
+    assert histogram.percentile(50) <= histogram.max
+
+
+def test_summary_in_microseconds():
+    histogram = LatencyHistogram()
+    for value in range(1000, 11000, 1000):
+        histogram.record(value)
+    summary = histogram.summary()
+    assert summary['count'] == 10
+    assert summary['mean_us'] == pytest.approx(5.5)
+    assert summary['max_us'] == 10.0
+    assert summary['p50_us'] == pytest.approx(5.0, rel=BUCKET_ERROR)
+    histogram.reset()
+    assert histogram.summary()['count'] == 0
+
+
+def test_metrics():
+    metrics = Metrics()
+    metrics.record('parse', 2000)
+    metrics.count('malformed')
+    metrics.count('malformed', 2)
+    snapshot = metrics.snapshot()
+    assert snapshot['counters'] == {'malformed': 3}
+    assert snapshot['histograms']['parse']['count'] == 1
+    assert metrics.histogram('parse') is metrics.histogram('parse')
+    assert len(metrics.text_lines()) == 2
@@ -0,0 +1,134 @@
+''' Tests for the batches handed out by MicrobitStream and its overflow policies. '''
+
+import asyncio
+import threading
+from time import monotonic, sleep
+
+import numpy as np
+import pytest
+
+from microbit_stream import BLOCK, DROP_OLDEST, MicrobitStream
+from ring_buffer import SCAN_DTYPE
+
+DURATION = 1.5
+FAKE_OPTIONS = {'seed': 1}
+
+
+def make_batch(number):
+    ''' Return a batch whose rows are counted <number>. '''
+    batch = np.zeros(2, dtype=SCAN_DTYPE)
+    batch['count'] = number
+    return batch
+
+
+def check_order(batches, steps_of_one=False):
+    ''' The counts of each microbit go up from one batch to the next,
+    by exactly one with <steps_of_one>. '''
+    rows = np.concatenate(batches)
+    assert rows.dtype == SCAN_DTYPE
+    for ident in range(3):
+        counts = rows['count'][rows['id'] == ident].astype(np.int64)
+        assert len(counts) >= 5
+        steps = np.diff(counts) % (1 << 16)
+        assert (steps == 1).all() if steps_of_one else (steps >= 1).all()
+
+
+def test_generator():
+    batches = []
+    with MicrobitStream(3, fake=True, fake_options=FAKE_OPTIONS) as stream:
+        end = monotonic() + DURATION
+        for batch in stream.batches(timeout=0.5):
+            batches.append(batch)
+            if monotonic() > end:
+                break
+    assert stream.finished
+    assert stream.dropped == 0
+    check_order(batches, steps_of_one=True)
+
+
+def test_generator_ends_after_stop():
+    stream = MicrobitStream(3, fake=True, fake_options=FAKE_OPTIONS)
+    threading.Timer(0.5, stream.stop).start()
+    batches = list(stream)
+    assert stream.finished
+    assert len(batches) > 0
+
+
+def test_async_iterator():
+    async def consume():
+        batches = []
+        async with MicrobitStream(3, fake=True, protocol=2,
+                fake_options=FAKE_OPTIONS) as stream:
+            end = monotonic() + DURATION
+            async for batch in stream:
+                batches.append(batch)
+                if monotonic() > end:
+                    break
+        return stream, batches
+
+    stream, batches = asyncio.run(consume())
+    assert stream.finished
+    check_order(batches)
+
+
+def test_async_block_waits_for_consumer():
+    async def consume():
+        batches = []
+        async with MicrobitStream(3, fake=True, max_batches=2, overflow=BLOCK,
+                fake_options=FAKE_OPTIONS) as stream:
+            end = monotonic() + DURATION
+            async for batch in stream:
+                batches.append(batch)
+                if monotonic() > end:
+                    break
+                # a slow consumer
+                await asyncio.sleep(0.05)
+        return stream, batches
+
+    stream, batches = asyncio.run(consume())
+    assert stream.dropped == 0
+    # polling waits while the queue is full, so no sample is lost
+    check_order(batches, steps_of_one=True)
+
+
+def test_drop_oldest():
+    stream = MicrobitStream(3, max_batches=3, overflow=DROP_OLDEST)
+    for number in range(10):
+        stream.publish(make_batch(number))
+    assert stream.dropped == 7
+    assert stream.metrics.counters['batches_dropped'] == 7
+    kept = [stream.queue.get_nowait()['count'][0] for _ in range(3)]
+    assert kept == [7, 8, 9]
+
+
+def test_drop_oldest_slow_consumer():
+    batches = []
+    with MicrobitStream(3, fake=True, max_batches=2, fake_options=FAKE_OPTIONS) as stream:
+        end = monotonic() + DURATION
+        for batch in stream:
+            batches.append(batch)
+            if monotonic() > end:
+                break
+            sleep(0.05)
+    assert stream.dropped > 0
+    # the batches kept are still in order
+    check_order(batches)
+
+
+def test_block():
+    stream = MicrobitStream(3, max_batches=2, overflow=BLOCK)
+    publisher = threading.Thread(target=lambda: [stream.publish(make_batch(number))
+        for number in range(10)])
+    publisher.start()
+    received = []
+    while len(received) < 10:
+        sleep(0.01)
+        received.append(stream.queue.get(timeout=5)['count'][0])
+    publisher.join()
+    assert received == list(range(10))
+    assert stream.dropped == 0
+
+
+def test_unknown_overflow():
+    with pytest.raises(ValueError):
+        MicrobitStream(3, overflow='newest')
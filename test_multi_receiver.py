@@ -0,0 +1,77 @@
+''' Tests for reading through several receivers with MultiReceiver. '''
+
+import threading
+from time import sleep
+
+import numpy as np
+
+from multi_receiver import MergedStore, MultiReceiver, assign_devices
+from ring_buffer import SCAN_DTYPE
+
+DURATION = 2.0
+
+
+def rows(times, ident=0):
+    ''' Return SCAN_DTYPE rows at <times> for microbit <ident>. '''
+    batch = np.zeros(len(times), dtype=SCAN_DTYPE)
+    batch['time'] = times
+    batch['id'] = ident
+    batch['count'] = np.arange(len(times))
+    return batch
+
+
+def test_assign_devices():
+    microbits = ['mb_{}'.format(i) for i in range(7)]
+    blocks = assign_devices(microbits, 3)
+    assert sum(blocks, []) == microbits
+    assert [len(block) for block in blocks] == [2, 2, 3]
+
+
+def test_merged_store_orders_sources():
+    store = MergedStore(2, 100, max_lateness_ns=0, max_lag_ns=1000)
+    store.push(1, rows([]), 0)
+    store.push(0, rows([10, 30]), 30)
+    # nothing is merged until the other source has read past the rows
+    assert store.merged == 0
+    store.push(1, rows([20, 40], 1), 40)
+    assert store.ring.tail()['time'].tolist() == [10, 20, 30]
+    store.flush(everything=True)
+    assert store.ring.tail()['time'].tolist() == [10, 20, 30, 40]
+    assert store.late == 0
+
+
+def test_merged_store_does_not_wait_for_a_silent_source():
+    store = MergedStore(2, 100, max_lateness_ns=0, max_lag_ns=100)
+    store.push(1, rows([]), 0)
+    store.push(0, rows([500, 600]), 600)
+    assert store.ring.tail()['time'].tolist() == [500, 600]
+
+
+def test_merged_store_counts_late_rows():
+    store = MergedStore(1, 100, max_lateness_ns=0)
+    store.push(0, rows([10, 20]), 20)
+    store.push(0, rows([15]), 30)
+    assert store.late == 1
+    assert store.ring.tail()['time'].tolist() == [10, 20, 15]
+
+
+def test_round_trip_through_receivers():
+    reader = MultiReceiver(6, run_main=False, receivers=2, groups=[11, 12], fake=True)
+    thread = threading.Thread(target=reader.run, daemon=True)
+    thread.start()
+    sleep(DURATION)
+    reader.stop()
+    thread.join(5)
+    assert not thread.is_alive()
+    assert [worker.assigned for worker in reader.workers] == [
+        ['mb_0', 'mb_1', 'mb_2'], ['mb_3', 'mb_4', 'mb_5']]
+    assert all(worker.connected for worker in reader.workers)
+    for mb, ring in reader.df_dict.items():
+        assert len(ring) > 10, mb
+    # on their own radio groups the receivers do not hear each other's microbits
+    assert not any(worker.metrics.counters.get('unassigned_scans')
+        for worker in reader.workers)
+    merged = reader.merged.ring.tail()
+    assert set(merged['id'].tolist()) == set(range(6))
+    assert reader.merged.pending() == 0
+    assert reader.merged.late < len(merged) / 20
@@ -0,0 +1,157 @@
+''' Tests for the poll order and timeouts of PollScheduler, with the time given. '''
+
+import pytest
+
+from poll_scheduler import (BACKOFF_MAX, BACKOFF_MIN, FAIL_THRESHOLD, MAX_TIMEOUT,
+    MIN_TIMEOUT, PROBE_TIMEOUT, PollScheduler)
+
+MICROBITS = ['mb_0', 'mb_1', 'mb_2']
+
+
+def poll(scheduler, now, rtt=None):
+    ''' Poll the next microbit at <now>, which replies after <rtt> seconds,
+    or times out if <rtt> is None. Return the microbit and the time after. '''
+    mb_id = scheduler.next_microbit(now)
+    now += scheduler.wait_time(now, mb_id)
+    scheduler.poll_sent(now, mb_id)
+    if rtt is None:
+        now += scheduler.timeout(mb_id)
+        scheduler.reply_timed_out(mb_id, now)
+    else:
+        now += rtt
+        scheduler.reply_received(mb_id, now)
+    return mb_id, now
+
+
+def test_round_robin():
+    scheduler = PollScheduler(MICROBITS)
+    now = 0.0
+    order = []
+    for _ in range(9):
+        mb_id, now = poll(scheduler, now, 0.01)
+        order.append(mb_id)
+    assert order == MICROBITS * 3
+
+
+def test_timeout_follows_rtt():
+    scheduler = PollScheduler(MICROBITS)
+    assert scheduler.timeout('mb_0') == MAX_TIMEOUT
+    scheduler.poll_sent(0.0, 'mb_0')
+    assert scheduler.reply_received('mb_0', 0.02) == pytest.approx(0.02)
+    # srtt + 4 * rttvar, with rttvar half the first rtt
+    assert scheduler.timeout('mb_0') == pytest.approx(0.06)
+    now = 0.02
+    for _ in range(100):
+        scheduler.poll_sent(now, 'mb_0')
+        now += 0.02
+        scheduler.reply_received('mb_0', now)
+    # a steady rtt shrinks the variation
+    assert scheduler.srtt['mb_0'] == pytest.approx(0.02)
+    assert scheduler.timeout('mb_0') == pytest.approx(0.02, abs=1e-4)
+
+
+def test_timeout_bounds():
+    scheduler = PollScheduler(MICROBITS)
+    scheduler.poll_sent(0.0, 'mb_0')
+    scheduler.reply_received('mb_0', 0.0001)
+    assert scheduler.timeout('mb_0') == MIN_TIMEOUT
+    scheduler.poll_sent(0.0, 'mb_1')
+    scheduler.reply_received('mb_1', 2.0)
+    assert scheduler.timeout('mb_1') == MAX_TIMEOUT
+    # a microbit which has never replied is probed with a short timeout
+    scheduler.reply_timed_out('mb_2', 0.0)
+    assert scheduler.timeout('mb_2') == PROBE_TIMEOUT
+
+
+def test_target_rate():
+    scheduler = PollScheduler(MICROBITS, target_rate=10)
+    assert scheduler.min_interval == pytest.approx(1 / 30)
+    now = 0.0
+    for _ in range(30):
+        _, now = poll(scheduler, now, 0.001)
+    # 10 polls of each microbit a second, however fast they reply
+    assert now == pytest.approx(29 / 30 + 0.001)
+    scheduler.set_target_rate(None)
+    assert scheduler.wait_time(now) == 0.0
+
+
+def test_unresponsive_backs_off():
+    scheduler = PollScheduler(MICROBITS)
+    now = 0.0
+    became = [scheduler.reply_timed_out('mb_1', now) for _ in range(FAIL_THRESHOLD)]
+    assert became == [False] * (FAIL_THRESHOLD - 1) + [True]
+    assert not scheduler.healthy('mb_1')
+    assert scheduler.next_probe['mb_1'] == BACKOFF_MIN
+    # only probed once the backoff has passed
+    polled = []
+    while now < BACKOFF_MIN:
+        mb_id, now = poll(scheduler, now, 0.01)
+        polled.append(mb_id)
+    assert 'mb_1' not in polled
+    assert scheduler.next_microbit(now) == 'mb_1'
+    # each probe which times out doubles the backoff, up to BACKOFF_MAX
+    backoffs = []
+    for _ in range(10):
+        scheduler.reply_timed_out('mb_1', now)
+        backoffs.append(scheduler.backoff['mb_1'])
+    assert backoffs[:3] == [2 * BACKOFF_MIN, 4 * BACKOFF_MIN, 8 * BACKOFF_MIN]
+    assert backoffs[-1] == BACKOFF_MAX
+    assert scheduler.wait_time(now, 'mb_1') == pytest.approx(BACKOFF_MAX)
+
+
+def test_reply_makes_healthy():
+    scheduler = PollScheduler(MICROBITS)
+    for _ in range(FAIL_THRESHOLD + 2):
+        scheduler.reply_timed_out('mb_0', 0.0)
+    rate = scheduler.success_rate['mb_0']
+    assert rate < 0.6
+    scheduler.poll_sent(BACKOFF_MAX, 'mb_0')
+    scheduler.reply_received('mb_0', BACKOFF_MAX + 0.01)
+    assert scheduler.healthy('mb_0')
+    assert scheduler.backoff['mb_0'] == 0.0
+    assert scheduler.success_rate['mb_0'] > rate
+    assert scheduler.wait_time(BACKOFF_MAX + 0.01, 'mb_0') == 0.0
+
+
+def test_all_backing_off():
+    scheduler = PollScheduler(MICROBITS)
+    for delay, mb_id in enumerate(MICROBITS):
+        for _ in range(FAIL_THRESHOLD):
+            scheduler.reply_timed_out(mb_id, 1.0 - delay / 10)
+    # the first probe due
+    assert scheduler.next_microbit(0.0) == 'mb_2'
+    assert scheduler.wait_time(0.0, 'mb_2') == pytest.approx(0.8 + BACKOFF_MIN)
+
+
+def test_min_rate_polled_when_behind():
+    microbits = ['mb_{}'.format(n) for n in range(5)]
+    scheduler = PollScheduler(microbits, min_rates={'mb_4': 50})
+    now = 0.0
+    counts = dict.fromkeys(microbits, 0)
+    polled = []
+    while now < 10:
+        mb_id, now = poll(scheduler, now, 0.01)
+        counts[mb_id] += 1
+        if mb_id == 'mb_4':
+            polled.append(scheduler.last_polled[mb_id])
+    # round robin would poll each of them every 0.05 s, it is polled at
+    # the first poll after it falls behind 1 / 50 s
+    assert max(b - a for a, b in zip(polled, polled[1:])) <= 0.03 + 1e-9
+    assert counts['mb_4'] > 2 * counts['mb_0']
+    assert counts['mb_0'] == pytest.approx(counts['mb_3'], abs=1)
+
+
+def test_priority_to_active():
+    scheduler = PollScheduler(MICROBITS, priority_gain=2.0)
+    for mb_id in MICROBITS:
+        scheduler.set_activity(mb_id, 1.0)
+    scheduler.set_activity('mb_1', 10.0)
+    now = 0.0
+    counts = dict.fromkeys(MICROBITS, 0)
+    for _ in range(300):
+        mb_id, now = poll(scheduler, now, 0.01)
+        counts[mb_id] += 1
+    assert counts['mb_1'] > 2 * counts['mb_0']
+    assert counts['mb_0'] == pytest.approx(counts['mb_2'], abs=1)
+    # the quiet microbits are still polled
+    assert counts['mb_0'] > 30
@@ -0,0 +1,76 @@
+''' Tests for the version 2 frames of protocol.py and their framing by ScanFramer. '''
+
+from protocol import (MAGIC_V2, MAX_BATCH, decode_frames, encode_frame, frame_length,
+    magnitude)
+from scan_framer import ScanFramer
+
+SAMPLES = [(-240, 336, 240), (1024, 0, -16), (0, -2047, 2047)]
+
+
+def test_decode_round_trip():
+    frames = encode_frame(4, 7, 100, SAMPLES) + encode_frame(5, 8, 65535, SAMPLES[:1])
+    samples, consumed, bad_frames = decode_frames(frames)
+    assert consumed == len(frames)
+    assert bad_frames == 0
+    assert samples['id'].tolist() == [4, 4, 4, 5]
+    assert samples['count'].tolist() == [100, 101, 102, 65535]
+    assert samples[['x_acc', 'y_acc', 'z_acc']].tolist() == SAMPLES + SAMPLES[:1]
+    assert samples['mag_acc'].tolist() == magnitude(*zip(*(SAMPLES + SAMPLES[:1]))).tolist()
+
+
+def test_count_wraps_within_a_batch():
+    samples, _, _ = decode_frames(encode_frame(1, 0, 65535, SAMPLES))
+    assert samples['count'].tolist() == [65535, 0, 1]
+
+
+def test_checksum_rejected():
+    frame = bytearray(encode_frame(1, 0, 10, SAMPLES))
+    # corrupt one acceleration byte
+    frame[12] ^= 0x01
+    good = encode_frame(2, 1, 20, SAMPLES[:1])
+    samples, consumed, bad_frames = decode_frames(bytes(frame) + good)
+    assert bad_frames == 1
+    assert samples['id'].tolist() == [2]
+    assert consumed == len(frame) + len(good)
+
+
+def test_partial_frame_waits():
+    frame = encode_frame(1, 0, 10, SAMPLES)
+    samples, consumed, bad_frames = decode_frames(frame[:-3])
+    assert len(samples) == 0
+    assert consumed == 0
+    assert bad_frames == 0
+
+
+def test_frame_length():
+    for num_samples in range(1, MAX_BATCH + 1):
+        assert len(encode_frame(1, 0, 0, SAMPLES[:num_samples])) == frame_length(num_samples)
+
+
+def test_framer_joins_split_frames():
+    framer = ScanFramer()
+    frames = encode_frame(1, 0, 10, SAMPLES) + encode_frame(1, 1, 13, SAMPLES)
+    scans = []
+    # split inside MAGIC_V2, inside the header and inside the samples
+    for start, end in ((0, 1), (1, 5), (5, 20), (20, len(frames))):
+        scans.extend(framer.feed(frames[start:end]))
+    assert [scan[1] for scan in scans] == list(range(10, 16))
+    assert framer.version == 2
+    assert framer.malformed == 0
+
+
+def test_framer_resyncs_on_magic():
+    framer = ScanFramer()
+    scans = framer.feed(b'garbage' + encode_frame(3, 0, 5, SAMPLES[:1]))
+    assert [scan[:2] for scan in scans] == [(3, 5)]
+    assert framer.discarded_bytes == len(b'garbage')
+
+
+def test_framer_counts_bad_checksums():
+    framer = ScanFramer()
+    frame = bytearray(encode_frame(1, 0, 10, SAMPLES))
+    frame[-1] ^= 0xff
+    scans = framer.feed(bytes(frame) + encode_frame(1, 1, 13, SAMPLES[:1]))
+    assert [scan[1] for scan in scans] == [13]
+    assert framer.malformed == 1
+    assert MAGIC_V2 not in framer.buffer
@@ -0,0 +1,97 @@
+''' Tests for writing recordings with SessionRecorder and reading them back. '''
+
+import threading
+from time import sleep
+
+import numpy as np
+import pytest
+
+from recorder import (HEADER_ALIGN, RECORD_DTYPE, SUFFIX, SessionRecorder, open_recording,
+    read_header)
+
+ROWS = [(n * 1000, n % 3, n // 3, -n, n, 2 * n, 100 + n) for n in range(1000)]
+
+
+def record(recorder, rows):
+    ''' Queue <rows>, waiting for the writer whenever the queue is full. '''
+    for row in rows:
+        while not recorder.record(row):
+            sleep(0.001)
+
+
+def read_back(recorder):
+    return np.concatenate([open_recording(path) for path in recorder.files]).tolist()
+
+
+def test_round_trip(tmp_path):
+    recorder = SessionRecorder(str(tmp_path), batch_size=64)
+    record(recorder, ROWS)
+    recorder.close()
+    assert recorder.recorded == len(ROWS)
+    assert recorder.dropped == 0
+    [path] = recorder.files
+    assert path.endswith(SUFFIX)
+    with open(path, 'rb') as in_file:
+        metadata, offset = read_header(in_file)
+    assert offset % HEADER_ALIGN == 0
+    assert np.dtype([tuple(field) for field in metadata['dtype']]) == RECORD_DTYPE
+    assert metadata['start_time_ns'] > 0
+    records = open_recording(path)
+    assert records.tolist() == ROWS
+    assert not records.flags.writeable
+
+
+def test_not_a_recording(tmp_path):
+    path = tmp_path / 'other.mbrec'
+    path.write_bytes(b'\0' * 128)
+    with pytest.raises(ValueError):
+        open_recording(str(path))
+
+
+def test_rotation_by_size(tmp_path):
+    max_bytes = 200 * RECORD_DTYPE.itemsize
+    recorder = SessionRecorder(str(tmp_path), max_bytes=max_bytes, batch_size=50)
+    record(recorder, ROWS)
+    recorder.close()
+    assert len(recorder.files) >= 4
+    assert sorted(recorder.files) == recorder.files
+    assert read_back(recorder) == ROWS
+    # a file is rotated on the first batch after it reaches max_bytes
+    for path in recorder.files[:-1]:
+        assert 200 <= len(open_recording(path)) < 200 + 50
+
+
+def test_rotation_by_time(tmp_path):
+    recorder = SessionRecorder(str(tmp_path), max_seconds=0, batch_size=100)
+    record(recorder, ROWS[:10])
+    sleep(0.1)
+    record(recorder, ROWS[10:20])
+    recorder.close()
+    assert len(recorder.files) >= 2
+    assert read_back(recorder) == ROWS[:20]
+
+
+def test_full_queue_drops(tmp_path, monkeypatch):
+    # hold the writer thread on its first batch
+    release = threading.Event()
+    write_batch = SessionRecorder.write_batch
+    monkeypatch.setattr(SessionRecorder, 'write_batch',
+        lambda self, batch: release.wait() and write_batch(self, batch))
+    recorder = SessionRecorder(str(tmp_path), queue_size=10, batch_size=5)
+    results = [recorder.record(row) for row in ROWS[:100]]
+    assert results.count(False) == recorder.dropped
+    assert recorder.dropped >= 100 - 10 - 5
+    release.set()
+    recorder.close()
+    assert recorder.recorded + recorder.dropped == 100
+    # the rows kept are written in order
+    kept = [row for row, queued in zip(ROWS, results) if queued]
+    assert read_back(recorder) == kept
+
+
+def test_close_twice(tmp_path):
+    recorder = SessionRecorder(str(tmp_path))
+    recorder.record(ROWS[0])
+    recorder.close()
+    recorder.close()
+    assert read_back(recorder) == ROWS[:1]
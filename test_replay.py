@@ -0,0 +1,122 @@
+''' Tests for playing recordings made by SessionRecorder with ReplayMicrobits. '''
+
+import threading
+from time import sleep
+
+import numpy as np
+
+from recorder import RECORD_DTYPE, SessionRecorder, open_recording
+from replay import CHUNK, ReplayMicrobits
+
+NUM_MICROBITS = 3
+NUM_ROWS = 9000
+# each microbit is sampled every 3 ms
+PERIOD_NS = 1000000
+START_NS = 10 ** 12
+
+
+def record_session(directory):
+    ''' Record a session of NUM_ROWS rows, rotated into a few files, with
+    the rows of the microbits a little out of time order, as protocol 2
+    stores them. Return the recorded files. '''
+    rng = np.random.default_rng(0)
+    rows = np.zeros(NUM_ROWS, dtype=RECORD_DTYPE)
+    rows['id'] = np.arange(NUM_ROWS) % NUM_MICROBITS
+    rows['count'] = np.arange(NUM_ROWS) // NUM_MICROBITS
+    rows['time_ns'] = START_NS + np.arange(NUM_ROWS) * PERIOD_NS + rng.integers(
+        -PERIOD_NS, PERIOD_NS, NUM_ROWS)
+    rows['mag_acc'] = 1000
+    recorder = SessionRecorder(str(directory), max_bytes=3000 * RECORD_DTYPE.itemsize,
+        batch_size=100)
+    for row in rows.tolist():
+        # a full queue drops rows, so give the writer time
+        while not recorder.record(row):
+            sleep(0.01)
+    recorder.close()
+    assert len(recorder.files) > 2
+    return recorder.files
+
+
+def brute_force_locate(segments, time_ns):
+    ''' Return (segment, position) of the first record at or after <time_ns>. '''
+    for segment, records in enumerate(segments):
+        later = np.flatnonzero(records['time_ns'] >= time_ns)
+        if len(later):
+            return segment, int(later[0])
+    return len(segments), 0
+
+
+def play(replay_microbits, seconds):
+    ''' Run the play loop of <replay_microbits> for up to <seconds>. '''
+    thread = threading.Thread(target=replay_microbits.main, daemon=True)
+    thread.start()
+    thread.join(seconds)
+    replay_microbits.stop()
+    thread.join(5)
+    assert not thread.is_alive()
+
+
+def test_start_and_end(tmp_path):
+    files = record_session(tmp_path)
+    replay_microbits = ReplayMicrobits(files, run_main=False, speed=0)
+    times = np.concatenate([open_recording(path)['time_ns'] for path in files])
+    assert replay_microbits.start_ns == times[:CHUNK].min()
+    assert replay_microbits.end_ns == times.max()
+    # opening only reads the last block
+    assert [int((maxima >= 0).sum()) for maxima in replay_microbits.maxima] == [
+        0] * (len(files) - 1) + [1]
+
+
+def test_locate(tmp_path):
+    files = record_session(tmp_path)
+    replay_microbits = ReplayMicrobits(files, run_main=False, speed=0)
+    segments = [open_recording(path) for path in files]
+    for time_ns in list(np.linspace(START_NS - PERIOD_NS, START_NS + (NUM_ROWS + 5)
+            * PERIOD_NS, 200).astype(np.int64)) + [int(segments[1]['time_ns'][0])]:
+        assert replay_microbits.locate(time_ns) == brute_force_locate(segments, time_ns)
+    # a seek reads a few blocks of each file it passes
+    assert all((maxima >= 0).sum() <= 3 for maxima in replay_microbits.maxima)
+
+
+def test_play_as_fast_as_possible(tmp_path):
+    files = record_session(tmp_path)
+    replay_microbits = ReplayMicrobits(files, run_main=False, speed=0, ring_rows=NUM_ROWS)
+    play(replay_microbits, 10)
+    for ident, ring in enumerate(replay_microbits.df_dict.values()):
+        rows = ring.tail()
+        assert rows['count'].tolist() == list(range(NUM_ROWS // NUM_MICROBITS))
+        assert (rows['id'] == ident).all()
+    assert replay_microbits.segment == len(files)
+
+
+def test_seek(tmp_path):
+    files = record_session(tmp_path)
+    replay_microbits = ReplayMicrobits(files, run_main=False, speed=0)
+    play(replay_microbits, 10)
+    replay_microbits.do_seek(5)
+    time_ns = replay_microbits.start_ns + 5 * 10 ** 9
+    assert (replay_microbits.segment, replay_microbits.position) == replay_microbits.locate(
+        time_ns)
+    # the samples before the seek are forgotten
+    assert all(len(ring) == 0 for ring in replay_microbits.df_dict.values())
+    assert replay_microbits.clock_ns == time_ns
+
+
+def test_speed(tmp_path):
+    files = record_session(tmp_path)
+    replay_microbits = ReplayMicrobits(files, run_main=False, speed=4)
+    play(replay_microbits, 1)
+    played_ns = max(int(ring.tail()['time'][-1]) for ring in replay_microbits.df_dict.values()
+        ) - replay_microbits.start_ns
+    assert 3e9 < played_ns < 5e9
+
+
+def test_loop(tmp_path, monkeypatch):
+    files = record_session(tmp_path)
+    replay_microbits = ReplayMicrobits(files, run_main=False, speed=0, loop=True)
+    seeks = []
+    monkeypatch.setattr(replay_microbits, 'do_seek', lambda seconds: seeks.append(seconds)
+        or ReplayMicrobits.do_seek(replay_microbits, seconds))
+    play(replay_microbits, 1)
+    assert len(seeks) > 2
+    assert set(seeks) == {0}
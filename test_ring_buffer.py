@@ -0,0 +1,112 @@
+''' Tests for RingBuffer against a plain list of the rows appended. '''
+
+import threading
+
+import numpy as np
+import pytest
+
+from ring_buffer import SCAN_DTYPE, RingBuffer
+
+CAPACITY = 7
+
+
+def make_row(n, ident=1):
+    return (n * 1000, ident, n, -n, 2 * n, 3 * n, 100 + n)
+
+
+def test_wraps_like_a_list():
+    ring = RingBuffer(CAPACITY)
+    appended = []
+    # several times round the ring
+    for n in range(5 * CAPACITY + 3):
+        assert ring.append(make_row(n))
+        appended.append(make_row(n))
+        assert len(ring) == min(len(appended), CAPACITY)
+        for num_rows in (None, 1, 3, CAPACITY, CAPACITY + 5):
+            expected = appended[-min(num_rows or CAPACITY, CAPACITY):]
+            assert ring.tail(num_rows).tolist() == expected
+        assert 0 <= ring.index < CAPACITY
+    # each row is written twice, so the last capacity rows are one slice
+    assert ring.data[:CAPACITY].tolist() == ring.data[CAPACITY:].tolist()
+
+
+def test_repeated_count_dropped():
+    ring = RingBuffer(CAPACITY)
+    assert ring.append(make_row(1))
+    assert not ring.append(make_row(1))
+    assert len(ring) == 1
+    merged = RingBuffer(CAPACITY, check_count=False)
+    assert merged.append(make_row(1))
+    assert merged.append(make_row(1, ident=2))
+    assert len(merged) == 2
+
+
+def test_views_are_read_only():
+    ring = RingBuffer(CAPACITY)
+    for n in range(3):
+        ring.append(make_row(n))
+    for view in (ring.tail(), ring.snapshot(), ring.snapshot(2, 'mag_acc')):
+        assert view.base is not None
+        with pytest.raises(ValueError):
+            view[0] = view[-1]
+    assert ring.snapshot(2, 'mag_acc').tolist() == [101, 102]
+
+
+def test_copy_is_owned():
+    ring = RingBuffer(CAPACITY)
+    for n in range(CAPACITY):
+        ring.append(make_row(n))
+    view = ring.snapshot(CAPACITY, 'count')
+    copy = ring.snapshot(CAPACITY, 'count', copy=True)
+    assert copy.flags.writeable and copy.flags.owndata
+    for n in range(CAPACITY, 2 * CAPACITY):
+        ring.append(make_row(n))
+    # the view now shows the rows written since, the copy does not
+    assert view.tolist() == list(range(CAPACITY, 2 * CAPACITY))
+    assert copy.tolist() == list(range(CAPACITY))
+
+
+def test_clear():
+    ring = RingBuffer(CAPACITY)
+    for n in range(10):
+        ring.append(make_row(n))
+    sequence = ring.sequence
+    ring.clear()
+    assert len(ring) == 0
+    assert ring.tail().tolist() == []
+    assert ring.sequence > sequence and ring.sequence % 2 == 0
+    # the count check starts again
+    assert ring.append(make_row(9))
+
+
+def test_to_dataframe():
+    ring = RingBuffer(CAPACITY)
+    for n in range(10):
+        ring.append(make_row(n))
+    df = ring.to_dataframe(4)
+    assert df.index.name == 'time'
+    assert df.index.tolist() == [n * 1000 for n in range(6, 10)]
+    assert list(df.columns) == list(SCAN_DTYPE.names[1:])
+    assert df['mag_acc'].tolist() == [106, 107, 108, 109]
+    # the frame holds its own rows
+    ring.append(make_row(10))
+    assert df['mag_acc'].tolist() == [106, 107, 108, 109]
+
+
+def test_snapshot_while_appending():
+    ring = RingBuffer(CAPACITY)
+    done = threading.Event()
+
+    def write():
+        for n in range(20000):
+            ring.append(make_row(n))
+        done.set()
+
+    thread = threading.Thread(target=write)
+    thread.start()
+    while not done.is_set():
+        rows = ring.snapshot(CAPACITY, copy=True)
+        # every row is whole and the rows are consecutive
+        assert (rows['mag_acc'] == rows['count'] + 100).all()
+        assert (np.diff(rows['count']) == 1).all()
+    thread.join()
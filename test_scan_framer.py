@@ -0,0 +1,59 @@
+''' Tests for the incremental framing of version 1 scans by ScanFramer. '''
+
+from scan_framer import MAX_BUFFER, ScanFramer
+
+SCAN = 'ST,1,1234,-240,336,240,EN'
+
+
+def test_scan_split_across_reads():
+    framer = ScanFramer()
+    scans = []
+    for byte in SCAN.encode():
+        scans.extend(framer.feed(bytes([byte])))
+    assert scans == [SCAN]
+    assert framer.version == 1
+
+
+def test_back_to_back_scans_in_one_read():
+    framer = ScanFramer()
+    second = SCAN.replace('1234', '1235')
+    assert framer.feed(SCAN + second) == [SCAN, second]
+
+
+def test_end_marker_split_across_reads():
+    framer = ScanFramer()
+    assert framer.feed(SCAN[:-1]) == []
+    assert framer.feed(SCAN[-1:]) == [SCAN]
+
+
+def test_resync_after_garbage():
+    framer = ScanFramer()
+    garbage = 'xx,3,EN'
+    assert framer.feed(garbage + SCAN) == [SCAN]
+    assert framer.discarded_bytes == len(garbage)
+    assert framer.malformed == 0
+
+
+def test_truncated_scan_is_dropped():
+    framer = ScanFramer()
+    assert framer.feed('ST,1,1233,-240' + SCAN) == [SCAN]
+    assert framer.malformed == 1
+
+
+def test_resync_without_end_marker():
+    framer = ScanFramer()
+    assert framer.feed('ST' + '0' * MAX_BUFFER) == []
+    assert framer.feed(SCAN) == [SCAN]
+
+
+def test_wrong_number_of_fields_is_malformed():
+    framer = ScanFramer()
+    assert framer.feed('ST,1,1234,EN' + SCAN) == [SCAN]
+    assert framer.malformed == 1
+
+
+def test_reset_drops_partial_scan():
+    framer = ScanFramer()
+    framer.feed(SCAN[:10])
+    framer.reset()
+    assert framer.feed(SCAN[10:] + SCAN) == [SCAN]
@@ -0,0 +1,66 @@
+''' Tests for the loss, duplicate and reorder counting of SequenceTracker. '''
+
+from sequence_tracker import COUNT_MODULUS, SequenceTracker
+
+
+def update_all(tracker, counts):
+    ''' Return the result of updating <tracker> with each of <counts>. '''
+    return [tracker.update(count) for count in counts]
+
+
+def test_in_order():
+    tracker = SequenceTracker()
+    assert update_all(tracker, range(5, 10)) == [True] * 5
+    assert tracker.received == 5
+    assert tracker.gap_lost == 0
+
+
+def test_gap_counted():
+    tracker = SequenceTracker()
+    update_all(tracker, [1, 2, 6])
+    assert tracker.gap_lost == 3
+
+
+def test_duplicate_dropped():
+    tracker = SequenceTracker()
+    assert update_all(tracker, [1, 2, 2, 3]) == [True, True, False, True]
+    assert tracker.duplicated == 1
+    assert tracker.received == 3
+
+
+def test_reordered_fills_gap():
+    tracker = SequenceTracker()
+    assert update_all(tracker, [1, 3, 2, 4]) == [True, True, False, True]
+    assert tracker.reordered == 1
+    assert tracker.gap_lost == 0
+    assert tracker.received == 4
+
+
+def test_wrap():
+    tracker = SequenceTracker()
+    counts = [COUNT_MODULUS - 2, COUNT_MODULUS - 1, 0, 1]
+    assert update_all(tracker, counts) == [True] * 4
+    assert tracker.gap_lost == 0
+    assert tracker.reordered == 0
+
+
+def test_gap_across_wrap():
+    tracker = SequenceTracker()
+    update_all(tracker, [COUNT_MODULUS - 1, 2])
+    assert tracker.gap_lost == 2
+
+
+def test_reordered_across_wrap():
+    tracker = SequenceTracker()
+    assert update_all(tracker, [COUNT_MODULUS - 1, 1, 0]) == [True, True, False]
+    assert tracker.reordered == 1
+    assert tracker.gap_lost == 0
+
+
+def test_rate():
+    tracker = SequenceTracker(rate_window=1.0)
+    start = tracker.window_start
+    for count in range(50):
+        tracker.update(count, now=start + count / 50)
+    tracker.update(50, now=start + 1.0)
+    assert abs(tracker.rate - 50) < 1
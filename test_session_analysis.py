@@ -0,0 +1,96 @@
+''' Tests for the statistics of DeviceStats and SessionAnalysis. '''
+
+import numpy as np
+
+from recorder import RECORD_DTYPE
+from sequence_tracker import COUNT_MODULUS, SequenceTracker
+from session_analysis import DeviceStats, SessionAnalysis
+
+PERIOD_NS = 11000000
+
+
+def delivered(num_samples, first_count=0, seed=0):
+    ''' Return the counts of <num_samples> samples as a receiver delivers
+    them, with some lost, some repeated and some swapped with the next. '''
+    rng = np.random.default_rng(seed)
+    counts = [count for count in range(first_count, first_count + num_samples)
+        if rng.random() > 0.05]
+    result = []
+    index = 0
+    while index < len(counts):
+        chance = rng.random()
+        if chance < 0.05 and index + 1 < len(counts):
+            # the later sample arrives first, after a gap which the earlier fills
+            result += [counts[index + 1], counts[index]]
+            index += 2
+            continue
+        result.append(counts[index])
+        if chance < 0.1:
+            result.append(counts[index])
+        index += 1
+    return np.array(result, dtype=np.int64) % COUNT_MODULUS
+
+
+def tracked(counts):
+    tracker = SequenceTracker()
+    for count in counts.tolist():
+        tracker.update(count)
+    return tracker
+
+
+def stats_of(counts, chunk_rows=None, seed=0):
+    ''' Return DeviceStats of <counts> added whole, or in chunks of up to <chunk_rows>. '''
+    rng = np.random.default_rng(seed)
+    times = np.arange(len(counts), dtype=np.int64) * PERIOD_NS
+    mags = rng.integers(0, 4000, len(counts))
+    stats = DeviceStats()
+    start = 0
+    while start < len(counts):
+        end = len(counts) if chunk_rows is None else start + int(rng.integers(1, chunk_rows))
+        stats.add(times[start:end], counts[start:end], mags[start:end])
+        start = end
+    return stats
+
+
+def test_counts_match_sequence_tracker():
+    for first_count in (0, COUNT_MODULUS - 500):
+        counts = delivered(2000, first_count)
+        tracker = tracked(counts)
+        summary = stats_of(counts).summary()
+        assert tracker.duplicated > 0 and tracker.reordered > 0 and tracker.gap_lost > 0
+        assert summary['samples'] == len(counts)
+        assert summary['duplicated'] == tracker.duplicated
+        assert summary['reordered'] == tracker.reordered
+        assert summary['lost'] == tracker.gap_lost
+
+
+def test_chunks_match_whole():
+    counts = delivered(3000, COUNT_MODULUS - 1000, seed=1)
+    whole = stats_of(counts).summary()
+    for chunk_rows in (2, 7, 100):
+        assert stats_of(counts, chunk_rows).summary() == whole
+
+
+def test_session_analysis_by_device():
+    counts = [delivered(500, seed=ident) for ident in range(3)]
+    records = np.zeros(sum(len(device) for device in counts), dtype=RECORD_DTYPE)
+    ids = np.concatenate([np.full(len(device), ident) for ident, device in enumerate(counts)])
+    # interleaved in the order they would be stored
+    order = np.argsort(np.concatenate([np.arange(len(device)) for device in counts]),
+        kind='stable')
+    records['id'] = ids[order]
+    records['count'] = np.concatenate(counts)[order]
+    records['time_ns'] = np.arange(len(records)) * PERIOD_NS
+    records['mag_acc'] = 1000
+    analysis = SessionAnalysis()
+    for start in range(0, len(records), 64):
+        analysis.add(records[start:start + 64])
+    summary = analysis.summary()
+    assert summary['rows'] == len(records)
+    for ident, device in enumerate(counts):
+        tracker = tracked(device)
+        stats = summary['devices'][ident]
+        assert stats['samples'] == len(device)
+        assert (stats['duplicated'], stats['reordered'], stats['lost']) == (
+            tracker.duplicated, tracker.reordered, tracker.gap_lost)
+        assert stats['mag_mean'] == 1000
@@ -0,0 +1,175 @@
+''' Tests for the shared memory ring buffers and the reader process of shared_buffer.py. '''
+
+import logging
+import os
+from time import monotonic, sleep
+
+import numpy as np
+import pytest
+
+import shared_buffer
+from shared_buffer import AcquisitionProcess, SharedSampleBuffer
+
+ROWS = [(n * 1000, 0, n, 0, 0, 0, 1000 + n) for n in range(10)]
+
+
+def append_rows(name, argv):
+    ''' A reader process which stores ROWS for mb_0, then exits. '''
+    shared = SharedSampleBuffer(name=name)
+    shared.heartbeat()
+    for row in ROWS:
+        shared.df_dict['mb_0'].append(row)
+    shared.close()
+
+
+def die_mid_write(name, argv):
+    ''' A reader process which dies inside an append to mb_0. '''
+    shared = SharedSampleBuffer(name=name)
+    # the first half of RingBuffer.append
+    shared.df_dict['mb_0'].sequence += 1
+    os._exit(1)
+
+
+def exit_at_once(name, argv):
+    os._exit(1)
+
+
+def stall(name, argv):
+    ''' A reader process which beats once, then hangs. '''
+    shared = SharedSampleBuffer(name=name)
+    shared.heartbeat()
+    sleep(60)
+
+
+def wait_for_exit(acquisition, timeout=10):
+    acquisition.process.join(timeout)
+    assert not acquisition.process.is_alive()
+
+
+@pytest.fixture
+def acquisition():
+    acquisition = AcquisitionProcess(2, 50)
+    yield acquisition
+    acquisition.stop()
+
+
+def test_attached_view_shares_rows():
+    shared = SharedSampleBuffer(2, 4)
+    view = SharedSampleBuffer(name=shared.name, readonly=True)
+    assert (view.num_microbits, view.capacity) == (2, 4)
+    for row in ROWS:
+        shared.df_dict['mb_0'].append(row)
+    # wrapped around the capacity of 4
+    snapshot = view.snapshot(column=None)
+    assert snapshot['mb_0'].tolist() == ROWS[-4:]
+    assert len(snapshot['mb_1']) == 0
+    assert view.sequences() == shared.sequences()
+    with pytest.raises(ValueError):
+        view.snapshot(column=None)['mb_0'][0] = ROWS[0]
+    with pytest.raises(ValueError):
+        view.df_dict['mb_0'].append(ROWS[0])
+    view.close()
+    shared.close()
+
+
+def test_copy_outlives_writes():
+    shared = SharedSampleBuffer(1, 4)
+    ring = shared.df_dict['mb_0']
+    for row in ROWS[:4]:
+        ring.append(row)
+    copy = shared.snapshot(4, copy=True)['mb_0']
+    view = shared.snapshot(4)['mb_0']
+    for row in ROWS[4:]:
+        ring.append(row)
+    assert copy.tolist() == [row[-1] for row in ROWS[:4]]
+    assert view.tolist() != copy.tolist()
+    del view
+    shared.close()
+
+
+def test_not_a_sample_buffer():
+    shared = SharedSampleBuffer(1, 4)
+    shared.set_field('magic', 0)
+    with pytest.raises(ValueError):
+        SharedSampleBuffer(name=shared.name)
+    shared.close()
+
+
+def test_snapshot_gives_up_on_a_dead_writer(caplog):
+    shared = SharedSampleBuffer(1, 4)
+    ring = shared.df_dict['mb_0']
+    ring.append(ROWS[0])
+    ring.sequence += 1
+    with caplog.at_level(logging.INFO):
+        assert shared.snapshot(column='count')['mb_0'].tolist() == [0]
+    assert 'inconsistent snapshot' in caplog.text
+    shared.close()
+
+
+def test_reader_process_writes(acquisition, monkeypatch):
+    monkeypatch.setattr(shared_buffer, 'run_reader', append_rows)
+    acquisition.start()
+    wait_for_exit(acquisition)
+    assert acquisition.process.exitcode == 0
+    assert acquisition.snapshot(column='count')['mb_0'].tolist() == list(range(10))
+    assert acquisition.view.heartbeat_age() < 10
+
+
+def test_restart_after_death_mid_write(acquisition, monkeypatch, caplog):
+    monkeypatch.setattr(shared_buffer, 'run_reader', die_mid_write)
+    acquisition.start()
+    wait_for_exit(acquisition)
+    ring = acquisition.view.df_dict['mb_0']
+    assert ring.sequence & 1
+    monkeypatch.setattr(shared_buffer, 'run_reader', append_rows)
+    assert acquisition.check() == 'reader restarted'
+    wait_for_exit(acquisition)
+    assert ring.sequence % 2 == 0
+    with caplog.at_level(logging.INFO):
+        assert acquisition.snapshot(column='count')['mb_0'].tolist() == list(range(10))
+    assert 'inconsistent snapshot' not in caplog.text
+
+
+def test_gives_up_after_max_restarts(acquisition, monkeypatch):
+    monkeypatch.setattr(shared_buffer, 'run_reader', exit_at_once)
+    acquisition.start()
+    statuses = []
+    for _ in range(acquisition.max_restarts + 1):
+        wait_for_exit(acquisition)
+        statuses.append(acquisition.check())
+    assert statuses == ['reader restarted'] * acquisition.max_restarts + [
+        'reader died, exit code 1']
+    assert acquisition.restarts == acquisition.max_restarts
+
+
+def test_stall(monkeypatch):
+    monkeypatch.setattr(shared_buffer, 'run_reader', stall)
+    monkeypatch.setattr(shared_buffer, 'STALL_TIMEOUT', 0.2)
+    acquisition = AcquisitionProcess(2, 50)
+    acquisition.start()
+    deadline = monotonic() + 10
+    while acquisition.view.heartbeat_age() is None and monotonic() < deadline:
+        sleep(0.01)
+    assert acquisition.check() == 'reader running'
+    sleep(0.3)
+    assert acquisition.check().startswith('reader stalled')
+    # the stalled reader does not answer the stop request and is terminated
+    monkeypatch.setattr(shared_buffer, 'JOIN_TIMEOUT', 0.2)
+    acquisition.stop()
+    assert not acquisition.process.is_alive()
+    assert acquisition.check() == 'stopped'
+
+
+def test_fake_microbits_in_reader_process(monkeypatch):
+    monkeypatch.setattr(shared_buffer.sys, 'argv', ['read_microbits', '--fake'])
+    acquisition = AcquisitionProcess(3, 50)
+    acquisition.start()
+    sleep(2)
+    assert acquisition.check() == 'reader running'
+    samples = acquisition.snapshot(column=None, copy=True)
+    acquisition.stop()
+    assert acquisition.process.exitcode == 0
+    for ident, rows in enumerate(samples.values()):
+        assert len(rows) > 10
+        assert (rows['id'] == ident).all()
+        assert (np.diff(rows['time']) > 0).all()
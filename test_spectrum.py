@@ -0,0 +1,71 @@
+''' Tests for the dominant frequencies found by Spectrum. '''
+
+import numpy as np
+
+from spectrum import HOP, SAMPLE_RATE, Spectrum
+
+AMPLITUDE = 300
+# samples of each microbit a second, polled one after another
+POLL_RATE = 80
+
+
+def polled(frequencies, seconds, seed=0):
+    ''' Return the times, ids and mags of microbits polled in turn for
+    <seconds>, each sampling a sine at its one of <frequencies>. '''
+    rng = np.random.default_rng(seed)
+    num_polls = int(seconds * POLL_RATE)
+    num_microbits = len(frequencies)
+    ids = np.tile(np.arange(num_microbits), num_polls)
+    times = (np.repeat(np.arange(num_polls), num_microbits) + (ids + rng.random(
+        len(ids)) * 0.5) / num_microbits) * (1e9 / POLL_RATE)
+    mags = 1000 + AMPLITUDE * np.sin(2 * np.pi * np.array(frequencies)[ids] * times / 1e9)
+    return times.astype(np.int64), ids, mags.round().astype(np.int32)
+
+
+def feed(spectrum, times, ids, mags, batch=24):
+    for start in range(0, len(ids), batch):
+        spectrum.process(times[start:start + batch], ids[start:start + batch],
+            mags[start:start + batch])
+
+
+def test_dominant_frequency():
+    frequencies = [2.5, 3.2, 1.1]
+    spectrum = Spectrum(3)
+    feed(spectrum, *polled(frequencies, 10))
+    dominant = spectrum.dominant_frequencies()
+    assert sorted(dominant) == [0, 1, 2]
+    for ident, frequency in enumerate(frequencies):
+        assert abs(dominant[ident] - frequency) < 0.05
+        bins, magnitudes = spectrum.spectrum(ident)
+        assert abs(bins[magnitudes.argmax()] - frequency) < SAMPLE_RATE / len(magnitudes)
+        # the Hann window loses at most about a sixth between bins
+        assert 0.8 * AMPLITUDE < magnitudes.max() < 1.05 * AMPLITUDE
+
+
+def test_no_spectrum_before_a_full_block():
+    spectrum = Spectrum(1)
+    feed(spectrum, *polled([2.0], 2))
+    assert spectrum.dominant_frequencies() == {}
+    assert spectrum.spectrum(0) is None
+
+
+def test_transforms_at_most_every_hop():
+    spectrum = Spectrum(1)
+    feed(spectrum, *polled([2.0], 10))
+    sequence = spectrum.sequences()[0]
+    times, ids, mags = polled([2.0], 4)
+    feed(spectrum, times + 10 ** 10, ids, mags)
+    # a flush transforms once if a hop of values or more has arrived
+    assert 0 < spectrum.sequences()[0] - sequence <= 4 * SAMPLE_RATE / HOP
+
+
+def test_reset():
+    spectrum = Spectrum(2)
+    feed(spectrum, *polled([2.5, 3.2], 10))
+    spectrum.reset()
+    assert spectrum.dominant_frequencies() == {}
+    # after a seek back to the start the frequencies are found again
+    feed(spectrum, *polled([1.5, 4.0], 10))
+    dominant = spectrum.dominant_frequencies()
+    assert abs(dominant[0] - 1.5) < 0.05
+    assert abs(dominant[1] - 4.0) < 0.05